@@ -0,0 +1,135 @@
+#!/usr/bin/python3
+
+# Adaptive output buffering for the GStreamer players.
+#
+# Rather than one queue size and the sink's default buffer for every
+# device, --adaptive-buffer starts on the tightest rung of a ladder of
+# sink buffer-time / latency-time and queue sizes. It climbs a rung as
+# soon as the queue runs dry, and steps back down once a device has played
+# stable_time seconds without a dropout, checked every check_interval
+# rather than only between tracks, so each device settles on the least
+# buffering it can sustain.
+#
+# The queue is resized live through its max-size-time. alsasink only reads
+# buffer-time and latency-time when it opens the device, and restarting it
+# under a playing pipeline upsets the stream, so the sink's part of a rung
+# waits until the pipeline is next stopped, as it is when the supervisor
+# rebuilds it, and is set from the main loop then; until then the queue
+# alone carries the rung. Sinks without buffer-time keep their own.
+
+import sys, time
+
+import gi
+
+gi.require_version('Gst', '1.0')
+from gi.repository import GLib, Gst
+
+# sink buffer-time and latency-time, and queue max-size-time, in ms
+levels = [
+    (40, 10, 250),
+    (80, 10, 500),
+    (160, 20, 1000),
+    (320, 40, 2000),
+    (640, 40, 4000),
+]
+
+default_stable_time = 300.0
+# the queue runs dry when a track starts, after a skip, and while it fills
+# up to a new rung; ignore that
+settle_time = 2.0
+# seconds between checks for a rung to step down
+check_interval = 10
+
+class AdaptiveBuffer(object):
+
+    def __init__(self, sink, queue=None, level=0, stable_time=default_stable_time, name="buffer",
+                 clock=time.monotonic):
+        # queue is left alone when None, as in multibike.py where it sets
+        # how far the bikes may drift apart
+        self.sink = sink
+        self.queue = queue
+        self.level = level
+        self.stable_time = stable_time
+        self.name = name
+        self.clock = clock
+
+        self.underruns = 0
+        self.boundary = clock()
+        self.changed = clock()
+        # a rung the sink has yet to take
+        self.pending = None
+        self.configure(self.level)
+        GLib.timeout_add_seconds(check_interval, self.check)
+
+    def configure(self, level):
+        # with the pipeline stopped
+        self.configure_sink(level)
+        if self.queue is not None:
+            self.queue.set_property('max-size-time', levels[level][2] * Gst.MSECOND)
+
+    def configure_sink(self, level):
+        buffer_ms, latency_ms, queue_ms = levels[level]
+        if self.sink.find_property('buffer-time') is not None:
+            self.sink.set_property('buffer-time', buffer_ms * 1000)
+            self.sink.set_property('latency-time', latency_ms * 1000)
+
+    def underrun(self):
+        # from the queue's underrun signal, on a streaming thread
+        if self.clock() - self.boundary > settle_time:
+            self.underruns += 1
+            GLib.idle_add(self.climb)
+
+    def climb(self):
+        # on the main loop, after a dropout
+        if self.underruns:
+            self.underruns = 0
+            self.set_level(min(self.level + 1, len(levels) - 1))
+        return GLib.SOURCE_REMOVE
+
+    def check(self):
+        # on the main loop, every check_interval; changed is reset by a
+        # climb, so this is the time since the last dropout or step
+        if self.clock() - self.changed >= self.stable_time:
+            self.set_level(max(self.level - 1, 0))
+        return GLib.SOURCE_CONTINUE
+
+    def track_changed(self):
+        # on the main loop, as the switcher flips to a new track
+        self.underruns = 0
+        self.boundary = self.clock()
+
+    def set_level(self, level):
+        now = self.clock()
+        if level == self.level:
+            # nowhere further to go; start counting again from here
+            self.changed = now
+            return
+        self.level = level
+        self.changed = now
+        self.boundary = now
+        buffer_ms, latency_ms, queue_ms = levels[level]
+        sys.stderr.write("%s: level %d, %d ms sink buffer, %d ms queue\n" % (self.name, level, buffer_ms, queue_ms))
+        if self.queue is not None:
+            self.queue.set_property('max-size-time', queue_ms * Gst.MSECOND)
+        if self.sink.find_property('buffer-time') is not None:
+            self.pending = level
+            if self.sink.get_state(0)[1] <= Gst.State.READY:
+                self.stopped()
+
+    def stopped(self):
+        # on the main loop, with the sink closed, so the rung waiting for
+        # it is read when it opens again
+        if self.pending is not None:
+            self.configure_sink(self.pending)
+            self.pending = None
+
+def add_arguments(parser):
+    parser.add_argument('--adaptive-buffer', action='store_true',
+                        help="size the sink buffer and queue from the dropouts each device has")
+    parser.add_argument('--buffer-stable-time', type=float, default=default_stable_time,
+                        help="seconds without a dropout before buffering is reduced again")
+
+def from_options(options, sink, queue=None, name="buffer"):
+    if not options.adaptive_buffer:
+        return None
+    return AdaptiveBuffer(sink, queue, stable_time=options.buffer_stable_time, name=name)
@@ -0,0 +1,103 @@
+#!/usr/bin/python3
+
+# Background sampler for the trimpot ADC.
+#
+# The ADS1015 runs in continuous-conversion mode, so each read is a single
+# register fetch rather than a start-convert-wait cycle, and the reads
+# happen on this thread instead of the control path. Readings go through
+# a short median (kills I2C glitches), then an EMA, then a dead-band; only
+# a change that clears the dead-band is published to `latest` and passed
+# to on_change. With a ready pin the thread wakes on the ADS1015's
+# ALERT/RDY edge instead of its own timer.
+
+import sys, time, threading, traceback
+
+default_rate = 100
+default_median = 5
+default_alpha = 0.3
+default_deadband = 0.01
+
+class AdcSampler(object):
+
+    def __init__(self, backend, rate=default_rate, median=default_median, alpha=default_alpha,
+                 deadband=default_deadband, ready_pin=None, on_change=None):
+        self.backend = backend
+        self.interval = 1.0 / rate
+        self.median = median
+        self.alpha = alpha
+        self.deadband = deadband
+        self.ready_pin = ready_pin
+        self.on_change = on_change
+
+        self.window = []
+        self.filtered = None
+        self.latest = None
+        self.samples = 0
+
+        self.stopping = threading.Event()
+        self.ready = threading.Event()
+        self.thread = None
+
+    def start(self):
+        self.backend.open_adc(continuous=True, data_rate=max(int(1.0 / self.interval), 128),
+                              ready_pin=self.ready_pin)
+        if self.ready_pin is not None:
+            self.backend.add_edge_callback(self.ready_pin, lambda pin: self.ready.set(), 0)
+
+        # take a first reading before anyone asks for one
+        self.sample()
+        self.thread = threading.Thread(target=self.run, name="adc-sampler", daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        self.stopping.set()
+        self.ready.set()
+
+    def run(self):
+        deadline = time.monotonic()
+        while not self.stopping.is_set():
+            if self.ready_pin is not None:
+                # fall back to the timer if the ready edge goes missing
+                self.ready.wait(self.interval * 4)
+                self.ready.clear()
+            else:
+                deadline += self.interval
+                delay = deadline - time.monotonic()
+                if delay > 0:
+                    self.stopping.wait(delay)
+                else:
+                    deadline = time.monotonic()
+            if self.stopping.is_set():
+                break
+            try:
+                self.sample()
+            except Exception:
+                traceback.print_exc(file=sys.stderr)
+
+    def sample(self):
+        self.samples += 1
+        self.window.append(self.backend.read_voltage())
+        if len(self.window) > self.median:
+            del self.window[0]
+        value = sorted(self.window)[len(self.window) // 2]
+
+        if self.filtered is None:
+            self.filtered = value
+        else:
+            self.filtered += self.alpha * (value - self.filtered)
+
+        if self.latest is None or abs(self.filtered - self.latest) >= self.deadband:
+            self.latest = self.filtered
+            if self.on_change is not None:
+                self.on_change(self.latest)
+
+def add_arguments(parser):
+    parser.add_argument('--adc-rate', type=int, default=default_rate, help="trimpot samples per second")
+    parser.add_argument('--adc-median', type=int, default=default_median, help="median filter length in samples")
+    parser.add_argument('--adc-alpha', type=float, default=default_alpha, help="EMA smoothing factor, 1 for none")
+    parser.add_argument('--adc-deadband', type=float, default=default_deadband, help="volts the reading must move before it counts")
+    parser.add_argument('--adc-ready-pin', type=int, help="GPIO wired to the ADS1015 ALERT/RDY output")
+
+def from_options(options, backend, on_change=None):
+    return AdcSampler(backend, options.adc_rate, options.adc_median, options.adc_alpha,
+                      options.adc_deadband, options.adc_ready_pin, on_change)
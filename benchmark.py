@@ -0,0 +1,621 @@
+#!/usr/bin/python3
+
+# End-to-end benchmarks for the players, run against the simulated input
+# backend so they work on any machine with GStreamer (and mplayer for the
+# mplayer players) installed.
+#
+#   gst      pulse-to-rate latency through speedo_player.py: hall edge to
+#            set_rate, to the first buffer out of the rate engine, and to
+#            that buffer being rendered by a synchronised fakesink; CPU per
+#            second of audio; track switch latency
+#   mplayer  the same for speedo_mplayer.py, plus the slave-protocol round
+#            trip for a speed change
+#   multibike  multibike.py with one bike more each round, until a bike's
+#            queue runs dry mid-playback: how many bikes this machine drives;
+#            with --mixed each bike rides the cadence profile from a
+#            different step, so a shared group has fast and slow bikes
+#   control  round trip of --control-socket commands sent at a sustained
+#            rate to a playing speedo_player.py, with event subscribers
+#   startup  time to first audio of speedo_player.py or trimpot_player.py
+#            started afresh, resuming from a checkpoint after the first
+#            run, with the player's own breakdown of where the time went
+#
+# Results are written as JSON so runs on different builds can be compared.
+
+import sys, os, re, time, json, signal, argparse, platform, threading, subprocess, resource, contextlib, tempfile
+
+import hardware
+
+default_cadence = "180:4,240:4,120:4,300:4,90:4,200:4"
+
+def percentile(values, p):
+    if not values:
+        return None
+    values = sorted(values)
+    k = (len(values) - 1) * p / 100.0
+    low = int(k)
+    high = min(low + 1, len(values) - 1)
+    return values[low] + (values[high] - values[low]) * (k - low)
+
+def summary(values, scale=1000.0):
+    # milliseconds by default
+    if not values:
+        return {'count': 0}
+    return {
+        'count': len(values),
+        'mean': sum(values) / len(values) * scale,
+        'p50': percentile(values, 50) * scale,
+        'p90': percentile(values, 90) * scale,
+        'p99': percentile(values, 99) * scale,
+        'max': max(values) * scale,
+    }
+
+def build_info():
+    try:
+        revision = subprocess.check_output(["git", "describe", "--always", "--dirty"],
+                                           cwd=os.path.dirname(os.path.abspath(__file__)),
+                                           stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        revision = None
+    return {
+        'revision': revision,
+        'machine': platform.machine(),
+        'node': platform.node(),
+        'python': platform.python_version(),
+        'time': time.strftime("%Y-%m-%dT%H:%M:%S"),
+    }
+
+class GstLatencyProbe(object):
+
+    # follows each hall pulse through the player: posted to the engine by
+    # set_rate or ramp_to, out of the rate engine, and finally rendered by
+    # the sink
+
+    def __init__(self, app):
+        from gi.repository import Gst
+        self.Gst = Gst
+        self.app = app
+        self.lock = threading.Lock()
+        self.waiting_set = []
+        self.waiting_engine = []
+        self.waiting_render = []
+        self.control = []
+        self.engine = []
+        self.render = []
+        self.audio = 0
+
+        for name in ('set_rate', 'ramp_to'):
+            setattr(app.engine, name, self.timed(getattr(app.engine, name)))
+
+        app.engine.element.get_static_pad("src").add_probe(Gst.PadProbeType.BUFFER, self.on_engine)
+        app.sink.set_property("signal-handoffs", True)
+        app.sink.connect("handoff", self.on_handoff)
+
+    def timed(self, method):
+        def timed_method(*args):
+            method(*args)
+            now = time.monotonic()
+            with self.lock:
+                for pulse in self.waiting_set:
+                    self.control.append(now - pulse)
+                    self.waiting_engine.append(pulse)
+                self.waiting_set = []
+        return timed_method
+
+    def pulse(self, number):
+        with self.lock:
+            self.waiting_set.append(time.monotonic())
+        self.app.get_pulse(number)
+
+    def on_engine(self, pad, info):
+        now = time.monotonic()
+        pts = info.get_buffer().pts
+        with self.lock:
+            for pulse in self.waiting_engine:
+                self.engine.append(now - pulse)
+                self.waiting_render.append((pulse, pts))
+            self.waiting_engine = []
+        return self.Gst.PadProbeReturn.OK
+
+    def on_handoff(self, sink, buf, pad):
+        now = time.monotonic()
+        if buf.duration != self.Gst.CLOCK_TIME_NONE:
+            self.audio += buf.duration
+        with self.lock:
+            waiting = []
+            for pulse, pts in self.waiting_render:
+                if buf.pts >= pts:
+                    self.render.append(now - pulse)
+                else:
+                    waiting.append((pulse, pts))
+            self.waiting_render = waiting
+
+def bench_gst(options):
+    import gi
+    gi.require_version('Gst', '1.0')
+    from gi.repository import GLib, Gst
+    import speedo_player
+
+    Gst.init(None)
+    args = ['speedo_player.py'] + options.files + [
+        '--backend', 'sim', '--sink', 'fakesink', '--sim-cadence', options.cadence,
+        '--engine', options.engine, '--quality', options.quality, '--ramp-time', str(options.ramp_time),
+        '--display', 'none']
+    if options.cache_dir is not None:
+        args += ['--cache-dir', options.cache_dir]
+    player_options = speedo_player.parse_args(args)
+
+    loop = GLib.MainLoop()
+    backend = hardware.from_options(player_options, speedo_player.hall_pin)
+    app = speedo_player.MalvernStar_Player(loop, player_options, backend)
+    probe = GstLatencyProbe(app)
+    backend.add_edge_callback(speedo_player.hall_pin, probe.pulse, backend.pulse_bouncetime)
+
+    def skip():
+        if not app.switcher.switch(app.playnumber + 1):
+            app.switcher.switch(0)
+        return GLib.SOURCE_CONTINUE
+
+    if options.switch_interval > 0 and len(options.files) > 1:
+        GLib.timeout_add(int(options.switch_interval * 1000), skip)
+    GLib.timeout_add(int(options.seconds * 1000), app.quit)
+
+    backend.start()
+    cpu = time.process_time()
+    wall = time.monotonic()
+    app.start(player_options)
+    cpu = time.process_time() - cpu
+    wall = time.monotonic() - wall
+    backend.cleanup()
+
+    audio = probe.audio / Gst.SECOND
+    return {
+        'player': 'speedo_player',
+        'engine': options.engine,
+        'quality': options.quality,
+        'ramp_time': options.ramp_time,
+        'cached': options.cache_dir is not None,
+        'seconds': wall,
+        'audio_seconds': audio,
+        'cpu_per_audio_second': cpu / audio if audio else None,
+        'pulse_to_set_rate_ms': summary(probe.control),
+        'pulse_to_engine_ms': summary(probe.engine),
+        'pulse_to_render_ms': summary(probe.render),
+        # the first entry is the initial track start
+        'track_switch_ms': summary([latency / 1000.0 for latency in app.switcher.latencies[1:]]),
+    }
+
+class RecordingPlayer(object):
+
+    # stands in for mplayer.core.Player behind the command channel and
+    # notes when each pulse's speed change is handed to mplayer
+
+    def __init__(self, player):
+        self.__dict__['player'] = player
+        self.__dict__['lock'] = threading.Lock()
+        self.__dict__['waiting'] = []
+        self.__dict__['control'] = []
+
+    def pulse(self, stamp):
+        with self.lock:
+            self.waiting.append(stamp)
+
+    def __getattr__(self, name):
+        return getattr(self.player, name)
+
+    def __setattr__(self, name, value):
+        setattr(self.player, name, value)
+        if name == 'speed':
+            now = time.monotonic()
+            with self.lock:
+                self.control.extend(now - pulse for pulse in self.waiting)
+                del self.waiting[:]
+
+def bench_mplayer(options):
+    import speedo_mplayer
+
+    args = ['speedo_mplayer.py'] + options.files + [
+        '--backend', 'sim', '--ao', 'null', '--sim-cadence', options.cadence, '--display', 'none']
+    player_options = speedo_mplayer.parse_args(args)
+    backend = hardware.from_options(player_options, speedo_mplayer.hall_pin)
+    app = speedo_mplayer.SpeedoPlayer(player_options, backend)
+    player = app.player
+    recorder = RecordingPlayer(player)
+    app.control.player = recorder
+
+    def pulse(number):
+        recorder.pulse(time.monotonic())
+        app.get_pulse(number)
+    backend.add_edge_callback(speedo_mplayer.hall_pin, pulse, backend.pulse_bouncetime)
+
+    # the player loop runs until mplayer reports itself paused
+    stopper = threading.Timer(options.seconds, app.control.pause)
+    backend.start()
+    stopper.start()
+    wall = time.monotonic()
+    app.start(player_options)
+    wall = time.monotonic() - wall
+    backend.cleanup()
+
+    # the player loop stops playback on its way out, so load the files again
+    for path in options.files:
+        player.loadfile(path, 1)
+    while player.paused is not False:
+        time.sleep(0.01)
+
+    # slave protocol round trip: set the speed and read it back
+    round_trip = []
+    for i in range(options.commands):
+        started = time.monotonic()
+        player.speed = 1.0 + (i % 2) * 0.5
+        player.speed
+        round_trip.append(time.monotonic() - started)
+
+    switches = []
+    for i in range(min(options.switches, len(options.files) - 1)):
+        current = player.filename
+        started = time.monotonic()
+        player.pt_step(1)
+        while player.filename == current and time.monotonic() - started < 5:
+            time.sleep(0.001)
+        switches.append(time.monotonic() - started)
+
+    player.quit()
+    usage = resource.getrusage(resource.RUSAGE_CHILDREN)
+    cpu = usage.ru_utime + usage.ru_stime
+
+    return {
+        'player': 'speedo_mplayer',
+        'seconds': wall,
+        # mplayer plays at the commanded speed, so count wall time played
+        'cpu_per_audio_second': cpu / wall if wall else None,
+        'pulse_to_set_rate_ms': summary(recorder.control),
+        'speed_round_trip_ms': summary(round_trip),
+        'track_switch_ms': summary(switches),
+    }
+
+def bench_multibike(options):
+    import gi
+    gi.require_version('Gst', '1.0')
+    from gi.repository import GLib, Gst
+    import multibike
+
+    Gst.init(None)
+    rounds = []
+    for count in range(1, options.max_bikes + 1):
+        bikes = []
+        for number in range(count):
+            bike = {'name': "bike-%d" % number, 'hall_pin': 100 + number, 'sink': 'fakesink'}
+            if options.shared:
+                bike['group'] = 'shared'
+            else:
+                bike['files'] = options.files
+            bikes.append(bike)
+        config = {'groups': {'shared': {'files': options.files}}, 'bikes': bikes}
+
+        with tempfile.NamedTemporaryFile('w', suffix='.json') as f, \
+                tempfile.NamedTemporaryFile('w', suffix='.trace') as trace:
+            json.dump(config, f)
+            f.flush()
+            args = ['multibike.py', f.name, '--backend', 'sim', '--engine', options.engine,
+                    '--quality', options.quality, '--group-drift', options.group_drift]
+            if options.mixed:
+                # bike n starts n steps into the profile
+                profile = hardware.parse_profile(options.cadence)
+                for number, bike in enumerate(bikes):
+                    step = number % len(profile)
+                    for stamp, kind, pin in hardware.synthetic_pulses(bike['hall_pin'],
+                                                                      profile[step:] + profile[:step]):
+                        trace.write("%.6f %s %d\n" % (stamp, kind, pin))
+                trace.flush()
+                args += ['--sim-trace', trace.name]
+            else:
+                args += ['--sim-cadence', options.cadence]
+            if options.cache_dir is not None:
+                args += ['--cache-dir', options.cache_dir]
+            player_options = multibike.parse_args(args)
+            # the backend reads the trace here
+            backend = hardware.from_options(player_options, [bike['hall_pin'] for bike in bikes])
+
+        loop = GLib.MainLoop()
+        app = multibike.MultiBike(loop, config, player_options, backend)
+        GLib.timeout_add(int(options.seconds * 1000), app.quit)
+
+        backend.start()
+        cpu = time.process_time()
+        app.start()
+        cpu = time.process_time() - cpu
+        backend.cleanup()
+
+        audio = sum(bike.audio for bike in app.bikes) / Gst.SECOND
+        underruns = sum(bike.underruns for bike in app.bikes)
+        rounds.append({
+            'bikes': count,
+            'underruns': underruns,
+            'underruns_by_bike': [bike.underruns for bike in app.bikes],
+            'overruns_by_bike': [bike.overruns for bike in app.bikes],
+            'audio_seconds': audio,
+            'cpu_per_audio_second': cpu / audio if audio else None,
+        })
+        sys.stderr.write("%d bikes: %d underruns\n" % (count, underruns))
+        if underruns:
+            break
+
+    clean = [r['bikes'] for r in rounds if not r['underruns']]
+    return {
+        'player': 'multibike',
+        'engine': options.engine,
+        'quality': options.quality,
+        'shared': options.shared,
+        'mixed': options.mixed,
+        'group_drift': options.group_drift,
+        'cpus': len(os.sched_getaffinity(0)),
+        'max_bikes_without_underruns': max(clean) if clean else 0,
+        'rounds': rounds,
+    }
+
+class ControlLoad(object):
+
+    # sends batches of commands at a steady rate on one connection and
+    # times each reply, while other connections take the event stream
+
+    def __init__(self, path, rate, batch, commands, subscribers):
+        self.path = path
+        self.rate = rate
+        self.batch = batch
+        self.commands = commands
+        self.subscribers = subscribers
+        self.stopping = threading.Event()
+        self.lock = threading.Lock()
+        self.sent = {}
+        self.round_trips = []
+        self.errors = 0
+        self.events = 0
+        self.requests = 0
+
+    def connect(self):
+        import control_api
+        while not self.stopping.is_set():
+            try:
+                return control_api.ControlClient(self.path)
+            except OSError:
+                time.sleep(0.05)
+        return None
+
+    def start(self):
+        threading.Thread(target=self.run, name="control-load", daemon=True).start()
+        for number in range(self.subscribers):
+            threading.Thread(target=self.subscribe, name="control-subscriber", daemon=True).start()
+
+    def run(self):
+        client = self.connect()
+        if client is None:
+            return
+        threading.Thread(target=self.receive, args=(client,), daemon=True).start()
+        interval = 1.0 / self.rate
+        due = time.monotonic()
+        serial = 0
+        while not self.stopping.is_set():
+            batch = []
+            for i in range(self.batch):
+                command = dict(self.commands[serial % len(self.commands)], id=serial)
+                batch.append(command)
+                serial += 1
+            with self.lock:
+                now = time.monotonic()
+                for command in batch:
+                    self.sent[command['id']] = now
+            try:
+                client.send(batch if self.batch > 1 else batch[0])
+            except OSError:
+                return
+            self.requests += 1
+            due += interval
+            delay = due - time.monotonic()
+            if delay > 0:
+                self.stopping.wait(delay)
+
+    def receive(self, client):
+        while not self.stopping.is_set():
+            try:
+                reply = client.receive()
+            except (OSError, EOFError, ValueError):
+                return
+            now = time.monotonic()
+            with self.lock:
+                for item in reply if isinstance(reply, list) else [reply]:
+                    sent = self.sent.pop(item.get('id'), None)
+                    if sent is not None:
+                        self.round_trips.append(now - sent)
+                    if not item.get('ok'):
+                        self.errors += 1
+
+    def subscribe(self):
+        client = self.connect()
+        if client is None:
+            return
+        client.send({'cmd': 'subscribe'})
+        while not self.stopping.is_set():
+            try:
+                message = client.receive()
+            except (OSError, EOFError, ValueError):
+                return
+            if 'event' in message:
+                with self.lock:
+                    self.events += 1
+
+def bench_control(options):
+    import gi
+    gi.require_version('Gst', '1.0')
+    from gi.repository import GLib, Gst
+    import speedo_player
+
+    Gst.init(None)
+    directory = tempfile.mkdtemp()
+    path = os.path.join(directory, "control.sock")
+    args = ['speedo_player.py'] + options.files + [
+        '--backend', 'sim', '--sink', 'fakesink', '--sim-cadence', options.cadence,
+        '--display', 'none', '--control-socket', path]
+    player_options = speedo_player.parse_args(args)
+
+    loop = GLib.MainLoop()
+    backend = hardware.from_options(player_options, speedo_player.hall_pin)
+    app = speedo_player.MalvernStar_Player(loop, player_options, backend)
+    backend.add_edge_callback(speedo_player.hall_pin, app.get_pulse, backend.pulse_bouncetime)
+
+    commands = {
+        'status': [{'cmd': 'status'}],
+        'ping': [{'cmd': 'ping'}],
+        # exercises the whole rate path, then hands it back to the wheel
+        'rpm': [{'cmd': 'rpm', 'value': 240}, {'cmd': 'status'}, {'cmd': 'rpm', 'value': None}],
+    }[options.mix]
+    load = ControlLoad(path, options.rate, options.batch, commands, options.subscribers)
+    GLib.timeout_add(int(options.seconds * 1000), app.quit)
+
+    backend.start()
+    load.start()
+    wall = time.monotonic()
+    app.start(player_options)
+    wall = time.monotonic() - wall
+    load.stopping.set()
+    backend.cleanup()
+    os.rmdir(directory)
+
+    return {
+        'player': 'speedo_player',
+        'mix': options.mix,
+        'batch': options.batch,
+        'subscribers': options.subscribers,
+        'target_requests_per_second': options.rate,
+        'requests_per_second': load.requests / wall,
+        'commands': len(load.round_trips),
+        'unanswered': len(load.sent),
+        'errors': load.errors,
+        'events': load.events,
+        'round_trip_ms': summary(load.round_trips),
+    }
+
+startup_line = re.compile(r'time to audio: (\d+) ms after process start \((.*)\)')
+startup_phase = re.compile(r'(\w+) (\d+) ms')
+
+def bench_startup(options):
+    here = os.path.dirname(os.path.abspath(__file__))
+    directory = tempfile.mkdtemp()
+    state = os.path.join(directory, "state.json")
+    # unbuffered, or the time to audio line sits in the pipe
+    command = [sys.executable, '-u', os.path.join(here, options.player)] + options.files + [
+        '--backend', 'sim', '--sink', 'fakesink', '--display', 'none', '--state-file', state]
+
+    runs = []
+    for number in range(options.runs):
+        started = time.monotonic()
+        child = subprocess.Popen(command, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, text=True)
+        timer = threading.Timer(options.timeout, child.kill)
+        timer.start()
+        run = None
+        for line in child.stdout:
+            match = startup_line.search(line)
+            if match is not None:
+                run = {'wall_ms': (time.monotonic() - started) * 1000,
+                       'total_ms': float(match.group(1)),
+                       'phases_ms': dict((name, float(ms)) for name, ms in startup_phase.findall(match.group(2)))}
+                break
+        timer.cancel()
+        # a few seconds' play, so the next run has a checkpoint part way in
+        time.sleep(options.play)
+        child.send_signal(signal.SIGINT)
+        child.communicate()
+        if run is None:
+            sys.stderr.write("run %d: no audio within %.0f s\n" % (number, options.timeout))
+            continue
+        run['resumed'] = number > 0
+        sys.stderr.write("run %d: %.0f ms to audio\n" % (number, run['total_ms']))
+        runs.append(run)
+
+    if os.path.exists(state):
+        os.unlink(state)
+    os.rmdir(directory)
+    phases = {}
+    for run in runs:
+        for name, ms in run['phases_ms'].items():
+            phases.setdefault(name, []).append(ms)
+    return {
+        'player': options.player,
+        'runs': runs,
+        'time_to_audio_ms': summary([run['total_ms'] for run in runs], scale=1.0),
+        'resumed_time_to_audio_ms': summary([run['total_ms'] for run in runs if run['resumed']], scale=1.0),
+        'phases_ms': dict((name, summary(values, scale=1.0)) for name, values in phases.items()),
+    }
+
+def main(args):
+    parser = argparse.ArgumentParser(prog=args[0], description="speedoplayer benchmarks")
+    parser.add_argument('--output', default='-', help="JSON results file, - for stdout")
+    commands = parser.add_subparsers(dest='command', required=True)
+
+    gst = commands.add_parser('gst', help="GStreamer player latency, CPU and track switch time")
+    gst.add_argument('files', nargs='+')
+    gst.add_argument('--seconds', type=float, default=24.0)
+    gst.add_argument('--cadence', default=default_cadence, help="synthetic pulse profile, rpm:seconds,...")
+    gst.add_argument('--engine', default='speed')
+    gst.add_argument('--quality', default='medium')
+    gst.add_argument('--ramp-time', type=float, default=0.5)
+    gst.add_argument('--cache-dir')
+    gst.add_argument('--switch-interval', type=float, default=5.0, help="seconds between skips, 0 for none")
+    gst.set_defaults(run=bench_gst)
+
+    mplayer = commands.add_parser('mplayer', help="mplayer player latency, CPU and track switch time")
+    mplayer.add_argument('files', nargs='+')
+    mplayer.add_argument('--seconds', type=float, default=24.0)
+    mplayer.add_argument('--cadence', default=default_cadence, help="synthetic pulse profile, rpm:seconds,...")
+    mplayer.add_argument('--commands', type=int, default=200, help="speed round trips to time")
+    mplayer.add_argument('--switches', type=int, default=5)
+    mplayer.set_defaults(run=bench_mplayer)
+
+    bikes = commands.add_parser('multibike', help="bikes one process drives before underruns")
+    bikes.add_argument('files', nargs='+')
+    bikes.add_argument('--seconds', type=float, default=30.0, help="seconds per round")
+    bikes.add_argument('--cadence', default=default_cadence, help="synthetic pulse profile, rpm:seconds,...")
+    bikes.add_argument('--max-bikes', type=int, default=16)
+    bikes.add_argument('--shared', action='store_true', help="one group sharing a decode, not a group per bike")
+    bikes.add_argument('--mixed', action='store_true', help="give each bike a different cadence at any moment")
+    bikes.add_argument('--group-drift', choices=['wait', 'skip'], default='wait',
+                       help="what a shared group does about a bike left behind, see multibike.py")
+    bikes.add_argument('--engine', default='speed')
+    bikes.add_argument('--quality', default='medium')
+    bikes.add_argument('--cache-dir')
+    bikes.set_defaults(run=bench_multibike)
+
+    control = commands.add_parser('control', help="control socket round trip under a steady command rate")
+    control.add_argument('files', nargs='+')
+    control.add_argument('--seconds', type=float, default=20.0)
+    control.add_argument('--cadence', default=default_cadence, help="synthetic pulse profile, rpm:seconds,...")
+    control.add_argument('--rate', type=float, default=200.0, help="requests per second")
+    control.add_argument('--batch', type=int, default=1, help="commands per request")
+    control.add_argument('--mix', choices=('status', 'ping', 'rpm'), default='status', help="commands sent")
+    control.add_argument('--subscribers', type=int, default=1, help="connections taking every event")
+    control.set_defaults(run=bench_control)
+
+    startup = commands.add_parser('startup', help="time to first audio from launch, with a breakdown")
+    startup.add_argument('files', nargs='+')
+    startup.add_argument('--player', choices=('speedo_player.py', 'trimpot_player.py'), default='speedo_player.py')
+    startup.add_argument('--runs', type=int, default=5)
+    startup.add_argument('--play', type=float, default=3.0, help="seconds each run plays before it is stopped")
+    startup.add_argument('--timeout', type=float, default=30.0, help="seconds to wait for audio")
+    startup.set_defaults(run=bench_startup)
+
+    options = parser.parse_args(args[1:])
+
+    # the players print status lines; keep them out of the JSON
+    with contextlib.redirect_stdout(sys.stderr):
+        result = options.run(options)
+
+    output = {'build': build_info(), 'benchmark': options.command, 'result': result}
+    text = json.dumps(output, indent=2, sort_keys=True)
+    if options.output == '-':
+        print(text)
+    else:
+        with open(options.output, 'w') as f:
+            f.write(text + "\n")
+
+if __name__ == '__main__':
+    main(sys.argv)
@@ -0,0 +1,356 @@
+#!/usr/bin/python3
+
+# Local control and event API for speedo_player.py, on a Unix socket.
+#
+# Each request is one line of JSON, a command object or a list of them to
+# run as a batch, and gets back one line: a reply object, or a list of
+# replies in the same order. A command's "id", if it has one, is echoed in
+# its reply.
+#
+#   {"cmd": "next"}
+#   [{"cmd": "rpm", "value": 240, "id": 1}, {"cmd": "status", "id": 2}]
+#
+# Commands:
+#
+#   ping, status
+#   play, pause, toggle, next, prev
+#   rate     {"value": 1.2} plays at that rate whatever the wheel does,
+#            {"value": null} hands it back to the wheel
+#   rpm      the same, overriding the measured RPM instead
+#   subscribe {"events": ["track", "state", "rate"]}, or every kind when
+#            left out; events then arrive on the same connection as
+#            {"event": "track", ...} lines between the replies
+#   unsubscribe
+#
+# The socket and every connection are watched from the player's main loop
+# and never block it: requests are read as they arrive and replies are
+# written as far as the socket takes them, the rest when it drains. A
+# client that falls more than max_backlog bytes behind is dropped. The
+# watches run at default priority, below the hall pulses, so a flood of
+# commands delays other commands rather than rate updates.
+#
+# Run this file to send commands, or to watch the events:
+#
+#   python3 control_api.py /run/speedo/control.sock '{"cmd": "status"}'
+#   python3 control_api.py /run/speedo/control.sock --watch
+
+import sys, os, json, time, argparse, traceback
+
+import gi
+
+gi.require_version('Gst', '1.0')
+from gi.repository import GLib, Gst
+
+event_kinds = ('track', 'state', 'rate')
+max_backlog = 256 * 1024
+max_request = 64 * 1024
+
+class Client(object):
+
+    def __init__(self, sock):
+        self.sock = sock
+        self.incoming = b''
+        self.outgoing = b''
+        self.events = set()
+        self.read_source = None
+        self.write_source = None
+
+class ControlServer(object):
+
+    # works on the attributes the GStreamer players have in common, plus
+    # speedo_player's rate_override and rpm_override
+
+    def __init__(self, app, path):
+        self.app = app
+        self.path = path
+        self.listener = None
+        self.source = None
+        self.clients = []
+
+    def start(self):
+        import socket
+
+        if os.path.exists(self.path):
+            os.unlink(self.path)
+        self.listener = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.listener.setblocking(False)
+        self.listener.bind(self.path)
+        self.listener.listen(16)
+        self.source = GLib.unix_fd_add_full(GLib.PRIORITY_DEFAULT, self.listener.fileno(),
+                                            GLib.IOCondition.IN, self.on_accept)
+
+    def stop(self):
+        for client in list(self.clients):
+            self.close(client)
+        if self.source is not None:
+            GLib.source_remove(self.source)
+            self.source = None
+        if self.listener is not None:
+            self.listener.close()
+            self.listener = None
+            try:
+                os.unlink(self.path)
+            except OSError:
+                pass
+
+    def on_accept(self, fd, condition):
+        try:
+            sock, address = self.listener.accept()
+        except OSError:
+            return GLib.SOURCE_CONTINUE
+        sock.setblocking(False)
+        client = Client(sock)
+        client.read_source = GLib.unix_fd_add_full(
+            GLib.PRIORITY_DEFAULT, sock.fileno(),
+            GLib.IOCondition.IN | GLib.IOCondition.HUP | GLib.IOCondition.ERR, self.on_readable, client)
+        self.clients.append(client)
+        return GLib.SOURCE_CONTINUE
+
+    def close(self, client):
+        for source in (client.read_source, client.write_source):
+            if source is not None:
+                GLib.source_remove(source)
+        client.read_source = client.write_source = None
+        client.sock.close()
+        if client in self.clients:
+            self.clients.remove(client)
+
+    def on_readable(self, fd, condition, client):
+        try:
+            data = client.sock.recv(65536)
+        except BlockingIOError:
+            return GLib.SOURCE_CONTINUE
+        except OSError:
+            data = b''
+        if not data:
+            client.read_source = None
+            self.close(client)
+            return GLib.SOURCE_REMOVE
+
+        lines = (client.incoming + data).split(b'\n')
+        client.incoming = lines.pop()
+        if len(client.incoming) > max_request:
+            client.read_source = None
+            self.close(client)
+            return GLib.SOURCE_REMOVE
+        # everything that arrived together is answered in one write
+        replies = [self.handle(client, line) for line in lines if line.strip()]
+        self.send(client, replies)
+        return GLib.SOURCE_CONTINUE
+
+    def handle(self, client, line):
+        try:
+            request = json.loads(line)
+        except ValueError:
+            return {'ok': False, 'error': "not JSON"}
+        if isinstance(request, list):
+            return [self.execute(client, command) for command in request]
+        return self.execute(client, request)
+
+    def execute(self, client, command):
+        if not isinstance(command, dict):
+            return {'ok': False, 'error': "expected an object"}
+        handler = getattr(self, 'cmd_' + str(command.get('cmd')), None)
+        if handler is None:
+            reply = {'ok': False, 'error': "unknown command %r" % command.get('cmd')}
+        else:
+            try:
+                reply = {'ok': True, 'result': handler(client, command)}
+            except (KeyError, TypeError, ValueError) as e:
+                # a malformed command
+                reply = {'ok': False, 'error': "%s: %s" % (type(e).__name__, e)}
+            except Exception as e:
+                # anything else is ours, but must not take the main loop down
+                traceback.print_exc(file=sys.stderr)
+                reply = {'ok': False, 'error': "%s: %s" % (type(e).__name__, e)}
+        if 'id' in command:
+            reply['id'] = command['id']
+        return reply
+
+    def send(self, client, messages):
+        if not messages or client.sock.fileno() < 0:
+            return
+        client.outgoing += b''.join(json.dumps(message).encode() + b'\n' for message in messages)
+        if len(client.outgoing) > max_backlog:
+            sys.stderr.write("control: dropping a client %d bytes behind\n" % len(client.outgoing))
+            self.close(client)
+            return
+        if client.write_source is None:
+            self.flush(client)
+            if client.outgoing:
+                client.write_source = GLib.unix_fd_add_full(GLib.PRIORITY_DEFAULT, client.sock.fileno(),
+                                                            GLib.IOCondition.OUT, self.on_writable, client)
+
+    def flush(self, client):
+        try:
+            sent = client.sock.send(client.outgoing)
+        except BlockingIOError:
+            return True
+        except OSError:
+            return False
+        client.outgoing = client.outgoing[sent:]
+        return True
+
+    def on_writable(self, fd, condition, client):
+        if not self.flush(client):
+            client.write_source = None
+            self.close(client)
+            return GLib.SOURCE_REMOVE
+        if client.outgoing:
+            return GLib.SOURCE_CONTINUE
+        client.write_source = None
+        return GLib.SOURCE_REMOVE
+
+    def emit(self, kind, **fields):
+        # from the main loop, whenever the player's state changes
+        event = None
+        for client in list(self.clients):
+            if kind in client.events:
+                if event is None:
+                    event = dict(fields, event=kind, stamp=time.monotonic())
+                self.send(client, [event])
+
+    def state(self):
+        # where the pipeline is heading, so a reply straight after play or
+        # pause reports the change rather than the state it is leaving
+        state, pending = self.app.player.get_state(0)[1:]
+        if pending != Gst.State.VOID_PENDING:
+            state = pending
+        if state == Gst.State.PLAYING:
+            return 'playing'
+        return 'paused'
+
+    # commands, on the main loop; the return value is the reply's result
+
+    def cmd_ping(self, client, command):
+        return None
+
+    def cmd_status(self, client, command):
+        app = self.app
+        return {
+            'track': app.playnumber,
+            'location': app.playlist[app.playnumber],
+            'state': self.state(),
+            'rpm': app.rpm,
+            'rate': app.engine.rate,
+            'position': app.position.position(),
+            'duration': app.position.duration(),
+            'rate_override': app.rate_override,
+            'rpm_override': app.rpm_override,
+        }
+
+    def cmd_toggle(self, client, command):
+        self.app.playpause(None)
+        return self.state()
+
+    def cmd_play(self, client, command):
+        if self.state() != 'playing':
+            self.app.playpause(None)
+        return self.state()
+
+    def cmd_pause(self, client, command):
+        if self.state() == 'playing':
+            self.app.playpause(None)
+        return self.state()
+
+    def cmd_next(self, client, command):
+        return self.app.switcher.skip()
+
+    def cmd_prev(self, client, command):
+        return self.app.switcher.previous()
+
+    def cmd_rate(self, client, command):
+        value = command['value']
+        self.app.rate_override = float(value) if value is not None else None
+        self.app.update_speed()
+        return self.app.engine.rate
+
+    def cmd_rpm(self, client, command):
+        value = command['value']
+        self.app.rpm_override = float(value) if value is not None else None
+        self.app.update_speed()
+        return self.app.rpm
+
+    def cmd_subscribe(self, client, command):
+        kinds = command.get('events') or event_kinds
+        unknown = [kind for kind in kinds if kind not in event_kinds]
+        if unknown:
+            raise ValueError("unknown events %s" % ", ".join(map(str, unknown)))
+        client.events.update(kinds)
+        return sorted(client.events)
+
+    def cmd_unsubscribe(self, client, command):
+        client.events.clear()
+        return []
+
+class NullControlServer(object):
+
+    def start(self):
+        pass
+
+    def stop(self):
+        pass
+
+    def emit(self, kind, **fields):
+        pass
+
+def add_arguments(parser):
+    parser.add_argument('--control-socket', help="take commands and publish events on this Unix socket")
+
+def from_options(options, app):
+    if options.control_socket is None:
+        return NullControlServer()
+    return ControlServer(app, options.control_socket)
+
+class ControlClient(object):
+
+    def __init__(self, path):
+        import socket
+
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.sock.connect(path)
+        self.file = self.sock.makefile('rb')
+
+    def send(self, request):
+        self.sock.sendall(json.dumps(request).encode() + b'\n')
+
+    def receive(self):
+        line = self.file.readline()
+        if not line:
+            raise EOFError("connection closed")
+        return json.loads(line)
+
+    def request(self, request):
+        # the reply, passing over any events on the way
+        self.send(request)
+        while True:
+            reply = self.receive()
+            if isinstance(reply, list) or 'event' not in reply:
+                return reply
+
+    def close(self):
+        self.file.close()
+        self.sock.close()
+
+def main(args):
+    parser = argparse.ArgumentParser(prog=args[0], description="send commands to a player's --control-socket")
+    parser.add_argument('socket')
+    parser.add_argument('requests', nargs='*', help="JSON commands, or lists of them, sent in turn")
+    parser.add_argument('--watch', action='store_true', help="then print events until interrupted")
+    options = parser.parse_args(args[1:])
+
+    client = ControlClient(options.socket)
+    for text in options.requests:
+        print(json.dumps(client.request(json.loads(text))))
+    if options.watch:
+        client.request({'cmd': 'subscribe'})
+        try:
+            while True:
+                print(json.dumps(client.receive()))
+                sys.stdout.flush()
+        except (KeyboardInterrupt, EOFError):
+            pass
+    client.close()
+
+if __name__ == '__main__':
+    main(sys.argv)
@@ -0,0 +1,201 @@
+#!/usr/bin/python3
+
+# Decoder selection for the GStreamer players.
+#
+# Tracks are decoded by decodebin, so anything the installed plugins can
+# play will do: MP3, FLAC, Ogg Vorbis and Opus, AAC. Which decoder decodebin
+# picks for a format is down to the factories' ranks, and the stock ranks
+# favour quality and features rather than what is cheapest on a small ARM
+# board. apply() raises the ranks of the decoders in preferences, first in
+# each list highest; a name starting with '-' is dropped to NONE so it is
+# never picked. The ranks are set in this process and exported through
+# GST_PLUGIN_FEATURE_RANK to the gst-launch children of pcm_cache.py and
+# tempo.py.
+#
+# Override a format from the command line with, for example,
+#
+#   --decoder mp3=mad,-avdec_mp3
+#
+# Run this file with some tracks to see what each installed decoder costs
+# on the current machine:
+#
+#   python3 decoders.py track.mp3 track.flac track.opus
+
+import sys, os, time, argparse
+
+import gi
+
+gi.require_version('Gst', '1.0')
+from gi.repository import Gst
+
+# cheapest first on a Pi class ARM core: mpg123 and fdk have NEON paths,
+# ivorbisdec is the integer-only Tremor
+preferences = {
+    'mp3': ['mpg123audiodec', 'mad', 'avdec_mp3'],
+    'aac': ['fdkaacdec', 'avdec_aac', 'faad'],
+    'flac': ['flacdec', 'avdec_flac'],
+    'vorbis': ['ivorbisdec', 'vorbisdec', 'avdec_vorbis'],
+    'opus': ['opusdec', 'avdec_opus'],
+}
+
+# above every stock decoder rank
+preferred_rank = Gst.Rank.PRIMARY + 100
+
+def ranks(prefer):
+    # factory name -> rank
+    result = {}
+    for names in prefer.values():
+        position = 0
+        for name in names:
+            if name.startswith('-'):
+                result[name[1:]] = Gst.Rank.NONE
+            else:
+                result[name] = preferred_rank - position
+                position += 1
+    return result
+
+def apply(prefer=preferences):
+    applied = {}
+    for name, rank in ranks(prefer).items():
+        factory = Gst.ElementFactory.find(name)
+        if factory is None:
+            continue
+        factory.set_rank(rank)
+        applied[name] = rank
+    # children read this at gst_init
+    exported = dict(entry.split(':', 1) for entry in os.environ.get('GST_PLUGIN_FEATURE_RANK', '').split(',')
+                    if ':' in entry)
+    exported.update((name, str(rank)) for name, rank in ranks(prefer).items())
+    os.environ['GST_PLUGIN_FEATURE_RANK'] = ','.join("%s:%s" % item for item in sorted(exported.items()))
+    return applied
+
+def parse_preference(text):
+    name, _, decoders = text.partition('=')
+    if not decoders:
+        raise argparse.ArgumentTypeError("expected FORMAT=DECODER[,DECODER...]")
+    return name, decoders.split(',')
+
+def add_arguments(parser):
+    parser.add_argument('--decoder', type=parse_preference, action='append', default=[], metavar='FORMAT=DECODERS',
+                        help="decoders to prefer for a format, best first; -name to never use one")
+
+def from_options(options):
+    prefer = dict(preferences)
+    prefer.update(options.decoder)
+    return apply(prefer)
+
+def audio_decoders():
+    return Gst.ElementFactory.list_get_elements(
+        Gst.ELEMENT_FACTORY_TYPE_DECODER | Gst.ELEMENT_FACTORY_TYPE_MEDIA_AUDIO, Gst.Rank.NONE)
+
+def stream_caps(path):
+    # the caps of each elementary stream in the file, as parsebin hands
+    # them to a decoder
+    pipeline = Gst.Pipeline.new("probe")
+    source = Gst.ElementFactory.make("filesrc", None)
+    parse = Gst.ElementFactory.make("parsebin", None)
+    source.set_property("location", path)
+    pipeline.add(source)
+    pipeline.add(parse)
+    source.link(parse)
+
+    found = []
+    def pad_added(element, pad):
+        found.append(pad.query_caps(None))
+        sink = Gst.ElementFactory.make("fakesink", None)
+        pipeline.add(sink)
+        sink.sync_state_with_parent()
+        pad.link(sink.get_static_pad("sink"))
+    parse.connect("pad-added", pad_added)
+
+    pipeline.set_state(Gst.State.PAUSED)
+    pipeline.get_bus().timed_pop_filtered(10 * Gst.SECOND, Gst.MessageType.ASYNC_DONE | Gst.MessageType.ERROR)
+    pipeline.set_state(Gst.State.NULL)
+    return found
+
+def measure(path, name):
+    # filesrc ! parsebin ! <decoder> ! fakesink, as fast as it will go
+    pipeline = Gst.Pipeline.new("measure")
+    source = Gst.ElementFactory.make("filesrc", None)
+    parse = Gst.ElementFactory.make("parsebin", None)
+    decoder = Gst.ElementFactory.make(name, None)
+    sink = Gst.ElementFactory.make("fakesink", None)
+    source.set_property("location", path)
+    sink.set_property("sync", False)
+    for element in (source, parse, decoder, sink):
+        pipeline.add(element)
+    source.link(parse)
+    decoder.link(sink)
+
+    def pad_added(element, pad):
+        target = decoder.get_static_pad("sink")
+        if not target.is_linked() and pad.can_link(target):
+            pad.link(target)
+            return
+        # other streams, or a second audio one, go nowhere
+        drop = Gst.ElementFactory.make("fakesink", None)
+        pipeline.add(drop)
+        drop.sync_state_with_parent()
+        pad.link(drop.get_static_pad("sink"))
+    parse.connect("pad-added", pad_added)
+
+    decoded = [0]
+    def on_buffer(pad, info):
+        buf = info.get_buffer()
+        if buf.duration != Gst.CLOCK_TIME_NONE:
+            decoded[0] += buf.duration
+        return Gst.PadProbeReturn.OK
+    decoder.get_static_pad("src").add_probe(Gst.PadProbeType.BUFFER, on_buffer)
+
+    bus = pipeline.get_bus()
+    cpu = time.process_time()
+    wall = time.monotonic()
+    pipeline.set_state(Gst.State.PLAYING)
+    message = bus.timed_pop_filtered(Gst.CLOCK_TIME_NONE, Gst.MessageType.EOS | Gst.MessageType.ERROR)
+    cpu = time.process_time() - cpu
+    wall = time.monotonic() - wall
+    pipeline.set_state(Gst.State.NULL)
+
+    if message.type == Gst.MessageType.ERROR:
+        err, debug = message.parse_error()
+        raise RuntimeError("%s: %s" % (err, debug))
+    audio = decoded[0] / Gst.SECOND
+    if not audio:
+        raise RuntimeError("nothing decoded")
+    return cpu / audio, wall / audio
+
+def report(args):
+    parser = argparse.ArgumentParser(prog=args[0], description="CPU per decoded second for each installed decoder")
+    parser.add_argument('files', nargs='+')
+    parser.add_argument('--decoders', help="comma separated decoders to try instead of every one that fits")
+    options = parser.parse_args(args[1:])
+
+    Gst.init(None)
+    factories = audio_decoders()
+    if options.decoders:
+        wanted = options.decoders.split(',')
+        factories = [factory for factory in factories if factory.get_name() in wanted]
+
+    print("{0:<32}{1:<20}{2:>8}{3:>10}{4:>10}".format("file", "decoder", "rank", "cpu %", "rtf"))
+    for path in options.files:
+        label = os.path.basename(path)[:31]
+        candidates = []
+        for caps in stream_caps(path):
+            for factory in Gst.ElementFactory.list_filter(factories, caps, Gst.PadDirection.SINK, False):
+                if factory not in candidates:
+                    candidates.append(factory)
+        if not candidates:
+            print("{0:<32}no decoder for this file".format(label))
+            continue
+        for factory in sorted(candidates, key=lambda factory: -factory.get_rank()):
+            name = factory.get_name()
+            try:
+                cpu, rtf = measure(path, name)
+            except Exception as e:
+                print("{0:<32}{1:<20}{2:>8}  failed: {3}".format(label, name, factory.get_rank(), e))
+                continue
+            # cpu % is of one core while playing in real time
+            print("{0:<32}{1:<20}{2:>8}{3:>10.2f}{4:>10.4f}".format(label, name, factory.get_rank(), cpu * 100, rtf))
+
+if __name__ == '__main__':
+    report(sys.argv)
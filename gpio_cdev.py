@@ -0,0 +1,248 @@
+#!/usr/bin/python3
+
+# Edge capture through the Linux GPIO character device (the v2 uAPI that
+# libgpiod uses), for --backend cdev.
+#
+# RPi.GPIO calls back on its own thread and the player stamps the pulse
+# when it gets round to it, so every interval carries thread scheduling
+# and GIL jitter. Here the kernel stamps each edge with CLOCK_MONOTONIC in
+# its interrupt handler, the same clock as time.monotonic(), and queues
+# it on the line request's file descriptor. A reader thread wakes on
+# epoll, reads whatever edges have piled up in one go and calls back for
+# each; while it does, backend.clock() returns that edge's kernel stamp,
+# so the players' get_pulse needs no change.
+#
+# Debouncing is done here on the kernel stamps rather than by the
+# kernel's own debouncer, which delays the edge and stamps it late. The
+# hall sensor gets --pulse-debounce, 2 ms by default instead of RPi.GPIO's
+# 20 ms.
+#
+# --gpio-chip sim swaps the chip for SimulatedChip, which replays the
+# --sim-cadence / --sim-trace edges as the kernel would, as binary
+# gpio_v2_line_event records down a pipe; the ADC is not simulated. Run
+# this file to compare RPM jitter with kernel stamps against stamps
+# taken in the callback:
+#
+#   python3 gpio_cdev.py --chip /dev/gpiochip0 --pin 17 --seconds 60
+
+import sys, os, time, fcntl, struct, select, threading, argparse
+
+import hardware
+
+GPIO_V2_GET_LINE_IOCTL = 0xc250b407
+
+GPIO_V2_LINE_FLAG_INPUT = 1 << 2
+GPIO_V2_LINE_FLAG_EDGE_RISING = 1 << 4
+GPIO_V2_LINE_FLAG_EDGE_FALLING = 1 << 5
+GPIO_V2_LINE_FLAG_BIAS_PULL_UP = 1 << 8
+
+GPIO_V2_LINE_EVENT_RISING_EDGE = 1
+GPIO_V2_LINE_EVENT_FALLING_EDGE = 2
+
+# struct gpio_v2_line_request: offsets[64], consumer[32], then
+# gpio_v2_line_config (flags, num_attrs, padding[5], attrs[10] of 24
+# bytes), num_lines, event_buffer_size, padding[5], fd
+line_request = struct.Struct('=64I32sQI20x240xII20xi')
+# struct gpio_v2_line_event: timestamp_ns, id, offset, seqno, line_seqno,
+# padding[6]
+line_event = struct.Struct('=QIIII24x')
+
+default_chip = '/dev/gpiochip0'
+default_pulse_debounce = 2.0
+consumer = b'speedoplayer'
+# edges kept by the kernel per line before the oldest are dropped
+event_buffer = 64
+
+class GpioChip(object):
+
+    def __init__(self, path=default_chip):
+        self.fd = os.open(path, os.O_RDONLY | os.O_CLOEXEC)
+
+    def request_line(self, offset):
+        # one input line with a pull-up, reporting falling edges, as
+        # RPi.GPIO was set up; returns the fd its events are read from
+        request = bytearray(line_request.pack(
+            *([offset] + [0] * 63 + [consumer,
+              GPIO_V2_LINE_FLAG_INPUT | GPIO_V2_LINE_FLAG_EDGE_FALLING | GPIO_V2_LINE_FLAG_BIAS_PULL_UP, 0,
+              1, event_buffer, 0])))
+        fcntl.ioctl(self.fd, GPIO_V2_GET_LINE_IOCTL, request)
+        return line_request.unpack(request)[-1]
+
+    def close(self):
+        os.close(self.fd)
+
+class SimulatedChip(object):
+
+    # stands in for GpioChip: each requested line is a pipe, and a replay
+    # thread writes its edges into it at their trace times, stamped with
+    # the monotonic time they were due
+
+    def __init__(self, events, time_scale=1.0):
+        self.events = [event for event in events if event[1] == "edge"]
+        self.time_scale = time_scale
+        self.lines = {}
+        self.seqno = 0
+        self.stopping = threading.Event()
+        self.thread = None
+        self.on_finished = None
+
+    def request_line(self, offset):
+        read, write = os.pipe()
+        self.lines[offset] = write
+        return read
+
+    def start(self):
+        self.started = time.monotonic()
+        self.thread = threading.Thread(target=self.run, name="sim-chip", daemon=True)
+        self.thread.start()
+
+    def run(self):
+        for stamp, kind, offset in self.events:
+            due = self.started + stamp / self.time_scale
+            delay = due - time.monotonic()
+            if delay > 0 and self.stopping.wait(delay):
+                return
+            if offset in self.lines:
+                self.seqno += 1
+                os.write(self.lines[offset], line_event.pack(
+                    int(due * 1e9), GPIO_V2_LINE_EVENT_FALLING_EDGE, offset, self.seqno, self.seqno))
+        if self.on_finished is not None:
+            self.on_finished()
+
+    def close(self):
+        self.stopping.set()
+        for write in self.lines.values():
+            os.close(write)
+
+class CdevBackend(hardware.Ads1015, hardware.Backend):
+
+    def __init__(self, chip, pulse_debounce=default_pulse_debounce, record=None):
+        super(CdevBackend, self).__init__(record)
+        self.chip = chip
+        self.pulse_bouncetime = pulse_debounce
+        self.lines = {}
+        self.last_edge = {}
+        self.poll = select.epoll()
+        self.on_finished = None
+
+        self.stopping = False
+        self.thread = None
+        self.dispatching = None
+        self.event_time = 0.0
+
+    def clock(self):
+        # the kernel's stamp for the edge being dispatched
+        if threading.get_ident() == self.dispatching:
+            return self.event_time
+        return time.monotonic()
+
+    def add_edge_callback(self, pin, callback, bouncetime):
+        fd = self.chip.request_line(pin)
+        self.lines[fd] = (pin, self.wrap(callback), bouncetime / 1000.0)
+        # safe while the reader is waiting in epoll
+        self.poll.register(fd, select.EPOLLIN)
+
+    def start(self):
+        self.started = time.monotonic()
+        self.thread = threading.Thread(target=self.run, name="gpio-cdev", daemon=True)
+        self.thread.start()
+        if isinstance(self.chip, SimulatedChip):
+            self.chip.on_finished = lambda: self.on_finished is not None and self.on_finished()
+            self.chip.start()
+
+    def run(self):
+        self.dispatching = threading.get_ident()
+        size = line_event.size * event_buffer
+        while not self.stopping:
+            for fd, mask in self.poll.poll(0.5):
+                if fd not in self.lines:
+                    continue
+                self.dispatch(fd, os.read(fd, size))
+
+    def dispatch(self, fd, data):
+        pin, callback, bouncetime = self.lines[fd]
+        for offset in range(0, len(data) - line_event.size + 1, line_event.size):
+            stamp = line_event.unpack_from(data, offset)[0] / 1e9
+            if stamp - self.last_edge.get(pin, -bouncetime) < bouncetime:
+                continue
+            self.last_edge[pin] = stamp
+            self.event_time = stamp
+            callback(pin)
+
+    def cleanup(self):
+        self.stopping = True
+        if self.thread is not None:
+            self.thread.join(1.0)
+        for fd in list(self.lines):
+            os.close(fd)
+        self.lines = {}
+        self.chip.close()
+        super(CdevBackend, self).cleanup()
+
+def from_options(options, events):
+    if options.gpio_chip == 'sim':
+        # edges in real time, as the kernel would see them
+        chip = SimulatedChip(events)
+    else:
+        chip = GpioChip(options.gpio_chip)
+    return CdevBackend(chip, options.pulse_debounce, options.record_trace)
+
+def jitter(stamps):
+    # spread of the instantaneous RPM over a steady cadence
+    intervals = [b - a for a, b in zip(stamps, stamps[1:]) if b > a]
+    if len(intervals) < 2:
+        return None
+    rpms = [60.0 / interval for interval in intervals]
+    mean = sum(rpms) / len(rpms)
+    deviation = (sum((rpm - mean) ** 2 for rpm in rpms) / len(rpms)) ** 0.5
+    interval_mean = sum(intervals) / len(intervals)
+    interval_deviation = (sum((i - interval_mean) ** 2 for i in intervals) / len(intervals)) ** 0.5
+    return {'pulses': len(stamps), 'rpm_mean': mean, 'rpm_stddev': deviation,
+            'interval_stddev_ms': interval_deviation * 1000}
+
+def busy(stopping):
+    # Python work on another thread, to contend for the GIL the way the
+    # rate engine callbacks and display do
+    while not stopping.is_set():
+        sum(range(10000))
+
+def main(args):
+    parser = argparse.ArgumentParser(prog=args[0], description="RPM jitter: kernel edge stamps against callback stamps")
+    parser.add_argument('--chip', default='sim', help="GPIO character device, or sim")
+    parser.add_argument('--pin', type=int, default=17)
+    parser.add_argument('--seconds', type=float, default=30.0)
+    parser.add_argument('--cadence', type=float, default=240.0, help="rpm of the simulated wheel")
+    parser.add_argument('--load', type=int, default=2, help="busy Python threads to run alongside")
+    options = parser.parse_args(args[1:])
+
+    if options.chip == 'sim':
+        chip = SimulatedChip(hardware.synthetic_pulses(options.pin, [(options.cadence, options.seconds)]))
+    else:
+        chip = GpioChip(options.chip)
+    backend = CdevBackend(chip, 0)
+
+    kernel = []
+    callback = []
+    def pulse(pin):
+        callback.append(time.monotonic())
+        kernel.append(backend.clock())
+    backend.add_edge_callback(options.pin, pulse, 0)
+
+    stopping = threading.Event()
+    for i in range(options.load):
+        threading.Thread(target=busy, args=(stopping,), daemon=True).start()
+    backend.start()
+    time.sleep(options.seconds)
+    stopping.set()
+    backend.cleanup()
+
+    for name, stamps in (('kernel', kernel), ('callback', callback)):
+        result = jitter(stamps)
+        if result is None:
+            print("%-9s too few pulses" % name)
+        else:
+            print("%-9s %5d pulses  %7.2f rpm  rpm stddev %6.3f  interval stddev %7.3f ms" % (
+                name, result['pulses'], result['rpm_mean'], result['rpm_stddev'], result['interval_stddev_ms']))
+
+if __name__ == '__main__':
+    main(sys.argv)
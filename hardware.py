@@ -0,0 +1,255 @@
+#!/usr/bin/python3
+
+# Input backends for the players: the hall sensor and buttons on GPIO
+# edges, and the trimpot on channel 0 of an ADS1015.
+#
+#   gpio  the real thing, RPi.GPIO plus the Adafruit ADS1x15 driver; these
+#         are only imported when the backend is created
+#   cdev  the GPIO character device with kernel edge timestamps, see
+#         gpio_cdev.py; the ADC as for gpio
+#   sim   replays a trace of edges and voltages, recorded with
+#         --record-trace or generated from --sim-cadence, at real or
+#         accelerated time, so the players run anywhere
+#
+# A trace is plain text, one event per line, times in seconds from start:
+#
+#   0.512 edge 17
+#   0.750 adc 2.05
+#
+# Edge callbacks are called the same way RPi.GPIO calls them, with the pin
+# number, from a thread that is not the main loop's.
+
+import sys, time, threading
+
+class Backend(object):
+
+    time_scale = 1.0
+    # ms to register the hall sensor with
+    pulse_bouncetime = 20
+
+    def __init__(self, record=None):
+        self.record = None
+        self.started = time.monotonic()
+        if record is not None:
+            self.record = open(record, "w")
+            self.record_lock = threading.Lock()
+
+    def clock(self):
+        return time.monotonic()
+
+    def wrap(self, callback):
+        if self.record is None:
+            return callback
+        def recorded(pin):
+            self.log("edge", pin)
+            return callback(pin)
+        return recorded
+
+    def log(self, kind, value):
+        with self.record_lock:
+            self.record.write("%.6f %s %s\n" % (time.monotonic() - self.started, kind, value))
+
+    def open_adc(self, continuous=False, data_rate=None, ready_pin=None):
+        pass
+
+    def start(self):
+        pass
+
+    def cleanup(self):
+        if self.record is not None:
+            self.record.close()
+            self.record = None
+
+class Ads1015(object):
+
+    # the trimpot ADC, shared by the backends on real hardware
+
+    chan = None
+
+    def open_adc(self, continuous=False, data_rate=None, ready_pin=None):
+        import board
+        import busio
+        import adafruit_ads1x15.ads1015 as ADS
+        from adafruit_ads1x15.ads1x15 import Mode
+        from adafruit_ads1x15.analog_in import AnalogIn
+
+        # Create the I2C bus
+        i2c = busio.I2C(board.SCL, board.SDA)
+
+        # Create the ADC object using the I2C bus
+        self.ads = ADS.ADS1015(i2c)
+
+        if data_rate is not None:
+            rates = [rate for rate in self.ads.rates if rate >= data_rate]
+            self.ads.data_rate = rates[0] if rates else max(self.ads.rates)
+        if continuous:
+            # reads just fetch the last conversion instead of waiting on one
+            self.ads.mode = Mode.CONTINUOUS
+        if ready_pin is not None:
+            self.enable_ready_pin()
+
+        # Create single-ended input on channel 0
+        self.chan = AnalogIn(self.ads, ADS.P0)
+
+    def enable_ready_pin(self):
+        # ALERT/RDY pulses at the end of every conversion when the high
+        # threshold's MSB is set, the low threshold's is clear and the
+        # comparator queue is enabled
+        with self.ads.i2c_device as device:
+            device.write(bytes([0x02, 0x00, 0x00]))
+            device.write(bytes([0x03, 0x80, 0x00]))
+        if hasattr(self.ads, 'comparator_queue_length'):
+            self.ads.comparator_queue_length = 1
+        else:
+            sys.stderr.write("ADS1x15 driver too old to enable ALERT/RDY, sampling on a timer\n")
+
+    def read_voltage(self):
+        voltage = self.chan.voltage
+        if self.record is not None:
+            self.log("adc", voltage)
+        return voltage
+
+class GPIOBackend(Ads1015, Backend):
+
+    def __init__(self, record=None):
+        super(GPIOBackend, self).__init__(record)
+        import RPi.GPIO as GPIO
+        self.GPIO = GPIO
+        GPIO.setmode(GPIO.BCM)
+        GPIO.setwarnings(False)
+
+    def add_edge_callback(self, pin, callback, bouncetime):
+        GPIO = self.GPIO
+        GPIO.setup(pin, GPIO.IN, pull_up_down = GPIO.PUD_UP)
+        if bouncetime > 0:
+            GPIO.add_event_detect(pin, GPIO.FALLING, callback = self.wrap(callback), bouncetime=bouncetime)
+        else:
+            # RPi.GPIO refuses a bouncetime of 0; leaving it out means none
+            GPIO.add_event_detect(pin, GPIO.FALLING, callback = self.wrap(callback))
+
+    def cleanup(self):
+        self.GPIO.cleanup()
+        super(GPIOBackend, self).cleanup()
+
+def load_trace(path):
+    events = []
+    with open(path) as f:
+        for line in f:
+            line = line.split('#', 1)[0].split()
+            if not line:
+                continue
+            stamp, kind, value = line
+            events.append((float(stamp), kind, int(value) if kind == "edge" else float(value)))
+    events.sort(key=lambda event: event[0])
+    return events
+
+def synthetic_pulses(pin, profile):
+    # profile is a list of (rpm, seconds) steps
+    events = []
+    start = 0.0
+    stamp = 0.0
+    for rpm, seconds in profile:
+        if rpm > 0:
+            interval = 60.0 / rpm
+            stamp = max(stamp, start)
+            while stamp < start + seconds:
+                events.append((stamp, "edge", pin))
+                stamp += interval
+        start += seconds
+    return events
+
+def parse_profile(text):
+    # "90:30,120:60" -> 30 s at 90 rpm, then 60 s at 120 rpm
+    profile = []
+    for step in text.split(','):
+        rpm, _, seconds = step.partition(':')
+        profile.append((float(rpm), float(seconds or 60)))
+    return profile
+
+class SimulatedBackend(Backend):
+
+    def __init__(self, events, time_scale=1.0, voltage=0.0, record=None):
+        super(SimulatedBackend, self).__init__(record)
+        self.events = events
+        self.time_scale = time_scale
+        self.voltage = voltage
+        self.callbacks = {}
+        self.last_edge = {}
+        self.on_finished = None
+
+        self.stopping = threading.Event()
+        self.thread = None
+        self.dispatching = None
+        self.event_time = 0.0
+
+    def clock(self):
+        # the replay thread stamps events with their trace time so results
+        # do not depend on how promptly it was scheduled
+        if threading.get_ident() == self.dispatching:
+            return self.event_time
+        return (time.monotonic() - self.started) * self.time_scale
+
+    def add_edge_callback(self, pin, callback, bouncetime):
+        self.callbacks[pin] = (self.wrap(callback), bouncetime / 1000.0)
+
+    def read_voltage(self):
+        return self.voltage
+
+    def start(self):
+        self.started = time.monotonic()
+        self.thread = threading.Thread(target=self.run, name="sim-backend", daemon=True)
+        self.thread.start()
+
+    def run(self):
+        self.dispatching = threading.get_ident()
+        for stamp, kind, value in self.events:
+            delay = self.started + stamp / self.time_scale - time.monotonic()
+            if delay > 0 and self.stopping.wait(delay):
+                return
+            self.event_time = stamp
+            if kind == "adc":
+                self.voltage = value
+            elif kind == "edge" and value in self.callbacks:
+                callback, bouncetime = self.callbacks[value]
+                # same rule as RPi.GPIO: ignore edges inside the bounce time
+                if stamp - self.last_edge.get(value, -bouncetime) >= bouncetime:
+                    self.last_edge[value] = stamp
+                    callback(value)
+        if self.on_finished is not None:
+            self.on_finished()
+
+    def cleanup(self):
+        self.stopping.set()
+        super(SimulatedBackend, self).cleanup()
+
+def add_arguments(parser):
+    parser.add_argument('--backend', choices=['gpio', 'cdev', 'sim'], default='gpio',
+                        help="read real GPIO/ADC hardware, through RPi.GPIO or the GPIO character device, "
+                             "or a simulated trace")
+    parser.add_argument('--gpio-chip', default='/dev/gpiochip0',
+                        help="GPIO character device for --backend cdev, or sim to replay the simulated trace")
+    parser.add_argument('--pulse-debounce', type=float, default=2.0,
+                        help="ms after a hall edge in which further edges are ignored, with --backend cdev")
+    parser.add_argument('--sim-trace', help="trace file to replay with --backend sim")
+    parser.add_argument('--sim-cadence', help="synthetic hall pulses as rpm:seconds[,rpm:seconds...]")
+    parser.add_argument('--sim-voltage', type=float, default=2.0, help="trimpot voltage with --backend sim")
+    parser.add_argument('--time-scale', type=float, default=1.0, help="replay the simulated trace this many times faster")
+    parser.add_argument('--exit-after-trace', action='store_true', help="quit once the simulated trace has been replayed")
+    parser.add_argument('--record-trace', help="write every edge and ADC reading to this trace file")
+
+def from_options(options, hall_pin=None):
+    if options.backend == 'gpio':
+        return GPIOBackend(options.record_trace)
+
+    events = []
+    if options.sim_trace is not None:
+        events.extend(load_trace(options.sim_trace))
+    if options.sim_cadence is not None and hall_pin is not None:
+        # one pin, or a list of them for several bikes
+        for pin in hall_pin if isinstance(hall_pin, (list, tuple)) else [hall_pin]:
+            events.extend(synthetic_pulses(pin, parse_profile(options.sim_cadence)))
+    events.sort(key=lambda event: event[0])
+    if options.backend == 'cdev':
+        import gpio_cdev
+        return gpio_cdev.from_options(options, events)
+    return SimulatedBackend(events, options.time_scale, options.sim_voltage, options.record_trace)
@@ -0,0 +1,28 @@
+#!/usr/bin/python3
+
+# Small formatting helpers shared by the players.
+
+import gi
+
+gi.require_version('Gst', '1.0')
+from gi.repository import Gst
+
+def format_ns(ns):
+    # h:mm:ss.nnnnnnnnn, or "-" for an unknown time
+    if ns == Gst.CLOCK_TIME_NONE or ns < 0:
+        return "-"
+    s, ns = divmod(ns, 1000000000)
+    m, s = divmod(s, 60)
+    h, m = divmod(m, 60)
+    return "%u:%02u:%02u.%09u" % (h, m, s, ns)
+
+def format_clock(ns):
+    # m:ss, or h:mm:ss past the hour, for status lines
+    if ns is None or ns == Gst.CLOCK_TIME_NONE or ns < 0:
+        return "-:--"
+    s = ns // 1000000000
+    m, s = divmod(s, 60)
+    h, m = divmod(m, 60)
+    if h:
+        return "%u:%02u:%02u" % (h, m, s)
+    return "%u:%02u" % (m, s)
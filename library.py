@@ -0,0 +1,302 @@
+#!/usr/bin/python3
+
+# Media library index for the players.
+#
+# Arguments can be audio files, directories or M3U playlists. Directories
+# are walked once and their tracks kept in a SQLite index, so later starts
+# cost one indexed query, and a stat per track to leave out any deleted
+# since, however big the library is; a background thread then walks them
+# again, picking up new, changed (by mtime or size) and deleted files, and
+# fills in duration, bitrate and tags from a thread pool. A directory
+# reached twice, through a symlink, is walked once. Tags come from mutagen when it is installed and from GStreamer's
+# discoverer otherwise.
+
+import sys, os, time, sqlite3, threading, traceback
+from concurrent.futures import ThreadPoolExecutor
+
+# imported by the first scan worker to read tags rather than at startup,
+# and None once it turns out not to be installed
+mutagen = False
+
+default_db = os.path.join(os.path.expanduser("~"), ".cache", "speedoplayer", "library.db")
+default_workers = 4
+
+audio_extensions = ('.mp3', '.flac', '.ogg', '.oga', '.opus', '.m4a', '.aac', '.wav', '.wma')
+playlist_extensions = ('.m3u', '.m3u8')
+
+schema = """
+create table if not exists tracks (
+    path text primary key,
+    root text,
+    mtime real,
+    size integer,
+    scanned real,
+    duration real,
+    bitrate integer,
+    title text,
+    artist text,
+    album text,
+    bpm real,
+    beat_confidence real
+);
+create index if not exists tracks_root on tracks (root, path);
+create table if not exists roots (
+    root text primary key,
+    scanned real
+);
+"""
+
+# columns added since the first version of the schema
+migrations = (
+    ('bpm', "alter table tracks add column bpm real"),
+    ('beat_confidence', "alter table tracks add column beat_confidence real"),
+)
+
+def walk(root, visited=None):
+    # yields (path, stat) for every audio file below root, depth first in
+    # name order, without building the whole tree up front; visited holds
+    # the (device, inode) of the directories walked so far
+    if visited is None:
+        visited = set()
+    try:
+        st = os.stat(root)
+        if (st.st_dev, st.st_ino) in visited:
+            return
+        visited.add((st.st_dev, st.st_ino))
+        entries = sorted(os.scandir(root), key=lambda entry: entry.name)
+    except OSError:
+        return
+    for entry in entries:
+        try:
+            if entry.is_dir():
+                yield from walk(entry.path, visited)
+            elif entry.name.lower().endswith(audio_extensions):
+                yield os.path.realpath(entry.path), entry.stat()
+        except OSError:
+            pass
+
+def read_m3u(path):
+    tracks = []
+    base = os.path.dirname(os.path.abspath(path))
+    with open(path, encoding='utf-8', errors='replace') as f:
+        for line in f:
+            line = line.strip()
+            if not line or line.startswith('#'):
+                continue
+            if line.startswith('file://'):
+                line = line[len('file://'):]
+            track = os.path.realpath(os.path.join(base, line))
+            if os.path.isfile(track):
+                tracks.append(track)
+    return tracks
+
+def first_tag(tags, *names):
+    for name in names:
+        value = tags.get(name)
+        if value:
+            return str(value[0]) if isinstance(value, list) else str(value)
+    return None
+
+def load_mutagen():
+    global mutagen
+    if mutagen is False:
+        try:
+            import mutagen as module
+        except ImportError:
+            module = None
+        mutagen = module
+    return mutagen
+
+def mutagen_metadata(path):
+    audio = load_mutagen().File(path, easy=True)
+    if audio is None:
+        return None
+    info = audio.info
+    tags = audio.tags or {}
+    return {
+        'duration': getattr(info, 'length', None),
+        'bitrate': getattr(info, 'bitrate', None),
+        'title': first_tag(tags, 'title'),
+        'artist': first_tag(tags, 'artist'),
+        'album': first_tag(tags, 'album'),
+    }
+
+discoverers = threading.local()
+
+def discoverer_metadata(path):
+    import gi
+    gi.require_version('Gst', '1.0')
+    gi.require_version('GstPbutils', '1.0')
+    from gi.repository import Gst, GstPbutils
+
+    if not Gst.is_initialized():
+        Gst.init(None)
+    # one discoverer per pool thread, they are not safe to share
+    if getattr(discoverers, 'discoverer', None) is None:
+        discoverers.discoverer = GstPbutils.Discoverer.new(10 * Gst.SECOND)
+    info = discoverers.discoverer.discover_uri(Gst.filename_to_uri(path))
+
+    metadata = {'duration': info.get_duration() / Gst.SECOND, 'bitrate': None,
+                'title': None, 'artist': None, 'album': None}
+    for stream in info.get_audio_streams():
+        metadata['bitrate'] = stream.get_bitrate() or None
+    tags = info.get_tags()
+    if tags is not None:
+        for key, tag in (('title', Gst.TAG_TITLE), ('artist', Gst.TAG_ARTIST), ('album', Gst.TAG_ALBUM)):
+            ok, value = tags.get_string(tag)
+            if ok:
+                metadata[key] = value
+    return metadata
+
+def read_metadata(path):
+    try:
+        if load_mutagen() is not None:
+            metadata = mutagen_metadata(path)
+            if metadata is not None:
+                return metadata
+        return discoverer_metadata(path)
+    except Exception:
+        sys.stderr.write("library: could not read %s\n" % path)
+        return None
+
+class Library(object):
+
+    def __init__(self, path=default_db, workers=default_workers):
+        self.path = path
+        self.workers = workers
+        self.roots = []
+        self.loose = []
+        self.scanner = None
+
+        if os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        self.db = self.connect()
+        self.db.executescript(schema)
+        columns = [row['name'] for row in self.db.execute("pragma table_info(tracks)")]
+        for column, statement in migrations:
+            if column not in columns:
+                self.db.execute(statement)
+        self.db.commit()
+
+    def connect(self):
+        # one connection per thread
+        db = sqlite3.connect(self.path, timeout=30)
+        db.row_factory = sqlite3.Row
+        db.execute("pragma journal_mode=wal")
+        return db
+
+    def playlist(self, args):
+        tracks = []
+        for arg in args:
+            if os.path.isdir(arg):
+                root = os.path.realpath(arg)
+                self.roots.append(root)
+                known = self.db.execute("select scanned from roots where root = ?", (root,)).fetchone()
+                if known is None:
+                    # never seen: walk it now, metadata can follow later
+                    self.update_root(self.db, root)
+                rows = self.db.execute("select path from tracks where root = ? order by path", (root,))
+                tracks.extend(row['path'] for row in rows if os.path.exists(row['path']))
+            elif arg.lower().endswith(playlist_extensions) and os.path.isfile(arg):
+                entries = read_m3u(arg)
+                self.loose.extend(entries)
+                tracks.extend(entries)
+            elif os.path.isfile(arg):
+                track = os.path.realpath(arg)
+                self.loose.append(track)
+                tracks.append(track)
+        return tracks
+
+    def track(self, path, db=None):
+        db = db or self.db
+        row = db.execute("select * from tracks where path = ?", (path,)).fetchone()
+        return dict(row) if row is not None else None
+
+    def tempos(self, db=None):
+        # path -> (bpm, confidence) for every analysed track
+        db = db or self.db
+        rows = db.execute("select path, bpm, beat_confidence from tracks where bpm is not null")
+        return dict((row['path'], (row['bpm'], row['beat_confidence'])) for row in rows)
+
+    def update_root(self, db, root):
+        # bring the index in line with the directory: returns the paths
+        # that are new or have changed since the last walk
+        known = {}
+        for row in db.execute("select path, mtime, size from tracks where root = ?", (root,)):
+            known[row['path']] = (row['mtime'], row['size'])
+        changed = []
+        for path, st in walk(root):
+            if known.pop(path, None) != (st.st_mtime, st.st_size):
+                db.execute("insert or replace into tracks (path, root, mtime, size) values (?, ?, ?, ?)",
+                           (path, root, st.st_mtime, st.st_size))
+                changed.append(path)
+        db.executemany("delete from tracks where path = ?", [(path,) for path in known])
+        db.execute("insert or replace into roots (root, scanned) values (?, ?)", (root, time.time()))
+        db.commit()
+        return changed
+
+    def update_loose(self, db):
+        for path in self.loose:
+            try:
+                st = os.stat(path)
+            except OSError:
+                continue
+            row = db.execute("select mtime, size from tracks where path = ?", (path,)).fetchone()
+            if row is None:
+                db.execute("insert into tracks (path, mtime, size) values (?, ?, ?)",
+                           (path, st.st_mtime, st.st_size))
+            elif (row['mtime'], row['size']) != (st.st_mtime, st.st_size):
+                # keep the root, a playlist entry can live in an indexed
+                # directory too
+                db.execute("update tracks set mtime = ?, size = ?, scanned = null, bpm = null, beat_confidence = null"
+                           " where path = ?", (st.st_mtime, st.st_size, path))
+        db.commit()
+
+    def rescan(self):
+        self.scanner = threading.Thread(target=self.run, name="library-scan", daemon=True)
+        self.scanner.start()
+
+    def run(self):
+        try:
+            db = self.connect()
+            for root in self.roots:
+                self.update_root(db, root)
+            self.update_loose(db)
+            self.scan_metadata(db)
+            db.close()
+        except Exception:
+            traceback.print_exc(file=sys.stderr)
+
+    def unscanned(self, db):
+        paths = []
+        for root in set(self.roots):
+            rows = db.execute("select path from tracks where root = ? and scanned is null", (root,))
+            paths.extend(row['path'] for row in rows)
+        for path in self.loose:
+            row = db.execute("select scanned from tracks where path = ?", (path,)).fetchone()
+            if row is not None and row['scanned'] is None and path not in paths:
+                paths.append(path)
+        return paths
+
+    def scan_metadata(self, db):
+        paths = self.unscanned(db)
+        if not paths:
+            return
+        with ThreadPoolExecutor(max_workers=self.workers) as pool:
+            for count, (path, metadata) in enumerate(zip(paths, pool.map(read_metadata, paths))):
+                metadata = metadata or {}
+                db.execute("update tracks set scanned = ?, duration = ?, bitrate = ?, title = ?, artist = ?, album = ?"
+                           " where path = ?",
+                           (time.time(), metadata.get('duration'), metadata.get('bitrate'), metadata.get('title'),
+                            metadata.get('artist'), metadata.get('album'), path))
+                if count % 100 == 99:
+                    db.commit()
+        db.commit()
+
+def add_arguments(parser):
+    parser.add_argument('--library-db', default=default_db, help="SQLite media library index")
+    parser.add_argument('--scan-workers', type=int, default=default_workers,
+                        help="threads reading track metadata in the background")
+
+def from_options(options):
+    return Library(options.library_db, options.scan_workers)
@@ -0,0 +1,219 @@
+#!/usr/bin/python3
+
+# Counters, gauges and histograms for the GStreamer players, served in the
+# Prometheus text format over HTTP on localhost or on a Unix socket:
+#
+#   curl -s localhost:9101/metrics
+#   curl -s --unix-socket /run/speedo/metrics.sock http://bike/metrics
+#
+# Updates come from GStreamer streaming threads as well as the main loop,
+# so every metric takes the registry lock; gauges that mirror pipeline
+# state are read only when scraped. http.server is only imported when
+# there is something to serve; it is slow to import on a Pi and the
+# players start without it.
+
+import os, time, threading
+
+duration_buckets = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+class Counter(object):
+
+    kind = 'counter'
+
+    def __init__(self, lock, name, help):
+        self.lock = lock
+        self.name = name
+        self.help = help
+        self.value = 0
+
+    def inc(self, amount=1):
+        with self.lock:
+            self.value += amount
+
+    def samples(self):
+        return [(self.name, self.value)]
+
+class Gauge(object):
+
+    kind = 'gauge'
+
+    def __init__(self, lock, name, help, function=None, kind=None):
+        self.lock = lock
+        self.name = name
+        self.help = help
+        self.function = function
+        self.value = 0
+        if kind is not None:
+            self.kind = kind
+
+    def set(self, value):
+        with self.lock:
+            self.value = value
+
+    def samples(self):
+        if self.function is not None:
+            try:
+                return [(self.name, self.function())]
+            except Exception:
+                return []
+        return [(self.name, self.value)]
+
+class Histogram(object):
+
+    kind = 'histogram'
+
+    def __init__(self, lock, name, help, buckets=duration_buckets):
+        self.lock = lock
+        self.name = name
+        self.help = help
+        self.buckets = buckets
+        self.counts = [0] * len(buckets)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value):
+        with self.lock:
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    self.counts[i] += 1
+            self.count += 1
+            self.sum += value
+
+    def samples(self):
+        samples = []
+        for bound, count in zip(self.buckets, self.counts):
+            samples.append(('%s_bucket{le="%g"}' % (self.name, bound), count))
+        samples.append(('%s_bucket{le="+Inf"}' % self.name, self.count))
+        samples.append((self.name + '_sum', self.sum))
+        samples.append((self.name + '_count', self.count))
+        return samples
+
+class Registry(object):
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.metrics = []
+
+    def add(self, metric):
+        self.metrics.append(metric)
+        return metric
+
+    def counter(self, name, help):
+        return self.add(Counter(self.lock, name, help))
+
+    def gauge(self, name, help, function=None, kind=None):
+        return self.add(Gauge(self.lock, name, help, function, kind))
+
+    def histogram(self, name, help, buckets=duration_buckets):
+        return self.add(Histogram(self.lock, name, help, buckets))
+
+    def render(self):
+        lines = []
+        for metric in self.metrics:
+            # a histogram's buckets, sum and count all from one moment
+            with self.lock:
+                samples = metric.samples()
+            lines.append("# HELP %s %s" % (metric.name, metric.help))
+            lines.append("# TYPE %s %s" % (metric.name, metric.kind))
+            for name, value in samples:
+                lines.append("%s %s" % (name, repr(float(value))))
+        return "\n".join(lines) + "\n"
+
+class PipelineMetrics(object):
+
+    def __init__(self, app):
+        self.registry = Registry()
+        r = self.registry
+
+        self.underruns = r.counter('speedo_queue_underruns_total', "Times the queue ahead of the rate engine ran dry")
+        self.underrun_seconds = r.histogram('speedo_queue_underrun_seconds', "How long the queue stayed dry")
+        self.overruns = r.counter('speedo_queue_overruns_total', "Times the queue ahead of the rate engine filled up")
+        self.bus_errors = r.counter('speedo_bus_errors_total', "ERROR messages on the pipeline bus")
+        self.bus_warnings = r.counter('speedo_bus_warnings_total', "WARNING messages on the pipeline bus")
+        self.switches = r.counter('speedo_track_switches_total', "Track switches, skips and natural track ends")
+        self.switch_seconds = r.histogram('speedo_track_switch_seconds', "Time from switch request to the new track's first buffer")
+        self.recoveries = r.counter('speedo_pipeline_recoveries_total', "Times the pipeline was rebuilt after an error")
+        self.recovery_seconds = r.histogram('speedo_recovery_seconds', "Time from rebuilding the pipeline to audio at the sink")
+
+        r.gauge('speedo_queue_level_seconds', "Audio currently held in the queue",
+                lambda: app.queue.get_property('current-level-time') / 1e9)
+        r.gauge('speedo_playback_rate', "Rate the engine is currently playing at", lambda: app.engine.rate)
+        if hasattr(app, 'rpm'):
+            r.gauge('speedo_rpm', "Current wheel RPM estimate", lambda: app.rpm)
+        if getattr(app, 'buffering', None) is not None:
+            r.gauge('speedo_buffer_level', "Rung of the adaptive buffering ladder in use",
+                    lambda: app.buffering.level)
+        r.gauge('speedo_track_position_seconds', "Position in the current track",
+                lambda: app.position.position() / 1e9)
+        r.gauge('speedo_track_index', "Playlist position of the current track", lambda: app.playnumber)
+        r.gauge('process_cpu_seconds_total', "CPU time used by the player process", time.process_time, 'counter')
+        r.gauge('speedo_load1', "One minute load average", lambda: os.getloadavg()[0])
+
+        self.underrun_started = None
+
+    def underrun(self):
+        self.underruns.inc()
+        self.underrun_started = time.monotonic()
+
+    def running(self):
+        started = self.underrun_started
+        if started is not None:
+            self.underrun_started = None
+            self.underrun_seconds.observe(time.monotonic() - started)
+
+    def switched(self, latency):
+        self.switches.inc()
+        self.switch_seconds.observe(latency / 1000.0)
+
+def server_classes():
+    import socketserver
+    from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+    class MetricsHandler(BaseHTTPRequestHandler):
+
+        registry = None
+
+        def do_GET(self):
+            if self.path.split('?')[0] not in ('/', '/metrics'):
+                self.send_error(404)
+                return
+            body = self.registry.render().encode()
+            self.send_response(200)
+            self.send_header("Content-Type", "text/plain; version=0.0.4")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            pass
+
+    class UnixHTTPServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+
+        daemon_threads = True
+
+        def get_request(self):
+            # http.server expects a (host, port) client address
+            request, _ = super(UnixHTTPServer, self).get_request()
+            return request, ("local", 0)
+
+    return MetricsHandler, ThreadingHTTPServer, UnixHTTPServer
+
+def serve(registry, port=None, socket_path=None):
+    servers = []
+    if port is None and socket_path is None:
+        return servers
+    MetricsHandler, ThreadingHTTPServer, UnixHTTPServer = server_classes()
+    handler = type('Handler', (MetricsHandler,), {'registry': registry})
+    if port is not None:
+        servers.append(ThreadingHTTPServer(("127.0.0.1", port), handler))
+    if socket_path is not None:
+        if os.path.exists(socket_path):
+            os.unlink(socket_path)
+        servers.append(UnixHTTPServer(socket_path, handler))
+    for server in servers:
+        threading.Thread(target=server.serve_forever, name="metrics", daemon=True).start()
+    return servers
+
+def add_arguments(parser):
+    parser.add_argument('--metrics-port', type=int, help="serve Prometheus metrics on this localhost port")
+    parser.add_argument('--metrics-socket', help="serve Prometheus metrics on this Unix socket")
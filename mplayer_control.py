@@ -0,0 +1,136 @@
+#!/usr/bin/python3
+
+# Command channel between the mplayer players and mplayer.core.Player.
+#
+# Every property read on Player is a slave-protocol round trip, and a
+# slow mplayer stalls whoever asked. Here nothing waits on mplayer:
+# commands are queued and written from a worker thread, and speed changes
+# are coalesced, so only the latest value is sent, and only once it has
+# moved by more than the dead-band. Pause and track state come from
+# mplayer's own output instead of being queried:
+#
+#   Playing <file>.   a track has started, and playback is not paused
+#   ID_PAUSED         playback has paused
+#   EOF code: 1       a track played to its end
+#
+# mplayer does not announce unpausing, so a pause command sent while
+# paused is taken to resume.
+
+import sys, threading, traceback
+
+# -quiet drops the status line, -identify and cplayer=6 add the ID_PAUSED
+# and EOF lines on top of the -msglevel global=4 that Player passes
+player_args = ('-quiet', '-identify', '-msglevel', 'cplayer=6')
+
+default_deadband = 0.01
+load_timeout = 10.0
+
+class MplayerControl(object):
+
+    def __init__(self, player, deadband=default_deadband):
+        self.player = player
+        self.deadband = deadband
+
+        self.lock = threading.Lock()
+        self.wakeup = threading.Condition(self.lock)
+        self.commands = []
+        self.pending_speed = None
+        self.sent_speed = None
+        self.closing = False
+
+        # state as last reported by mplayer
+        self.playlist = []
+        self.filename = None
+        self.index = None
+        self.paused = None
+        self.started = threading.Event()
+        self.finished = threading.Event()
+
+        player.stdout.connect(self.on_output)
+        self.worker = threading.Thread(target=self.run, name="mplayer-control", daemon=True)
+        self.worker.start()
+
+    def send(self, name, *args):
+        with self.lock:
+            self.commands.append((name, args))
+            self.wakeup.notify()
+
+    def set_speed(self, speed, force=False):
+        with self.lock:
+            if not force and self.sent_speed is not None and abs(speed - self.sent_speed) < self.deadband:
+                self.pending_speed = None
+                return
+            self.pending_speed = speed
+            self.wakeup.notify()
+
+    def loadfile(self, path, append=0):
+        with self.lock:
+            if append:
+                self.playlist.append(path)
+            else:
+                self.playlist = [path]
+        self.finished.clear()
+        self.send('loadfile', path, append)
+
+    def pause(self):
+        self.paused = not self.paused if self.paused is not None else None
+        self.send('pause')
+
+    def pt_step(self, step):
+        self.send('pt_step', step)
+
+    def stop(self):
+        self.send('stop')
+
+    def close(self):
+        # send whatever is queued, then stop the worker
+        with self.lock:
+            self.closing = True
+            self.wakeup.notify()
+        self.worker.join(1.0)
+
+    def quit(self):
+        self.close()
+        self.player.quit()
+
+    def wait_started(self, timeout=load_timeout):
+        return self.started.wait(timeout)
+
+    def run(self):
+        while True:
+            with self.lock:
+                while not self.commands and self.pending_speed is None and not self.closing:
+                    self.wakeup.wait()
+                commands, self.commands = self.commands, []
+                speed, self.pending_speed = self.pending_speed, None
+                if speed is not None:
+                    self.sent_speed = speed
+                closing = self.closing
+            try:
+                for name, args in commands:
+                    getattr(self.player, name)(*args)
+                if speed is not None:
+                    self.player.speed = speed
+            except Exception:
+                traceback.print_exc(file=sys.stderr)
+            if closing:
+                return
+
+    def on_output(self, line):
+        # called on mplayer.py's stdout reader thread
+        if line.startswith('Playing ') and line.endswith('.'):
+            self.filename = line[len('Playing '):-1]
+            with self.lock:
+                if self.filename in self.playlist:
+                    self.index = self.playlist.index(self.filename)
+            self.paused = False
+            self.started.set()
+        elif line.startswith('ID_PAUSED'):
+            self.paused = True
+        elif line.startswith('EOF code: 1'):
+            if self.index is not None and self.index + 1 >= len(self.playlist):
+                self.finished.set()
+
+def add_arguments(parser):
+    parser.add_argument('--speed-deadband', type=float, default=default_deadband,
+                        help="smallest speed change worth sending to mplayer")
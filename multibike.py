@@ -0,0 +1,405 @@
+#!/usr/bin/python3
+
+# Several bikes from one process: each bike's hall sensor drives its own
+# rate engine and ALSA device.
+#
+# Bikes are put in groups. A group has one pipeline and one playlist; its
+# tracks are decoded once, by a single TrackSwitcher, and split with a tee
+# into a queue, rate engine and sink per bike:
+#
+#   branches ! input-selector ! tee ! queue ! engine ! alsasink   (bike 1)
+#                                   ! queue ! engine ! alsasink   (bike 2)
+#
+# The queues hold --group-buffer seconds, which is how far apart the bikes
+# of a group can drift. By default one that pulls further ahead than that
+# waits for the others, and so its queue runs dry. With --group-drift skip
+# the bike playing fastest keeps a blocking queue, which paces the decode,
+# and the others' queues drop their oldest audio when full, so a rider who
+# falls behind skips ahead instead of holding up the group. A bike on its
+# own is never leaky. A skip on any bike of a group skips the whole group.
+# A bike that should play on its own goes in a group of one.
+#
+# Each bike's queue thread, which runs its rate engine, is pinned to a core
+# round-robin over the cores we may use, leaving the first to the main loop
+# and GPIO callbacks, unless the config says which. The decoding and
+# resampling then run in parallel, but the rate engines' Python probes all
+# still take the GIL, so bikes do not scale quite with cores.
+#
+# The config is JSON:
+#
+#   {
+#     "groups": {"class": {"files": ["/srv/music/spin"]}},
+#     "bikes": [
+#       {"name": "front-left", "group": "class", "hall_pin": 17, "device": "hw:1",
+#        "play_pin": 25, "prev_pin": 23, "next_pin": 12},
+#       {"name": "front-right", "group": "class", "hall_pin": 27, "device": "hw:2", "cpu": 3},
+#       {"name": "solo", "hall_pin": 22, "device": "hw:3", "files": ["/srv/music/solo.m3u"]}
+#     ]
+#   }
+
+import sys, os, json, signal, traceback, argparse, logging
+
+import gi
+
+gi.require_version('Gst', '1.0')
+from gi.repository import GLib, Gst
+
+from rpm_estimator import PulseRing, RpmEstimator
+from track_switcher import TrackSwitcher
+import rate_engine
+import pcm_cache
+import decoders
+import adaptive_buffer
+import hardware
+import library
+import telemetry
+import speedo_player
+
+default_group_buffer = 30.0
+
+def usable_cpus():
+    cpus = sorted(os.sched_getaffinity(0))
+    # keep the first core for the main loop when there is more than one
+    return cpus[1:] or cpus
+
+class Bike(object):
+
+    def __init__(self, group, config, number, cpu, options):
+        self.group = group
+        self.backend = group.backend
+        self.name = config.get('name', "bike-%d" % number)
+        self.number = number
+        self.telemetry = group.app.telemetry
+        self.hall_pin = config['hall_pin']
+        self.cpu = config.get('cpu', cpu)
+        self.ramp_time = options.ramp_time
+
+        self.rpm = 0.00
+        self.multiplier = 0.00
+        self.pulses = PulseRing()
+        self.estimator = RpmEstimator(self.pulses, speedo_player.rpm_method, speedo_player.stall_timeout,
+                                      **speedo_player.rpm_options)
+        self.speed_update_pending = False
+        self.decay_source = None
+
+        self.playing = False
+        self.underruns = 0
+        # times its queue was full when the tee pushed
+        self.overruns = 0
+        self.audio = 0
+
+        self.bin = Gst.Bin.new(self.name)
+        self.queue = Gst.ElementFactory.make("queue", None)
+        self.queue.set_property('max-size-buffers', 0)
+        self.queue.set_property('max-size-bytes', 0)
+        self.queue.set_property('max-size-time', int(options.group_buffer * Gst.SECOND))
+        # set by the group, see Group.pace
+        self.leaky = False
+        self.queue.connect('underrun', self.on_underrun)
+        self.queue.connect('overrun', self.on_overrun)
+        self.queue.connect('running', self.on_running)
+        self.engine = rate_engine.make_engine(config.get('engine', options.engine),
+                                              config.get('quality', options.quality))
+        self.sink = Gst.ElementFactory.make(config.get('sink', options.sink), None)
+        if 'device' in config:
+            self.sink.set_property('device', config['device'])
+        if self.sink.get_factory().get_name() == 'fakesink':
+            self.sink.set_property('sync', True)
+        # the queue is the group's drift allowance, so only the sink adapts
+        self.buffering = adaptive_buffer.from_options(options, self.sink, name=self.name)
+
+        for element in (self.queue, self.engine.element, self.sink):
+            self.bin.add(element)
+        self.queue.link(self.engine.element)
+        self.engine.element.link(self.sink)
+        self.bin.add_pad(Gst.GhostPad.new("sink", self.queue.get_static_pad("sink")))
+
+        srcpad = self.queue.get_static_pad("src")
+        srcpad.add_probe(Gst.PadProbeType.BUFFER, self.on_first_buffer)
+        srcpad.add_probe(Gst.PadProbeType.BUFFER, self.on_buffer)
+
+    def on_first_buffer(self, pad, info):
+        # runs on the queue's streaming thread, which is also the one
+        # driving the rate engine
+        self.playing = True
+        if self.cpu is not None:
+            try:
+                os.sched_setaffinity(0, [self.cpu])
+            except OSError as e:
+                sys.stderr.write("%s: could not pin to cpu %s: %s\n" % (self.name, self.cpu, e))
+        return Gst.PadProbeReturn.REMOVE
+
+    def on_buffer(self, pad, info):
+        buf = info.get_buffer()
+        if buf.duration != Gst.CLOCK_TIME_NONE:
+            self.audio += buf.duration
+        return Gst.PadProbeReturn.OK
+
+    def on_underrun(self, element):
+        # the queue is empty before the first buffer too; only count the
+        # ones that interrupt playback
+        logging.debug('%s: on_underrun', self.name)
+        if self.playing:
+            self.underruns += 1
+            self.telemetry.record(telemetry.UNDERRUN, bike=self.number)
+            if self.buffering is not None:
+                self.buffering.underrun()
+
+    def on_running(self, element):
+        if self.playing:
+            self.telemetry.record(telemetry.RUNNING, bike=self.number)
+
+    def on_overrun(self, element):
+        # the bike is a whole group buffer behind the fastest of its group
+        if self.playing:
+            self.overruns += 1
+            self.telemetry.record(telemetry.OVERRUN, bike=self.number)
+
+    def get_pulse(self, number):
+        stamp = self.backend.clock()
+        self.pulses.push(stamp)
+        self.telemetry.record(telemetry.PULSE, bike=self.number, stamp=stamp)
+        if not self.speed_update_pending:
+            self.speed_update_pending = True
+            GLib.idle_add(self.update_speed, priority=GLib.PRIORITY_HIGH)
+
+    def update_speed(self):
+        self.speed_update_pending = False
+        try:
+            now = self.backend.clock()
+            self.rpm = self.estimator.rpm(now)
+            self.multiplier = self.rpm/1000
+            self.engine.ramp_to(self.multiplier + 0.25, self.ramp_time)
+            self.group.pace()
+            self.telemetry.record(telemetry.RATE, self.rpm, self.engine.rate, self.group.playnumber,
+                                  self.number, stamp=now)
+
+            if self.decay_source is not None:
+                GLib.source_remove(self.decay_source)
+                self.decay_source = None
+            delay = self.estimator.decay_delay(self.rpm, now)
+            if delay is not None:
+                delay = delay / self.backend.time_scale
+                self.decay_source = GLib.timeout_add(max(int(delay*1000), speedo_player.decay_interval),
+                                                     self.decay_tick)
+        except:
+            print('Exception in user code:')
+            print('-'*60)
+            traceback.print_exc(file=sys.stdout)
+            print('-'*60)
+        return GLib.SOURCE_REMOVE
+
+    def decay_tick(self):
+        self.decay_source = None
+        self.update_speed()
+        return GLib.SOURCE_REMOVE
+
+class Group(object):
+
+    def __init__(self, name, files, app, options):
+        self.name = name
+        self.files = files
+        self.app = app
+        self.backend = app.backend
+        self.bikes = []
+        self.playlist = []
+        self.playnumber = 0
+        self.drift = options.group_drift
+
+        self.pipeline = Gst.Pipeline.new(name)
+        self.pipeline.set_auto_flush_bus(True)
+        self.switcher = TrackSwitcher(self.pipeline, self.track_changed, app.cache, options.predecode)
+        self.tee = Gst.ElementFactory.make("tee", None)
+        self.pipeline.add(self.tee)
+        self.switcher.link(self.tee)
+
+        self.bus = self.pipeline.get_bus()
+        self.bus.add_signal_watch()
+        self.bus.connect("message", self.bus_call)
+
+    def add_bike(self, bike):
+        self.bikes.append(bike)
+        self.pipeline.add(bike.bin)
+        self.tee.link(bike.bin)
+        self.switcher.follow(bike.engine.element)
+
+    def bus_call(self, bus, message):
+        t = message.type
+        if t == Gst.MessageType.EOS:
+            sys.stdout.write("%s: End-of-stream\n" % self.name)
+            self.app.group_finished(self)
+        elif t == Gst.MessageType.ERROR:
+            err, debug = message.parse_error()
+            sys.stderr.write("%s: Error: %s: %s\n" % (self.name, err, debug))
+            if not self.switcher.standby_error(message.src):
+                self.app.group_finished(self)
+        return True
+
+    def start(self):
+        self.playlist = self.app.library.playlist(self.files)
+        self.switcher.start(self.playlist, self.playnumber)
+        for bike in self.bikes:
+            bike.engine.set_rate(bike.multiplier + 0.25)
+        self.pace()
+        self.pipeline.set_state(Gst.State.PLAYING)
+
+    def pace(self):
+        # with --group-drift skip, the fastest bike's queue blocks the tee
+        # and so sets how fast the group decodes; the rest may drop audio
+        if self.drift != 'skip' or len(self.bikes) < 2:
+            return
+        leader = max(self.bikes, key=lambda bike: bike.engine.rate)
+        for bike in self.bikes:
+            leaky = bike is not leader
+            if leaky != bike.leaky:
+                bike.leaky = leaky
+                Gst.util_set_object_arg(bike.queue, 'leaky', 'downstream' if leaky else 'no')
+
+    def stop(self):
+        self.pipeline.set_state(Gst.State.NULL)
+
+    def playpause(self, number):
+        if self.pipeline.get_state(0)[1] == Gst.State.PAUSED:
+            self.pipeline.set_state(Gst.State.PLAYING)
+        else:
+            self.pipeline.set_state(Gst.State.PAUSED)
+        print("%s: play / pause music playback" % self.name)
+
+    def skipnext(self, number):
+        if not self.switcher.skip():
+            print("%s: no next track" % self.name)
+
+    def skipprev(self, number):
+        if not self.switcher.previous():
+            print("%s: no prev track" % self.name)
+
+    def track_changed(self, index):
+        self.playnumber = index
+        for bike in self.bikes:
+            self.app.telemetry.record(telemetry.TRACK, track=index, bike=bike.number)
+            if bike.buffering is not None:
+                bike.buffering.track_changed()
+        print("%s: %s" % (self.name, self.playlist[self.playnumber]))
+
+class MultiBike(object):
+
+    def __init__(self, loop, config, options, backend):
+        self.loop = loop
+        self.backend = backend
+        # rank the cheapest decoders first, here and in the cache's children
+        decoders.from_options(options)
+        self.library = library.from_options(options)
+        self.telemetry = telemetry.from_options(options, backend.clock)
+        self.cache = None
+        if options.cache_dir is not None:
+            self.cache = pcm_cache.PcmCache(options.cache_dir, options.cache_budget * 1024 * 1024)
+
+        self.groups = {}
+        self.bikes = []
+        cpus = usable_cpus()
+        group_config = config.get('groups', {})
+        for number, bike_config in enumerate(config['bikes']):
+            name = bike_config.get('group')
+            if name is None:
+                name = "group-%s" % bike_config.get('name', number)
+                files = bike_config['files']
+            else:
+                files = group_config[name]['files']
+            if name not in self.groups:
+                self.groups[name] = Group(name, files, self, options)
+            group = self.groups[name]
+            bike = Bike(group, bike_config, number, cpus[number % len(cpus)], options)
+            group.add_bike(bike)
+            self.bikes.append(bike)
+
+            backend.add_edge_callback(bike.hall_pin, bike.get_pulse, backend.pulse_bouncetime)
+            for pin, action in (('play_pin', group.playpause), ('prev_pin', group.skipprev),
+                                ('next_pin', group.skipnext)):
+                if pin in bike_config:
+                    backend.add_edge_callback(bike_config[pin],
+                                              lambda number, action=action: GLib.idle_add(action, number), 500)
+        self.running = set(self.groups)
+
+    def start(self):
+        for group in self.groups.values():
+            group.start()
+        self.library.rescan()
+        self.telemetry.start()
+        self.loop.run()
+        self.telemetry.stop()
+        for group in self.groups.values():
+            group.stop()
+
+    def group_finished(self, group):
+        group.stop()
+        self.running.discard(group.name)
+        if not self.running:
+            self.loop.quit()
+
+    def quit(self):
+        sys.stderr.write("cleanup called\n")
+        for group in self.groups.values():
+            group.stop()
+        self.loop.quit()
+        return GLib.SOURCE_REMOVE
+
+    def signal_handler(self, signalNumber, frame=None):
+        print('received:', signalNumber)
+        return self.quit()
+
+def load_config(path):
+    with open(path) as f:
+        return json.load(f)
+
+def parse_args(args):
+    parser = argparse.ArgumentParser(prog=args[0], description="drive several bikes from one process")
+    parser.add_argument('config', help="JSON bike and group configuration")
+    parser.add_argument('--engine', choices=sorted(rate_engine.engines), default=speedo_player.engine_name,
+                        help="playback rate engine, unless a bike sets its own")
+    parser.add_argument('--quality', default=speedo_player.engine_quality,
+                        help="scaletempo preset (low, medium, high) or stride,overlap,search")
+    parser.add_argument('--ramp-time', type=float, default=speedo_player.ramp_time,
+                        help="seconds over which rate changes are ramped, 0 to jump")
+    parser.add_argument('--sink', default='alsasink', help="audio sink element, unless a bike sets its own")
+    parser.add_argument('--group-buffer', type=float, default=default_group_buffer,
+                        help="seconds of decoded audio each bike may be ahead of the rest of its group")
+    parser.add_argument('--group-drift', choices=['wait', 'skip'], default='wait',
+                        help="the group waits for a bike further behind than --group-buffer, or it skips ahead")
+    parser.add_argument('--cache-dir', help="decode tracks once to PCM here and play them from the cache")
+    parser.add_argument('--cache-budget', type=int, default=pcm_cache.default_budget // (1024 * 1024),
+                        help="PCM cache size limit in MiB")
+    parser.add_argument('--predecode', type=int, default=pcm_cache.default_predecode,
+                        help="number of upcoming tracks to decode into the cache in the background")
+    hardware.add_arguments(parser)
+    library.add_arguments(parser)
+    telemetry.add_arguments(parser)
+    decoders.add_arguments(parser)
+    adaptive_buffer.add_arguments(parser)
+    return parser.parse_args(args[1:])
+
+if __name__ == '__main__':
+
+    options = parse_args(sys.argv)
+    config = load_config(options.config)
+
+    Gst.init(None)
+    loop = GLib.MainLoop()
+
+    backend = hardware.from_options(options, [bike['hall_pin'] for bike in config['bikes']])
+    app = MultiBike(loop, config, options, backend)
+
+    GLib.unix_signal_add(GLib.PRIORITY_HIGH, signal.SIGINT, app.signal_handler, signal.SIGINT)
+    GLib.unix_signal_add(GLib.PRIORITY_HIGH, signal.SIGTERM, app.signal_handler, signal.SIGTERM)
+    if options.exit_after_trace:
+        backend.on_finished = lambda: GLib.idle_add(app.quit)
+    backend.start()
+
+    try:
+        app.start()
+    except:
+        print('Exception in user code:')
+        print('-'*60)
+        traceback.print_exc(file=sys.stdout)
+        print('-'*60)
+
+    backend.cleanup()
@@ -0,0 +1,241 @@
+#!/usr/bin/python3
+
+# Decoded-PCM cache for the GStreamer players.
+#
+# Each playlist entry is decoded once to raw 16-bit stereo PCM under the
+# cache directory and afterwards read straight from the file, so
+# skips and replays cost no decoder time. Entries are keyed by the real
+# path of the source and are thrown away when its mtime or size changes;
+# the least recently used ones are evicted to stay under the byte budget.
+#
+# Decoding happens in a niced gst-launch-1.0 child so it never competes
+# with the player's own threads for the GIL, and can use another core.
+# The index is only written by the background thread, and only when it has
+# changed, so a lookup from the main loop never touches the disk beyond a
+# stat.
+#
+# PyGObject copies the data of every buffer it wraps, so a memory map
+# would save nothing over a plain read; PcmSource reads each chunk with
+# pread into the bytes that are then wrapped.
+
+import sys, os, json, hashlib, threading, time, traceback
+
+import gi
+
+gi.require_version('Gst', '1.0')
+from gi.repository import Gst
+
+import profiler
+
+pcm_caps = "audio/x-raw,format=S16LE,layout=interleaved,rate=44100,channels=2"
+pcm_rate = 44100
+pcm_frame = 4
+
+default_budget = 2 * 1024 * 1024 * 1024
+default_predecode = 2
+decode_niceness = 10
+# how stale an entry's last use may get before a lookup records it again
+used_resolution = 60.0
+
+class PcmCache(object):
+
+    def __init__(self, directory, budget=default_budget):
+        self.directory = directory
+        self.budget = budget
+        self.lock = threading.Lock()
+        self.index_path = os.path.join(directory, "index.json")
+
+        os.makedirs(directory, exist_ok=True)
+        try:
+            with open(self.index_path) as f:
+                self.index = json.load(f)
+        except (OSError, ValueError):
+            self.index = {}
+
+        self.pending = []
+        # the index has changes that are not on disk yet
+        self.dirty = False
+        self.wakeup = threading.Condition(self.lock)
+        self.worker = None
+
+    def key(self, path):
+        return hashlib.sha1(os.path.realpath(path).encode()).hexdigest()
+
+    def pcm_path(self, key):
+        return os.path.join(self.directory, key + ".pcm")
+
+    def changed(self):
+        # called with the lock held; the worker writes the index out
+        self.dirty = True
+        self.start_worker()
+        self.wakeup.notify()
+
+    def save(self):
+        # on the worker thread, without the lock held
+        with self.lock:
+            if not self.dirty:
+                return
+            data = json.dumps(self.index)
+            self.dirty = False
+        tmp = self.index_path + ".tmp"
+        with open(tmp, "w") as f:
+            f.write(data)
+        os.replace(tmp, self.index_path)
+
+    def lookup(self, path):
+        key = self.key(path)
+        try:
+            st = os.stat(path)
+        except OSError:
+            return None
+        with self.lock:
+            entry = self.index.get(key)
+            if entry is None:
+                return None
+            if entry['mtime'] != st.st_mtime or entry['size'] != st.st_size \
+                    or not os.path.exists(self.pcm_path(key)):
+                self.remove(key)
+                self.changed()
+                return None
+            now = time.time()
+            if now - entry['used'] >= used_resolution:
+                entry['used'] = now
+                self.changed()
+            return self.pcm_path(key)
+
+    def remove(self, key):
+        # called with the lock held
+        self.index.pop(key, None)
+        try:
+            os.unlink(self.pcm_path(key))
+        except OSError:
+            pass
+
+    def evict(self):
+        # called with the lock held; unlinking a file that is still being
+        # played is fine, it lives on until the branch closes it
+        total = sum(entry['bytes'] for entry in self.index.values())
+        for key, entry in sorted(self.index.items(), key=lambda item: item[1]['used']):
+            if total <= self.budget:
+                break
+            total -= entry['bytes']
+            self.remove(key)
+
+    def decode(self, path):
+        import subprocess
+
+        key = self.key(path)
+        st = os.stat(path)
+        target = self.pcm_path(key)
+        tmp = target + ".tmp"
+
+        command = ["nice", "-n", str(decode_niceness), "gst-launch-1.0", "-q",
+                   "filesrc", launch_location(path), "!", "decodebin", "!",
+                   "audioconvert", "!", "audioresample", "!", pcm_caps, "!",
+                   "filesink", launch_location(tmp)]
+        started = time.monotonic()
+        if subprocess.call(command, stdout=subprocess.DEVNULL, env=profiler.child_environment()) != 0:
+            sys.stderr.write("pcm cache: could not decode %s\n" % path)
+            try:
+                os.unlink(tmp)
+            except OSError:
+                pass
+            return None
+        os.replace(tmp, target)
+
+        with self.lock:
+            self.index[key] = {
+                'path': os.path.realpath(path),
+                'mtime': st.st_mtime,
+                'size': st.st_size,
+                'bytes': os.path.getsize(target),
+                'used': time.time(),
+            }
+            self.evict()
+            self.dirty = True
+        self.save()
+        sys.stderr.write("pcm cache: decoded %s in %.1f s\n" % (path, time.monotonic() - started))
+        return target
+
+    def predecode(self, paths):
+        # queue up paths for the background decoder, nearest first
+        with self.lock:
+            self.pending = [path for path in paths if self.key(path) not in self.index]
+            self.start_worker()
+            self.wakeup.notify()
+
+    def start_worker(self):
+        # called with the lock held
+        if self.worker is None:
+            self.worker = threading.Thread(target=self.run, name="pcm-predecode", daemon=True)
+            self.worker.start()
+
+    def run(self):
+        while True:
+            with self.lock:
+                while not self.pending and not self.dirty:
+                    self.wakeup.wait()
+                path = self.pending.pop(0) if self.pending else None
+                if path is not None and self.key(path) in self.index:
+                    path = None
+            # one bad file or a full disk costs that track its cache entry,
+            # not the cache
+            try:
+                if path is not None:
+                    self.decode(path)
+                self.save()
+            except Exception:
+                traceback.print_exc(file=sys.stderr)
+
+def launch_location(path):
+    # location= for a gst-launch-1.0 argv, quoted so that a ! or = in the
+    # path is not taken for pipeline syntax
+    return 'location="%s"' % path.replace('\\', '\\\\').replace('"', '\\"')
+
+def byte_offset(position):
+    # whole frames of pcm_caps audio in position ns
+    return int(position * pcm_rate // Gst.SECOND) * pcm_frame
+
+class PcmSource(object):
+
+    chunk = 64 * 1024
+
+    def __init__(self, path, start=0):
+        # start ns into the file, which then plays as if it began there
+        self.file = open(path, "rb")
+        self.size = os.fstat(self.file.fileno()).st_size
+        self.base = min(byte_offset(start), self.size)
+        self.offset = 0
+        # close comes from the main loop, reads from the streaming thread
+        self.lock = threading.Lock()
+
+        self.element = Gst.ElementFactory.make("appsrc", None)
+        self.element.set_property("caps", Gst.Caps.from_string(pcm_caps))
+        self.element.set_property("format", Gst.Format.BYTES)
+        self.element.set_property("stream-type", 2)     # GST_APP_STREAM_TYPE_RANDOM_ACCESS
+        self.element.set_property("size", self.size - self.base)
+        self.element.connect("need-data", self.on_need_data)
+        self.element.connect("seek-data", self.on_seek_data)
+
+    def on_need_data(self, src, length):
+        with self.lock:
+            data = b""
+            if self.file is not None and self.base + self.offset < self.size:
+                data = os.pread(self.file.fileno(), self.chunk, self.base + self.offset)
+        if not data:
+            src.emit("end-of-stream")
+            return
+        buf = Gst.Buffer.new_wrapped(data)
+        buf.offset = self.offset
+        self.offset += len(data)
+        src.emit("push-buffer", buf)
+
+    def on_seek_data(self, src, offset):
+        self.offset = offset
+        return True
+
+    def close(self):
+        with self.lock:
+            if self.file is not None:
+                self.file.close()
+                self.file = None
@@ -0,0 +1,90 @@
+#!/usr/bin/python3
+
+# Playback position for the GStreamer players without querying the
+# pipeline on every tick.
+#
+# The position in the track is derived from the pipeline's running time
+# and the rate the engine has been playing at: every rate change closes a
+# segment of constant rate, so
+#
+#   position = segment start position + (running time - segment start) * rate
+#
+# Running time stands still while paused (see TrackSwitcher.running_time),
+# so the position does too. Durations are cached per track; a track's
+# duration is queried once, the first time it is asked for, and again only
+# after the pipeline posts DURATION_CHANGED.
+#
+# The position counts from when the switcher flips to a track, which on a
+# natural track end is up to a queue's worth of audio before it is heard.
+
+import gi
+
+gi.require_version('Gst', '1.0')
+from gi.repository import Gst
+
+class PositionTracker(object):
+
+    def __init__(self, switcher, rate=1.0):
+        self.switcher = switcher
+        self.rate = rate
+        self.durations = {}
+        self.location = None
+        self.start_running = 0
+        self.start_position = 0
+
+    def track_changed(self, position=0):
+        current = self.switcher.current
+        self.location = current.location if current is not None else None
+        self.start_running = self.switcher.running_time()
+        self.start_position = position
+
+    def set_rate(self, rate):
+        if rate == self.rate:
+            return
+        # close the segment played at the old rate
+        now = self.switcher.running_time()
+        self.start_position = self.position(now)
+        self.start_running = now
+        self.rate = rate
+
+    def position(self, running_time=None):
+        if running_time is None:
+            running_time = self.switcher.running_time()
+        elapsed = max(0, running_time - self.start_running)
+        return self.start_position + int(elapsed * self.rate)
+
+    def duration_changed(self):
+        self.durations.pop(self.location, None)
+
+    def duration(self):
+        if self.location is None:
+            return Gst.CLOCK_TIME_NONE
+        if self.location not in self.durations:
+            # asked downstream of the decoder, which answers for decodebin
+            # and rawaudioparse alike
+            current = self.switcher.current
+            ok, duration = current.conv.query_duration(Gst.Format.TIME)
+            # a pre-rendered rate, or a branch started part way in, answers
+            # for what it has to play
+            self.durations[self.location] = int(current.start + duration * current.rate) if ok else Gst.CLOCK_TIME_NONE
+        return self.durations[self.location]
+
+    def remaining(self):
+        # track time left to play
+        duration = self.duration()
+        if duration == Gst.CLOCK_TIME_NONE:
+            return Gst.CLOCK_TIME_NONE
+        return max(0, duration - self.position())
+
+    def eta(self):
+        # wall time until the end of the track at the current rate
+        remaining = self.remaining()
+        if remaining == Gst.CLOCK_TIME_NONE or self.rate <= 0:
+            return Gst.CLOCK_TIME_NONE
+        return int(remaining / self.rate)
+
+    def progress(self):
+        duration = self.duration()
+        if duration == Gst.CLOCK_TIME_NONE or duration <= 0:
+            return None
+        return min(1.0, self.position() / float(duration))
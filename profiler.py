@@ -0,0 +1,283 @@
+#!/usr/bin/python3
+
+# --profile: where the time goes on a unit that stutters.
+#
+# The players record what their control path spends its time on, as
+# Chrome trace events (chrome://tracing, or ui.perfetto.dev):
+#
+#   loop   each main loop callback or control loop tick, bus messages
+#   gpio   edge callback to the main loop handling it
+#   gst    rate changes handed to the engine
+#   i2c    trimpot ADC reads
+#
+# Events are appended to a deque and written out by a thread every
+# flush_interval, as a JSON array that is never closed, which the trace
+# viewers accept; a unit can be switched off at any point and the file
+# still loads. With the GStreamer players, the latency tracer is also
+# enabled, timing every element, the decoder, audioconvert, queue, rate
+# engine and sink, to <trace>.gst.log; --profile-tracers latency logs
+# only how long each buffer takes from source to sink, one record per
+# buffer rather than several.
+#
+# Left on in the field that grows without end, so recording stops, tracer
+# records included, once the two files pass --profile-max-mb together or
+# after --profile-seconds. The tracer settings are only for this process;
+# the gst-launch children decoding and rendering tracks are started
+# without them, so they do not write over its log.
+#
+# Run this file on a trace for a per-event summary, and to merge the
+# element timings in as a timeline of their own:
+#
+#   python3 profiler.py ride.trace --timeline ride.json
+
+import sys, os, re, json, time, argparse, threading, collections, contextlib
+
+flush_interval = 1.0
+default_tracers = "latency(flags=element)"
+default_max_mb = 64
+
+# monotonic time of Gst.init, which the tracer timestamps count from
+gst_epoch = None
+# where the tracers log to, when they are enabled
+gst_log = None
+# what prepare changed in the environment, and the values it replaced
+saved_environment = {}
+
+class Profiler(object):
+
+    def __init__(self, path, max_bytes=None, seconds=None):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.deadline = time.monotonic() + seconds if seconds else None
+        # set once a cap is reached, after which nothing more is recorded
+        self.capped = False
+        self.pid = os.getpid()
+        self.pending = collections.deque()
+        self.threads = {}
+        self.stopping = threading.Event()
+        self.thread = None
+
+    def complete(self, name, start, end, cat='loop', args=None):
+        # start and end in time.monotonic() seconds
+        if self.capped:
+            return
+        event = {'name': name, 'cat': cat, 'ph': 'X', 'ts': start * 1e6, 'dur': (end - start) * 1e6,
+                 'pid': self.pid, 'tid': threading.get_native_id()}
+        if args is not None:
+            event['args'] = args
+        self.pending.append(event)
+
+    @contextlib.contextmanager
+    def span(self, name, cat='loop', args=None):
+        start = time.monotonic()
+        try:
+            yield
+        finally:
+            self.complete(name, start, time.monotonic(), cat, args)
+
+    def timed(self, function, name, cat):
+        def wrapper(*args, **kwargs):
+            start = time.monotonic()
+            try:
+                return function(*args, **kwargs)
+            finally:
+                self.complete(name, start, time.monotonic(), cat)
+        return wrapper
+
+    def start(self):
+        self.thread = threading.Thread(target=self.run, name="profiler", daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        self.stopping.set()
+        if self.thread is not None:
+            self.thread.join()
+
+    def run(self):
+        new = not os.path.exists(self.path) or os.path.getsize(self.path) == 0
+        with open(self.path, "a") as f:
+            if new:
+                f.write("[\n")
+            if gst_epoch is not None:
+                f.write(json.dumps({'name': 'gst_epoch', 'ph': 'M', 'pid': self.pid,
+                                    'args': {'monotonic': gst_epoch}}) + ",\n")
+            while not self.stopping.wait(flush_interval):
+                self.drain(f)
+                if not self.capped:
+                    self.check()
+            self.drain(f)
+
+    def check(self):
+        size = 0
+        for path in (self.path, gst_log):
+            if path is not None and os.path.exists(path):
+                size += os.path.getsize(path)
+        if self.max_bytes and size >= self.max_bytes:
+            self.cap("size limit reached at %.1f MB" % (size / 1e6))
+        elif self.deadline is not None and time.monotonic() >= self.deadline:
+            self.cap("time limit reached")
+
+    def cap(self, reason):
+        self.capped = True
+        self.pending.clear()
+        sys.stderr.write("profile: %s, no longer recording\n" % reason)
+        if gst_log is not None:
+            stop_tracers()
+
+    def drain(self, f):
+        lines = []
+        while self.pending:
+            event = self.pending.popleft()
+            if event['tid'] not in self.threads:
+                # name each thread once so the viewer can label its track
+                for thread in threading.enumerate():
+                    self.threads[thread.native_id] = thread.name
+                lines.append(json.dumps({'name': 'thread_name', 'ph': 'M', 'pid': self.pid, 'tid': event['tid'],
+                                         'args': {'name': self.threads.get(event['tid'], str(event['tid']))}}))
+            lines.append(json.dumps(event))
+        if lines:
+            f.write(",\n".join(lines) + ",\n")
+            f.flush()
+
+class NullProfiler(object):
+
+    def complete(self, name, start, end, cat='loop', args=None):
+        pass
+
+    def span(self, name, cat='loop', args=None):
+        return contextlib.nullcontext()
+
+    def timed(self, function, name, cat):
+        return function
+
+    def start(self):
+        pass
+
+    def stop(self):
+        pass
+
+def stop_tracers():
+    # from the writer thread; the tracers keep running, but their records
+    # are no longer logged. Log functions are left alone, so any GST_DEBUG
+    # output asked for besides ours carries on as before
+    from gi.repository import Gst
+    Gst.debug_set_threshold_for_name('GST_TRACER', Gst.DebugLevel.NONE)
+
+def child_environment():
+    # for gst-launch children: the environment without what prepare set
+    env = dict(os.environ)
+    for name, value in saved_environment.items():
+        if value is None:
+            env.pop(name, None)
+        else:
+            env[name] = value
+    return env
+
+def add_arguments(parser):
+    parser.add_argument('--profile', metavar='TRACE', help="record control path and element timings to this trace")
+    parser.add_argument('--profile-tracers', default=default_tracers,
+                        help="GStreamer tracers to enable with --profile, empty for none")
+    parser.add_argument('--profile-max-mb', type=float, default=default_max_mb,
+                        help="stop recording once the trace and tracer log reach this size, 0 for no limit")
+    parser.add_argument('--profile-seconds', type=float, default=0,
+                        help="stop recording this long after starting, 0 for no limit")
+
+def prepare(options):
+    # before Gst.init: tracers are only read from the environment there
+    global gst_epoch, gst_log
+    gst_epoch = time.monotonic()
+    if options.profile is None or not options.profile_tracers:
+        return
+    for name in ('GST_TRACERS', 'GST_DEBUG', 'GST_DEBUG_FILE', 'GST_DEBUG_NO_COLOR'):
+        saved_environment[name] = os.environ.get(name)
+    os.environ['GST_TRACERS'] = options.profile_tracers
+    debug = os.environ.get('GST_DEBUG')
+    os.environ['GST_DEBUG'] = debug + ",GST_TRACER:7" if debug else "GST_TRACER:7"
+    os.environ.setdefault('GST_DEBUG_FILE', options.profile + ".gst.log")
+    os.environ['GST_DEBUG_NO_COLOR'] = "1"
+    gst_log = os.environ['GST_DEBUG_FILE']
+
+def from_options(options):
+    if options.profile is None:
+        return NullProfiler()
+    return Profiler(options.profile, int(options.profile_max_mb * 1e6), options.profile_seconds)
+
+def load(path):
+    with open(path) as f:
+        text = f.read().rstrip().rstrip(',')
+    if not text.endswith(']'):
+        text += ']'
+    return json.loads(text)
+
+tracer_line = re.compile(r'\b(element-latency|latency), (.*);')
+tracer_field = re.compile(r'([\w-]+)=\((\w+)\)([^,;]*)')
+
+def load_gst_log(path, epoch, pid=0):
+    # element-latency records as trace events, placed on our timeline by
+    # the monotonic time of Gst.init
+    events = []
+    tids = {}
+    with open(path, errors='replace') as f:
+        for line in f:
+            match = tracer_line.search(line)
+            if match is None:
+                continue
+            fields = dict((name, value.strip('"')) for name, kind, value in tracer_field.findall(match.group(2)))
+            try:
+                spent = int(fields['time'])
+                end = int(fields['ts'])
+            except (KeyError, ValueError):
+                continue
+            if match.group(1) == 'element-latency':
+                name = fields.get('element', '?')
+            else:
+                name = "%s -> %s" % (fields.get('src-element', '?'), fields.get('sink-element', '?'))
+            if name not in tids:
+                tids[name] = len(tids) + 1
+                events.append({'name': 'thread_name', 'ph': 'M', 'pid': pid, 'tid': tids[name],
+                               'args': {'name': name}})
+            events.append({'name': name, 'cat': 'element' if match.group(1) == 'element-latency' else 'pipeline',
+                           'ph': 'X', 'pid': pid, 'tid': tids[name],
+                           'ts': epoch * 1e6 + (end - spent) / 1e3, 'dur': spent / 1e3})
+    return events
+
+def percentile(values, p):
+    k = (len(values) - 1) * p / 100.0
+    low = int(k)
+    high = min(low + 1, len(values) - 1)
+    return values[low] + (values[high] - values[low]) * (k - low)
+
+def summarise(events):
+    durations = collections.defaultdict(list)
+    for event in events:
+        if event.get('ph') == 'X':
+            durations[(event.get('cat', ''), event['name'])].append(event['dur'] / 1000.0)
+    print("{0:<10}{1:<32}{2:>8}{3:>10}{4:>10}{5:>10}{6:>10}".format("cat", "name", "count", "mean ms", "p50", "p99", "max"))
+    for (cat, name), values in sorted(durations.items()):
+        values.sort()
+        print("{0:<10}{1:<32}{2:>8}{3:>10.3f}{4:>10.3f}{5:>10.3f}{6:>10.3f}".format(
+            cat, name[:31], len(values), sum(values) / len(values),
+            percentile(values, 50), percentile(values, 99), values[-1]))
+
+def main(args):
+    parser = argparse.ArgumentParser(prog=args[0], description="summarise a --profile trace")
+    parser.add_argument('trace')
+    parser.add_argument('--gst-log', help="tracer log to merge, by default <trace>.gst.log if there is one")
+    parser.add_argument('--timeline', help="write the merged trace here, for chrome://tracing or Perfetto")
+    options = parser.parse_args(args[1:])
+
+    events = load(options.trace)
+    gst_log = options.gst_log or options.trace + ".gst.log"
+    if os.path.exists(gst_log):
+        epochs = [event['args']['monotonic'] for event in events if event.get('name') == 'gst_epoch']
+        if epochs:
+            events += load_gst_log(gst_log, epochs[-1])
+        else:
+            sys.stderr.write("no gst_epoch in %s, leaving out %s\n" % (options.trace, gst_log))
+    summarise(events)
+    if options.timeline:
+        with open(options.timeline, "w") as f:
+            json.dump({'traceEvents': events, 'displayTimeUnit': 'ms'}, f)
+
+if __name__ == '__main__':
+    main(sys.argv)
@@ -0,0 +1,324 @@
+#!/usr/bin/python3
+
+# Playback rate engines for the GStreamer players.
+#
+#   speed       the original resampler; cheapest, but pitch follows the rate
+#   scaletempo  WSOLA time-stretch, pitch preserved; --quality trades CPU
+#               for fewer artifacts by changing the stride/overlap/search
+#   pitch       SoundTouch time-stretch (gst-plugins-bad soundtouch)
+#
+# Besides set_rate, which jumps, each engine has ramp_to(rate, seconds):
+# the control path only posts the target and ramp time, and the rate is
+# interpolated per buffer on the streaming thread. speed and pitch do this
+# with a linear InterpolationControlSource bound to their rate property;
+# scaletempo re-segments whenever the interpolated rate crosses a step.
+# Ramp times are in seconds of track time, and a ramp carries on across a
+# track change.
+#
+# Run this file directly to get a CPU and real-time-factor report for each
+# engine on the current machine.
+
+import sys, time, argparse
+
+import gi
+
+gi.require_version('Gst', '1.0')
+gi.require_version('GstController', '1.0')
+from gi.repository import Gst, GstController
+
+min_rate = 0.25
+max_rate = 3.0
+
+# scaletempo stride (ms), overlap (fraction of stride) and search window (ms);
+# the search window is where most of the CPU goes
+scaletempo_quality = {
+    'low': (60, 0.10, 0),
+    'medium': (30, 0.20, 14),
+    'high': (20, 0.30, 28),
+}
+
+def clamp(rate):
+    return min(max(rate, min_rate), max_rate)
+
+def make_bin(name, elements):
+    # chain elements into a bin with ghost pads at either end
+    engine_bin = Gst.Bin.new(name)
+    for element in elements:
+        engine_bin.add(element)
+    for upstream, downstream in zip(elements, elements[1:]):
+        upstream.link(downstream)
+    engine_bin.add_pad(Gst.GhostPad.new("sink", elements[0].get_static_pad("sink")))
+    engine_bin.add_pad(Gst.GhostPad.new("src", elements[-1].get_static_pad("src")))
+    return engine_bin
+
+class Ramp(object):
+
+    # a linear ramp in buffer time, posted from the control path and
+    # picked up by the streaming thread on the next buffer
+
+    def __init__(self, value=1.0):
+        self.value = value
+        self.target = value
+        self.begin = None
+        self.end = None
+        self.pending = None
+        self.last_pts = None
+
+    def post(self, target, seconds):
+        # a single assignment, so the streaming thread sees all or nothing
+        self.pending = (target, int(seconds * Gst.SECOND))
+
+    def at(self, pts):
+        if self.begin is None or pts >= self.end:
+            return self.target
+        if pts <= self.begin[0]:
+            return self.begin[1]
+        start, value = self.begin
+        return value + (self.target - value) * (pts - start) / float(self.end - start)
+
+    def update(self, pts):
+        # returns True when the ramp has to be laid out again from pts
+        changed = False
+        if self.last_pts is not None and pts < self.last_pts:
+            # a new track, or a flush: carry on with what is left of the ramp
+            if self.end is not None and self.end > self.last_pts:
+                self.begin = (pts, self.value)
+                self.end = pts + self.end - self.last_pts
+            else:
+                self.begin = self.end = None
+            changed = True
+        pending, self.pending = self.pending, None
+        if pending is not None:
+            target, duration = pending
+            self.target = target
+            self.begin = (pts, self.value)
+            self.end = pts + duration
+            changed = True
+        self.last_pts = pts
+        self.value = self.at(pts)
+        return changed
+
+class ControlledEngine(object):
+
+    # rate through a controllable property of self.stretch
+
+    rate_property = None
+
+    def setup_ramp(self):
+        self.rate = 1.0
+        self.ramp = Ramp(self.rate)
+        self.control = GstController.InterpolationControlSource.new()
+        self.control.set_property("mode", GstController.InterpolationMode.LINEAR)
+        self.stretch.add_control_binding(
+            GstController.DirectControlBinding.new_absolute(self.stretch, self.rate_property, self.control))
+        self.stretch.get_static_pad("sink").add_probe(Gst.PadProbeType.BUFFER, self.on_buffer)
+
+    def set_rate(self, rate):
+        self.rate = clamp(rate)
+        self.stretch.set_property(self.rate_property, self.rate)
+        self.ramp.post(self.rate, 0)
+
+    def ramp_to(self, rate, seconds):
+        self.rate = clamp(rate)
+        self.ramp.post(self.rate, seconds)
+
+    def on_buffer(self, pad, info):
+        pts = info.get_buffer().pts
+        if pts == Gst.CLOCK_TIME_NONE:
+            return Gst.PadProbeReturn.OK
+        if self.ramp.update(pts):
+            self.control.unset_all()
+            self.control.set(pts, self.ramp.value)
+            if self.ramp.end is not None and self.ramp.end > pts:
+                self.control.set(self.ramp.end, self.ramp.target)
+        self.stretch.sync_values(pts)
+        return Gst.PadProbeReturn.OK
+
+class SpeedEngine(ControlledEngine):
+
+    name = 'speed'
+    rate_property = 'speed'
+
+    def __init__(self, quality=None):
+        self.element = Gst.ElementFactory.make("speed", "speed")
+        self.stretch = self.element
+        self.setup_ramp()
+
+class PitchEngine(ControlledEngine):
+
+    name = 'pitch'
+    rate_property = 'tempo'
+
+    def __init__(self, quality=None):
+        self.stretch = Gst.ElementFactory.make("pitch", "pitch")
+        self.element = make_bin("rate-engine", [
+            Gst.ElementFactory.make("audioconvert", None),
+            self.stretch,
+            Gst.ElementFactory.make("audioconvert", None),
+        ])
+        self.setup_ramp()
+
+class ScaletempoEngine(object):
+
+    name = 'scaletempo'
+
+    # scaletempo restarts its overlap buffers on every new rate, so do not
+    # bother it with changes smaller than this
+    rate_step = 0.01
+
+    def __init__(self, quality='medium'):
+        self.stretch = Gst.ElementFactory.make("scaletempo", "scaletempo")
+        if quality in scaletempo_quality:
+            stride, overlap, search = scaletempo_quality[quality]
+        else:
+            stride, overlap, search = [float(value) for value in quality.split(',')]
+        self.stretch.set_property("stride", int(stride))
+        self.stretch.set_property("overlap", overlap)
+        self.stretch.set_property("search", int(search))
+
+        self.element = make_bin("rate-engine", [
+            Gst.ElementFactory.make("audioconvert", None),
+            self.stretch,
+            Gst.ElementFactory.make("audioconvert", None),
+        ])
+
+        self.rate = 1.0
+        self.ramp = Ramp(self.rate)
+        self.applied = None
+        self.segment = None
+        self.injecting = False
+
+        # scaletempo takes its rate from the segment, so rather than seek the
+        # whole pipeline we rewrite the segment just ahead of it
+        self.stretch.get_static_pad("sink").add_probe(
+            Gst.PadProbeType.BUFFER | Gst.PadProbeType.EVENT_DOWNSTREAM, self.on_data)
+
+    def set_rate(self, rate):
+        self.ramp_to(rate, 0)
+
+    def ramp_to(self, rate, seconds):
+        self.rate = round(clamp(rate) / self.rate_step) * self.rate_step
+        self.ramp.post(self.rate, seconds)
+
+    def on_data(self, pad, info):
+        if self.injecting:
+            return Gst.PadProbeReturn.OK
+
+        if info.type & Gst.PadProbeType.EVENT_DOWNSTREAM:
+            event = info.get_event()
+            if event.type == Gst.EventType.SEGMENT:
+                # replaced with our own before the next buffer; the event
+                # owns the parsed segment
+                self.segment = event.parse_segment().copy()
+                self.applied = None
+                return Gst.PadProbeReturn.DROP
+            if event.type == Gst.EventType.EOS and self.segment is not None and self.applied is None:
+                # no buffer came after the segment to carry it
+                self.inject(pad, self.segment)
+            return Gst.PadProbeReturn.OK
+
+        buf = info.get_buffer()
+        if buf.pts == Gst.CLOCK_TIME_NONE:
+            return Gst.PadProbeReturn.OK
+        self.ramp.update(buf.pts)
+        rate = round(self.ramp.value / self.rate_step) * self.rate_step
+        if self.segment is not None and self.applied != rate:
+            self.resegment(pad, buf.pts, rate)
+        return Gst.PadProbeReturn.OK
+
+    def resegment(self, pad, pts, rate):
+        # a new segment starting at this buffer that keeps running time and
+        # stream time continuous across the rate change
+        segment = self.segment.copy()
+        segment.base = self.segment.to_running_time(Gst.Format.TIME, pts)
+        segment.time = self.segment.to_stream_time(Gst.Format.TIME, pts)
+        segment.start = pts
+        segment.position = pts
+        segment.rate = rate
+        self.inject(pad, segment)
+
+    def inject(self, pad, segment):
+        self.segment = segment
+        self.applied = segment.rate
+        self.injecting = True
+        try:
+            pad.send_event(Gst.Event.new_segment(segment))
+        finally:
+            self.injecting = False
+
+engines = {
+    'speed': SpeedEngine,
+    'scaletempo': ScaletempoEngine,
+    'pitch': PitchEngine,
+}
+
+def make_engine(name, quality='medium'):
+    return engines[name](quality)
+
+def measure(name, quality, rate, seconds):
+    # decode-free pipeline so the numbers are the engine's own
+    pipeline = Gst.Pipeline.new("report")
+    source = Gst.ElementFactory.make("audiotestsrc", None)
+    caps = Gst.ElementFactory.make("capsfilter", None)
+    sink = Gst.ElementFactory.make("fakesink", None)
+    engine = make_engine(name, quality)
+
+    samples = 1024
+    source.set_property("wave", "pink-noise")
+    source.set_property("samplesperbuffer", samples)
+    source.set_property("num-buffers", int(seconds * 44100 / samples))
+    caps.set_property("caps", Gst.Caps.from_string("audio/x-raw,format=S16LE,rate=44100,channels=2"))
+    sink.set_property("sync", False)
+    engine.set_rate(rate)
+
+    for element in (source, caps, engine.element, sink):
+        pipeline.add(element)
+    source.link(caps)
+    caps.link(engine.element)
+    engine.element.link(sink)
+
+    bus = pipeline.get_bus()
+    wall = time.monotonic()
+    cpu = time.process_time()
+    pipeline.set_state(Gst.State.PLAYING)
+    message = bus.timed_pop_filtered(Gst.CLOCK_TIME_NONE, Gst.MessageType.EOS | Gst.MessageType.ERROR)
+    cpu = time.process_time() - cpu
+    wall = time.monotonic() - wall
+    pipeline.set_state(Gst.State.NULL)
+
+    if message.type == Gst.MessageType.ERROR:
+        err, debug = message.parse_error()
+        raise RuntimeError("%s: %s" % (err, debug))
+
+    # seconds of audio the listener would hear at this rate
+    audio = seconds / engine.rate
+    return cpu / audio, wall / audio
+
+def report(args):
+    parser = argparse.ArgumentParser(prog=args[0], description="CPU and real-time-factor report for each rate engine")
+    parser.add_argument('--engines', default=','.join(sorted(engines)))
+    parser.add_argument('--quality', action='append', help="scaletempo preset or stride,overlap,search; may be repeated")
+    parser.add_argument('--rates', default='0.25,0.5,1.0,1.5,2.0,3.0')
+    parser.add_argument('--seconds', type=float, default=20.0, help="seconds of input audio per measurement")
+    options = parser.parse_args(args[1:])
+
+    Gst.init(None)
+
+    print("{0:<12}{1:<10}{2:>6}{3:>10}{4:>10}".format("engine", "quality", "rate", "cpu %", "rtf"))
+    for name in options.engines.split(','):
+        qualities = ['-']
+        if name == 'scaletempo':
+            qualities = options.quality or sorted(scaletempo_quality)
+        for quality in qualities:
+            for rate in [float(rate) for rate in options.rates.split(',')]:
+                try:
+                    cpu, rtf = measure(name, quality, rate, options.seconds)
+                except Exception as e:
+                    print("{0:<12}{1:<10}{2:>6.2f}  failed: {3}".format(name, quality, rate, e))
+                    continue
+                # cpu % is of one core while playing in real time; rtf below
+                # 1.0 means the engine keeps ahead of playback
+                print("{0:<12}{1:<10}{2:>6.2f}{3:>10.1f}{4:>10.3f}".format(name, quality, rate, cpu * 100, rtf))
+
+if __name__ == '__main__':
+    report(sys.argv)
@@ -0,0 +1,266 @@
+#!/usr/bin/python3
+
+# Pre-rendered rate ladders, for boards too slow to stretch audio live.
+#
+# Each track is rendered offline at a ladder of rates, 0.5x to 2.0x in
+# 0.1 steps unless --rates says otherwise, by niced gst-launch-1.0
+# children run from a process pool. The rungs are raw PCM in the PCM
+# cache's format, one directory per track keyed by its real path, so at
+# runtime a rung plays straight from its file with no decoder at
+# all; any compression would bring the decoding back. Budget about 10 MB
+# per minute of track per rung: the ladder trades disk space for CPU.
+#
+# With --rate-ladder DIR the players wrap their rate engine in a
+# LadderEngine. It plays the rung nearest the wanted rate and leaves the
+# engine only the small residual between the two. The rung is kept while
+# the residual stays within --ladder-residual, and beyond that is only
+# left for a rung nearer the rate by more than hysteresis, so a cadence
+# wobbling around the midpoint between two rungs does not flip between
+# them. A rung change rebuilds the current track from the new rung at
+# the same track position, which for raw PCM takes a few milliseconds,
+# and jumps to the new rate rather than ramping. Tracks that have not
+# been rendered play as before, with the engine doing all of the work.
+#
+# Render a library, here with the SoundTouch engine so pitch is kept:
+#
+#   python3 rate_ladder.py --rates 0.6:1.6:0.2 --engine pitch ladder/ /srv/music
+
+import sys, os, json, math, time, hashlib, argparse
+
+import library
+import profiler
+from pcm_cache import pcm_caps, launch_location
+
+default_rates = "0.5:2.0:0.1"
+default_engine = 'speed'
+# the residual the engine is left to do before moving to another rung
+default_residual = 0.08
+# how much nearer, as a log ratio, another rung must be to move to it
+hysteresis = 0.04
+render_niceness = 10
+
+# gst-launch elements rendering a rate, matching rate_engine.py's engines;
+# scaletempo takes its rate from the segment, which gst-launch cannot set
+render_elements = {
+    'speed': lambda rate: ["speed", "speed=%g" % rate],
+    'pitch': lambda rate: ["pitch", "tempo=%g" % rate],
+}
+
+def parse_rates(text):
+    # start:stop:step, inclusive, or a comma separated list
+    try:
+        if ':' in text:
+            start, stop, step = (float(part) for part in text.split(':'))
+            if step <= 0 or stop < start:
+                raise ValueError(text)
+            rates = [round(start + i * step, 3) for i in range(int(round((stop - start) / step)) + 1)]
+        else:
+            rates = [float(part) for part in text.split(',')]
+    except ValueError:
+        raise argparse.ArgumentTypeError("expected START:STOP:STEP or RATE,RATE,...")
+    if not rates or min(rates) <= 0:
+        raise argparse.ArgumentTypeError("rates must be positive")
+    return sorted(set(rates))
+
+def nearest(rate, rates):
+    # by ratio, so 0.5 is as far from 1.0 as 2.0 is
+    return min(rates, key=lambda rung: distance(rate, rung))
+
+def distance(rate, rung):
+    return abs(math.log(rate / rung))
+
+class RateLadder(object):
+
+    def __init__(self, directory, residual=default_residual):
+        self.directory = directory
+        self.residual = residual
+        try:
+            with open(os.path.join(directory, "ladder.json")) as f:
+                self.rates = json.load(f)['rates']
+        except (OSError, ValueError, KeyError):
+            self.rates = parse_rates(default_rates)
+        self.rung = nearest(1.0, self.rates)
+        self.tracks = {}
+
+    def key(self, path):
+        return hashlib.sha1(os.path.realpath(path).encode()).hexdigest()
+
+    def track_dir(self, path):
+        return os.path.join(self.directory, self.key(path))
+
+    def rung_path(self, path, rate):
+        return os.path.join(self.track_dir(path), "%.3f.pcm" % rate)
+
+    def entry(self, path):
+        # the track's rendered rates, or None when it has none or has
+        # changed since; read once per track
+        if path not in self.tracks:
+            entry = None
+            try:
+                st = os.stat(path)
+                with open(os.path.join(self.track_dir(path), "index.json")) as f:
+                    entry = json.load(f)
+                if entry['mtime'] != st.st_mtime or entry['size'] != st.st_size:
+                    entry = None
+            except (OSError, ValueError, KeyError):
+                entry = None
+            self.tracks[path] = entry
+        return self.tracks[path]
+
+    def lookup(self, path):
+        # (pcm path, rate) of the track's rung nearest the current one, or
+        # (None, 1.0) to play the track itself
+        entry = self.entry(path)
+        if entry is None or not entry['rates']:
+            return None, 1.0
+        rate = nearest(self.rung, entry['rates'])
+        pcm = self.rung_path(path, rate)
+        if not os.path.exists(pcm):
+            self.tracks[path] = None
+            return None, 1.0
+        return pcm, rate
+
+    def select(self, rate):
+        # move to the nearest rung once the current one would leave the
+        # engine more than the residual, and the nearest is clearly
+        # nearer; True if the rung changed
+        if rate <= 0 or abs(rate / self.rung - 1) <= self.residual:
+            return False
+        rung = nearest(rate, self.rates)
+        if distance(rate, rung) + hysteresis >= distance(rate, self.rung):
+            return False
+        self.rung = rung
+        return True
+
+class LadderEngine(object):
+
+    # stands in for a rate_engine engine: rate is the rate the track plays
+    # at, of which the engine underneath does rate / rung
+
+    def __init__(self, engine, ladder, switcher, position):
+        self.engine = engine
+        self.ladder = ladder
+        self.switcher = switcher
+        self.position = position
+        self.element = engine.element
+        self.rate = engine.rate
+        switcher.ladder = ladder
+
+    def rung(self):
+        current = self.switcher.current
+        return current.rate if current is not None else 1.0
+
+    def change_rung(self):
+        current = self.switcher.current
+        if current is None or self.ladder.lookup(current.location)[1] == current.rate:
+            return False
+        position = self.position.position()
+        self.switcher.replace(position)
+        self.position.track_changed(position)
+        return True
+
+    def set_rate(self, rate):
+        self.rate = rate
+        if self.ladder.select(rate):
+            self.change_rung()
+        self.engine.set_rate(rate / self.rung())
+
+    def ramp_to(self, rate, seconds):
+        self.rate = rate
+        if self.ladder.select(rate) and self.change_rung():
+            # the audio has jumped to the new rung, so jump the residual
+            self.engine.set_rate(rate / self.rung())
+            return
+        self.engine.ramp_to(rate / self.rung(), seconds)
+
+    def track_changed(self):
+        # the new track may come from another rung, or none
+        self.engine.set_rate(self.rate / self.rung())
+
+def add_arguments(parser):
+    parser.add_argument('--rate-ladder', metavar='DIR', help="play from tracks pre-rendered at a ladder of rates here")
+    parser.add_argument('--ladder-residual', type=float, default=default_residual,
+                        help="largest fraction of the rate left to the engine before changing rung")
+
+def from_options(options, engine, switcher, position):
+    if options.rate_ladder is None:
+        return None
+    return LadderEngine(engine, RateLadder(options.rate_ladder, options.ladder_residual), switcher, position)
+
+def render(source, target, rate, engine):
+    # one rung of one track, in a pool process
+    import subprocess
+
+    tmp = target + ".tmp"
+    command = ["nice", "-n", str(render_niceness), "gst-launch-1.0", "-q",
+               "filesrc", launch_location(source), "!", "decodebin", "!",
+               "audioconvert", "!", "audioresample", "!"] + render_elements[engine](rate) + ["!",
+               "audioconvert", "!", "audioresample", "!", pcm_caps, "!",
+               "filesink", launch_location(tmp)]
+    started = time.monotonic()
+    if subprocess.call(command, stdout=subprocess.DEVNULL, env=profiler.child_environment()) != 0:
+        try:
+            os.unlink(tmp)
+        except OSError:
+            pass
+        return None
+    os.replace(tmp, target)
+    return time.monotonic() - started
+
+def main(args):
+    # only for rendering; the players import this module at startup
+    from concurrent.futures import ProcessPoolExecutor
+
+    parser = argparse.ArgumentParser(prog=args[0], description="render tracks at a ladder of playback rates")
+    parser.add_argument('directory', help="where the ladder is kept, as given to --rate-ladder")
+    parser.add_argument('files', nargs='+', metavar='<media file, directory or m3u>')
+    parser.add_argument('--rates', type=parse_rates, default=parse_rates(default_rates),
+                        help="START:STOP:STEP or RATE,RATE,... (default %s)" % default_rates)
+    parser.add_argument('--engine', choices=sorted(render_elements), default=default_engine,
+                        help="speed lets the pitch follow the rate, pitch keeps it")
+    parser.add_argument('--workers', type=int, default=os.cpu_count() or 1, help="render processes")
+    parser.add_argument('--force', action='store_true', help="render tracks that already have their rungs")
+    library.add_arguments(parser)
+    options = parser.parse_args(args[1:])
+
+    os.makedirs(options.directory, exist_ok=True)
+    with open(os.path.join(options.directory, "ladder.json"), "w") as f:
+        json.dump({'rates': options.rates, 'engine': options.engine}, f)
+    ladder = RateLadder(options.directory)
+    playlist = library.from_options(options).playlist(options.files)
+
+    jobs = []
+    for path in playlist:
+        entry = ladder.entry(path)
+        if not options.force and entry is not None and set(options.rates) <= set(entry['rates']) \
+                and entry.get('engine') == options.engine:
+            continue
+        os.makedirs(ladder.track_dir(path), exist_ok=True)
+        for rate in options.rates:
+            jobs.append((path, rate))
+
+    started = time.monotonic()
+    rendered = dict((path, []) for path, rate in jobs)
+    with ProcessPoolExecutor(max_workers=options.workers) as pool:
+        futures = [(path, rate, pool.submit(render, path, ladder.rung_path(path, rate), rate, options.engine))
+                   for path, rate in jobs]
+        for path, rate, future in futures:
+            seconds = future.result()
+            if seconds is None:
+                sys.stderr.write("could not render %s at %gx\n" % (path, rate))
+                continue
+            print("%5.2fx\t%6.1f s\t%s" % (rate, seconds, path))
+            rendered[path].append(rate)
+
+    total = 0
+    for path, rates in rendered.items():
+        st = os.stat(path)
+        with open(os.path.join(ladder.track_dir(path), "index.json"), "w") as f:
+            json.dump({'path': os.path.realpath(path), 'mtime': st.st_mtime, 'size': st.st_size,
+                       'rates': rates, 'engine': options.engine}, f)
+        total += sum(os.path.getsize(ladder.rung_path(path, rate)) for rate in rates)
+    sys.stderr.write("rendered %d rungs of %d tracks in %.1f s, %.1f MB\n" % (
+        sum(len(rates) for rates in rendered.values()), len(rendered), time.monotonic() - started, total / 1e6))
+
+if __name__ == '__main__':
+    main(sys.argv)
@@ -0,0 +1,114 @@
+#!/usr/bin/python3
+
+# Hall-sensor pulse timestamps and the RPM estimators that read them.
+#
+# The GPIO callback thread is the only writer of a PulseRing and the main
+# loop only ever reads it, so no lock is needed: the slot is written before
+# the pulse count is bumped, and a reader re-checks the count after copying
+# to detect that the writer lapped it.
+
+import time
+from array import array
+
+class PulseRing(object):
+
+    def __init__(self, size=32):
+        self.size = size
+        self.stamps = array('d', [0.0] * size)
+        self.count = 0
+
+    def push(self, stamp):
+        self.stamps[self.count % self.size] = stamp
+        self.count += 1
+
+    def last(self, n):
+        # newest n timestamps, oldest first
+        while True:
+            count = self.count
+            n = min(n, count, self.size - 1)
+            stamps = [self.stamps[i % self.size] for i in range(count - n, count)]
+            if self.count - count < self.size - n:
+                return stamps
+
+def intervals(stamps, min_interval):
+    # a bounced edge shows up as a very short interval; fold it into the
+    # next one instead of letting it double the speed
+    result = []
+    previous = None
+    for stamp in stamps:
+        if previous is None:
+            previous = stamp
+        elif stamp - previous >= min_interval:
+            result.append(stamp - previous)
+            previous = stamp
+    return result
+
+def median_rpm(ring, now, samples=5, min_interval=0.02, **kwargs):
+    gaps = sorted(intervals(ring.last(samples + 1), min_interval))
+    if not gaps:
+        return 0.0
+    middle = len(gaps) // 2
+    if len(gaps) % 2:
+        gap = gaps[middle]
+    else:
+        gap = (gaps[middle - 1] + gaps[middle]) / 2
+    return 60.0 / gap
+
+def ema_rpm(ring, now, samples=16, alpha=0.3, min_interval=0.02, **kwargs):
+    gap = None
+    for interval in intervals(ring.last(samples + 1), min_interval):
+        gap = interval if gap is None else gap + alpha * (interval - gap)
+    if gap is None:
+        return 0.0
+    return 60.0 / gap
+
+def window_rpm(ring, now, window=3.0, samples=31, min_interval=0.02, **kwargs):
+    stamps = [stamp for stamp in ring.last(samples + 1) if now - stamp <= window]
+    gaps = intervals(stamps, min_interval)
+    if not gaps:
+        return 0.0
+    return 60.0 * len(gaps) / sum(gaps)
+
+estimators = {
+    'median': median_rpm,
+    'ema': ema_rpm,
+    'window': window_rpm,
+}
+
+class RpmEstimator(object):
+
+    def __init__(self, ring, method='median', stall_timeout=3.0, min_rpm=5.0, **options):
+        self.ring = ring
+        self.estimate = estimators[method]
+        self.stall_timeout = stall_timeout
+        self.min_rpm = min_rpm
+        self.options = options
+
+    def rpm(self, now=None):
+        if now is None:
+            now = time.monotonic()
+        last = self.ring.last(1)
+        if not last:
+            return 0.0
+        since = now - last[0]
+        if since > self.stall_timeout:
+            return 0.0
+
+        rpm = self.estimate(self.ring, now, **self.options)
+
+        # once the wheel is overdue for its next pulse it can be turning at
+        # most one revolution per elapsed gap, which decays towards zero
+        if since > 0:
+            rpm = min(rpm, 60.0 / since)
+        if rpm < self.min_rpm:
+            return 0.0
+        return rpm
+
+    def decay_delay(self, rpm, now=None):
+        # seconds until the overdue bound starts to pull the estimate down
+        if now is None:
+            now = time.monotonic()
+        last = self.ring.last(1)
+        if not last or rpm <= 0:
+            return None
+        return max(0.0, last[0] + 60.0 / rpm - now)
@@ -1,65 +1,86 @@
 #!/usr/bin/python3
 
-import sys, os, signal, time, traceback
+import sys, os, signal, time, traceback, argparse
 
 import time
 import signal
 
 import logging
 
-import RPi.GPIO as GPIO
 from signal import pause
 
 from mplayer.core import Player
 
+from rpm_estimator import PulseRing, RpmEstimator
+import hardware
+import library
+import mplayer_control
+import status_display
+import profiler
+
+# 'median', 'ema' or 'window', see rpm_estimator.py
+rpm_method = 'median'
+rpm_options = {'samples': 5}
+stall_timeout = 3.0
+
 hall_pin = 17
 play_pin = 25
 prev_pin = 23
 next_pin = 12
 
+# status fields: name, format, width
+status_layout = [
+    ('track', '{}', 32),
+    ('rpm', '{:3.0f} rpm', 7),
+    ('speed', '{:4.2f}x', 5),
+]
+
 class SpeedoPlayer(object):
 
-    def __init__(self):
-        self.pulse = 0
+    def __init__(self, options, backend):
         self.rpm = 0.00
         self.multiplier = 2.0
-        self.elapse = 0.00
-        self.starttime = time.time()
+        self.pulses = PulseRing()
+        self.estimator = RpmEstimator(self.pulses, rpm_method, stall_timeout, **rpm_options)
         self.speed_refresh_delay = 0.25
-        self.player = Player()
+        self.backend = backend
+        args = mplayer_control.player_args + (('-ao', options.ao) if options.ao else ())
+        self.player = Player(args=args)
+        self.control = mplayer_control.MplayerControl(self.player, options.speed_deadband)
+        self.status = status_display.from_options(options, status_layout, self.status_track)
+        self.profiler = profiler.from_options(options)
 
     def display(self):
-        print("{0}\t{1: 5.0f}\t{2:05.2f}".format(self.player.filename, self.rpm, self.multiplier*100), end='\r')
+        self.status.update(rpm=self.rpm, speed=self.multiplier + 0.25)
+
+    def status_track(self):
+        # called on the status thread
+        filename = self.control.filename
+        return {'track': os.path.basename(filename) if filename else None}
 
     def get_pulse(self, number):
-        self.pulse+=1
-        if self.pulse > 0:
-            self.elapse = time.time() - self.starttime
-            self.pulse -=1
-
-        self.rpm = 1/self.elapse * 60
-        self.multiplier = self.rpm/1000
-
-        self.starttime = time.time()
-
-    def start(self, args):
-        # The script expects MP3 files to be given as arguments
-        if len(args) < 2:
-            sys.stderr.write("usage: %s <media file or uri>\n" % args[0])
-            sys.exit(1)
-        else:
-            for arg in args[1:]:
-                if os.path.isfile(arg):
-                    self.player.loadfile(arg, 1)
+        self.pulses.push(self.backend.clock())
+
+    def start(self, options):
+        # files, directories and M3U playlists, expanded through the index
+        self.library = library.from_options(options)
+        for path in self.library.playlist(options.files):
+            self.control.loadfile(path, 1)
+        self.library.rescan()
 
         # Need to wait for the first track to load
-        while self.player.paused is True:
-            time.sleep(0.1)
+        self.control.wait_started()
+        self.status.start()
 
-        while self.player.paused is False:
+        self.profiler.start()
+        while self.control.paused is False and not self.control.finished.is_set():
+            started = time.monotonic()
             try:
+                self.rpm = self.estimator.rpm(self.backend.clock())
+                self.multiplier = self.rpm/1000
+                self.control.set_speed(self.multiplier + 0.25)
                 self.display()
-                self.player.speed = self.multiplier + 0.25
+                self.profiler.complete('tick', started, time.monotonic())
                 time.sleep(self.speed_refresh_delay)
             except:
                 print('Exception in user code:')
@@ -67,26 +88,29 @@ class SpeedoPlayer(object):
                 traceback.print_exc(file=sys.stdout)
                 print('-'*60)
 
-        self.player.stop();
+        self.status.stop()
+        self.profiler.stop()
+        self.control.stop()
+        self.control.close()
 
     def playpause(self, number):
         print("Play / pause pressed")
-        self.player.pause()
-        self.player.speed = self.multiplier
+        self.control.pause()
+        self.control.set_speed(self.multiplier, force=True)
 
     def skipnext(self, number):
         print("Skipping to next track")
-        self.player.pt_step(1)
-        self.player.speed = self.multiplier
+        self.control.pt_step(1)
+        self.control.set_speed(self.multiplier, force=True)
 
     def skipprev(self, number):
         print("Skipping to previous track")
-        self.player.pt_step(-1)
-        self.player.speed = self.multiplier
+        self.control.pt_step(-1)
+        self.control.set_speed(self.multiplier, force=True)
 
     def cleanup(self):
         print("Cleaup called")
-        self.player.quit()
+        self.control.quit()
 
     def signal_handler(self, signalNumber, frame):
         print('received:', signalNumber)
@@ -99,35 +123,40 @@ class SpeedoPlayer(object):
     def error(data):
         logging.error(data)
 
+def parse_args(args):
+    parser = argparse.ArgumentParser(prog=args[0])
+    parser.add_argument('files', nargs='+', metavar='<media file, directory or m3u>')
+    parser.add_argument('--ao', help="mplayer audio output driver, e.g. null to run without a sound card")
+    hardware.add_arguments(parser)
+    library.add_arguments(parser)
+    mplayer_control.add_arguments(parser)
+    status_display.add_arguments(parser)
+    profiler.add_arguments(parser)
+    return parser.parse_args(args[1:])
+
 if __name__ == '__main__':
 
-    app = SpeedoPlayer()
+    options = parse_args(sys.argv)
+
+    backend = hardware.from_options(options, hall_pin)
+    app = SpeedoPlayer(options, backend)
 
     # register the signals to be caught
     signal.signal(signal.SIGINT, app.signal_handler)
     signal.signal(signal.SIGTERM, app.signal_handler)
 
-    GPIO.setmode(GPIO.BCM)
-    GPIO.setwarnings(False)
-
-    GPIO.setup(hall_pin, GPIO.IN, pull_up_down = GPIO.PUD_UP)
-    GPIO.add_event_detect(hall_pin, GPIO.FALLING, callback = app.get_pulse, bouncetime=20)
-
-    GPIO.setup(play_pin, GPIO.IN, pull_up_down = GPIO.PUD_UP)
-    GPIO.add_event_detect(play_pin, GPIO.FALLING, callback = app.playpause, bouncetime=500)
-
-    GPIO.setup(prev_pin, GPIO.IN, pull_up_down = GPIO.PUD_UP)
-    GPIO.add_event_detect(prev_pin, GPIO.FALLING, callback = app.skipprev, bouncetime=500)
-
-    GPIO.setup(next_pin, GPIO.IN, pull_up_down = GPIO.PUD_UP)
-    GPIO.add_event_detect(next_pin, GPIO.FALLING, callback = app.skipnext, bouncetime=500)
+    backend.add_edge_callback(hall_pin, app.get_pulse, backend.pulse_bouncetime)
+    backend.add_edge_callback(play_pin, app.playpause, 500)
+    backend.add_edge_callback(prev_pin, app.skipprev, 500)
+    backend.add_edge_callback(next_pin, app.skipnext, 500)
+    backend.start()
 
     try:
-        app.start(sys.argv)
+        app.start(options)
     except:
         print('Exception in user code:')
         print('-'*60)
         traceback.print_exc(file=sys.stdout)
         print('-'*60)
 
-    GPIO.cleanup()
+    backend.cleanup()
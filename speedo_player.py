@@ -1,6 +1,6 @@
 #!/usr/bin/python3 -d
 
-import sys, os, signal, time, traceback
+import sys, os, signal, time, traceback, argparse
 
 import time
 import gi
@@ -8,38 +8,98 @@ import signal
 
 import logging
 
-import RPi.GPIO as GPIO
 from signal import pause
 
 gi.require_version('Gst', '1.0')
-from gi.repository import GObject, Gst
+from gi.repository import GLib, GObject, Gst
+
+from rpm_estimator import PulseRing, RpmEstimator
+from track_switcher import TrackSwitcher
+from position import PositionTracker
+from helper import format_clock
+import rate_engine
+import rate_ladder
+import pcm_cache
+import decoders
+import adaptive_buffer
+import supervisor
+import hardware
+import library
+import tempo
+import metrics
+import telemetry
+import status_display
+import profiler
+import control_api
+
+# 'median', 'ema' or 'window', see rpm_estimator.py
+rpm_method = 'median'
+rpm_options = {'samples': 5}
+stall_timeout = 3.0
+decay_interval = 100
+
+# 'speed', 'scaletempo' or 'pitch', see rate_engine.py
+engine_name = 'speed'
+engine_quality = 'medium'
+# seconds of track over which the rate glides to a new value
+ramp_time = 0.5
 
 hall_pin = 17
 play_pin = 25
 prev_pin = 23
 next_pin = 12
 
+# status fields: name, format, width
+status_layout = [
+    ('track', '{}', 32),
+    ('rpm', '{:3.0f} rpm', 7),
+    ('rate', '{:4.2f}x', 5),
+    ('position', '{}', 15),
+]
+
 class MalvernStar_Player(object):
 
-    def __init__(self):
+    def __init__(self, loop, options, backend):
+
+        self.loop = loop
+        self.backend = backend
+        self.playlist = None
+        self.speed_update_pending = False
 
-        self.pulse = 0
         self.rpm = 0.00
-        self.multiplier = 0.25
-        self.elapse = 0.00
-        self.starttime = time.time()
+        self.multiplier = 0.00
+        self.pulses = PulseRing()
+        self.estimator = RpmEstimator(self.pulses, rpm_method, stall_timeout, **rpm_options)
+        self.decay_source = None
+        self.tempo = None
+        # the track the next one was last picked again for
+        self.repicked = None
+        self.ramp_time = options.ramp_time
+        # set through the control socket, see control_api.py
+        self.rate_override = None
+        self.rpm_override = None
 
         self.was_playpause_held = False
 
         self.player = Gst.Pipeline.new("player")
         self.player.set_auto_flush_bus(True)
 
-        self.source = Gst.ElementFactory.make("filesrc", "source")
-        self.decoder = Gst.ElementFactory.make("mad", "mp3-decoder")
-        self.speed = Gst.ElementFactory.make("speed", "speed")
-        self.conv = Gst.ElementFactory.make("audioconvert", "converter")
+        # rank the cheapest decoders first, here and in the cache's children
+        decoders.from_options(options)
+        self.cache = None
+        if options.cache_dir is not None:
+            self.cache = pcm_cache.PcmCache(options.cache_dir, options.cache_budget * 1024 * 1024)
+        self.switcher = TrackSwitcher(self.player, self.track_changed, self.cache, options.predecode)
+        self.engine = rate_engine.make_engine(options.engine, options.quality)
+        self.position = PositionTracker(self.switcher)
+        # the engine only does what is left between the pre-rendered rates
+        self.ladder = rate_ladder.from_options(options, self.engine, self.switcher, self.position)
+        if self.ladder is not None:
+            self.engine = self.ladder
         self.queue = Gst.ElementFactory.make("queue", "queue")
-        self.sink = Gst.ElementFactory.make("alsasink", "alsa-output")
+        self.sink = Gst.ElementFactory.make(options.sink, "alsa-output")
+        if options.sink == 'fakesink':
+            self.sink.set_property('sync', True)
 
         self.queue.set_property('max-size-buffers', 0)
         self.queue.set_property('max-size-bytes', 0)
@@ -48,85 +108,180 @@ class MalvernStar_Player(object):
         self.queue.connect('underrun', self.on_underrun)
         self.queue.connect('pushing', self.on_pushing)
         self.queue.connect('running', self.on_running)
-
-        self.player.add(self.source)
-        self.player.add(self.decoder)
-        self.player.add(self.speed)
-        self.player.add(self.conv)
+        self.buffering = adaptive_buffer.from_options(options, self.sink, self.queue)
+
+        self.metrics = metrics.PipelineMetrics(self)
+        self.telemetry = telemetry.from_options(options, backend.clock)
+        self.profiler = profiler.from_options(options)
+        self.pulse_seen = None
+        self.switcher.on_latency = self.metrics.switched
+        self.supervisor = supervisor.Supervisor(self, options)
+        self.finished = False
+        self.failed = False
+        self.status = status_display.from_options(options, status_layout, self.status_position)
+        self.control = control_api.from_options(options, self)
+
+        self.player.add(self.engine.element)
         self.player.add(self.queue)
         self.player.add(self.sink)
 
-        self.source.link(self.decoder)
-        self.decoder.link(self.conv)
-        self.conv.link(self.queue)
-        self.queue.link(self.speed)
-        self.speed.link(self.sink)
+        self.switcher.link(self.queue)
+        self.queue.link(self.engine.element)
+        self.engine.element.link(self.sink)
+        self.switcher.follow(self.engine.element)
 
         # create an event loop and feed gstreamer bus mesages to it
         self.bus = self.player.get_bus()
         self.bus.add_signal_watch()
-        self.bus.connect ("message", self.bus_call, loop)
+        self.bus.connect ("message", self.bus_call, self.loop)
 
     def display(self):
-        # os.system('clear')
-        # print(self.playlist[self.playnumber])
-        # print("RPM: %d" % self.rpm)
-        # print("Multiplier: %.2f" % self.multiplier)
-        print("{0}\t{1:05.0f}\t{2:05.2f}".format(self.playlist[self.playnumber], self.rpm, self.multiplier*100))
-
-    def get_pulse(self, number):
-        self.pulse+=1
-        if self.pulse > 0:
-            self.elapse = time.time() - self.starttime
-            self.pulse -=1
+        # only hands the values over; the status thread does the writing
+        self.status.update(track=os.path.basename(self.playlist[self.playnumber]),
+                           rpm=self.rpm, rate=self.engine.rate)
 
-        self.rpm = 1/self.elapse * 60
-        self.multiplier = self.rpm/1000
+    def status_position(self):
+        # called on the status thread
+        return {'position': "%s / %s" % (format_clock(self.position.position()),
+                                         format_clock(self.position.duration()))}
 
-        self.starttime = time.time()
+    def get_pulse(self, number):
+        stamp = self.backend.clock()
+        self.pulses.push(stamp)
+        self.telemetry.record(telemetry.PULSE, stamp=stamp)
+
+        # this runs on the GPIO callback thread, so hand the rate change to
+        # the main loop rather than touching the pipeline from here
+        if not self.speed_update_pending:
+            self.speed_update_pending = True
+            self.pulse_seen = time.monotonic()
+            GLib.idle_add(self.update_speed, priority=GLib.PRIORITY_HIGH)
+
+    def update_speed(self):
+        self.speed_update_pending = False
+        started = time.monotonic()
+        if self.pulse_seen is not None:
+            self.profiler.complete('pulse to update_speed', self.pulse_seen, started, 'gpio')
+            self.pulse_seen = None
+        try:
+            now = self.backend.clock()
+            self.rpm = self.estimator.rpm(now) if self.rpm_override is None else self.rpm_override
+            self.multiplier = self.rpm/1000
+            with self.profiler.span('ramp_to', 'gst'):
+                self.engine.ramp_to(self.playback_rate(), self.ramp_time)
+            self.position.set_rate(self.engine.rate)
+            self.telemetry.record(telemetry.RATE, self.rpm, self.engine.rate, self.playnumber, stamp=now)
+            self.control.emit('rate', rpm=self.rpm, rate=self.engine.rate)
+            self.display()
+            self.repick()
+
+            # wake up again when the next pulse is overdue so a stopping
+            # wheel winds the speed down instead of holding the last value
+            if self.decay_source is not None:
+                GLib.source_remove(self.decay_source)
+                self.decay_source = None
+            delay = self.estimator.decay_delay(self.rpm, now)
+            if delay is not None:
+                delay = delay / self.backend.time_scale
+                self.decay_source = GLib.timeout_add(max(int(delay*1000), decay_interval), self.decay_tick)
+        except:
+            print('Exception in user code:')
+            print('-'*60)
+            traceback.print_exc(file=sys.stdout)
+            print('-'*60)
+        self.profiler.complete('update_speed', started, time.monotonic())
+        return GLib.SOURCE_REMOVE
+
+    def repick(self):
+        # as the track is about to finish, pick the next one from the
+        # cadence now rather than the one it started at
+        if self.tempo is None or self.repicked == self.playnumber:
+            return
+        eta = self.position.eta()
+        if eta == Gst.CLOCK_TIME_NONE or eta > tempo.about_to_finish * Gst.SECOND:
+            return
+        self.repicked = self.playnumber
+        self.switcher.refresh_next()
+
+    def playback_rate(self):
+        if self.rate_override is not None:
+            return self.rate_override
+        rate = self.multiplier + 0.25
+        if self.tempo is not None:
+            # scale to the current track's own tempo
+            rate = self.tempo.track_rate(self.playlist[self.playnumber], rate)
+        return rate
+
+    def decay_tick(self):
+        self.decay_source = None
+        self.update_speed()
+        return GLib.SOURCE_REMOVE
 
     def bus_call(self, bus, message, loop):
+        with self.profiler.span('bus message', args={'type': Gst.MessageType.get_name(message.type)}):
+            return self.handle_message(message, loop)
+
+    def handle_message(self, message, loop):
         t = message.type
         if t == Gst.MessageType.EOS:
             sys.stdout.write("End-of-stream\n")
+            self.finished = True
             loop.quit()
+        elif t in (Gst.MessageType.DURATION_CHANGED, Gst.MessageType.ASYNC_DONE):
+            # the duration has changed or can now be known, invalidate the
+            # cached one
+            self.position.duration_changed()
+        elif t == Gst.MessageType.WARNING:
+            self.metrics.bus_warnings.inc()
         elif t == Gst.MessageType.ERROR:
             err, debug = message.parse_error()
+            self.metrics.bus_errors.inc()
             sys.stderr.write("Error: %s: %s\n" % (err, debug))
-            loop.quit()
+            if self.switcher.standby_error(message.src):
+                # only a track waiting its turn; it is skipped
+                return True
+            if not self.supervisor.error():
+                self.failed = True
+                loop.quit()
         return True
 
-    def start(self, args):
-        self.speed_refresh_delay = 0.25
-        self.playnumber = 0;
-        self.playlist = []
-
-        if len(args) < 2:
-            sys.stderr.write("usage: %s <media file or uri>\n" % args[0])
-            sys.exit(1)
-        else:
-            for arg in args[1:]:
-                if os.path.isfile(arg):
-                    self.playlist.append(os.path.realpath(arg))
-
-        print(self.playlist[0])
-
-        # take the commandline argument and ensure that it is a uri
-        self.source.set_property("location", self.playlist[0])
-
-        # start play back and listen to events
-        self.player.set_state(Gst.State.PLAYING)
-
-        while self.player.get_state(Gst.CLOCK_TIME_NONE)[1] in [Gst.State.PLAYING, Gst.State.PAUSED]:
-            try:
-                self.display()
-                self.speed.set_property("speed", self.multiplier + 0.25)
-                time.sleep(self.speed_refresh_delay)
-            except:
-                print('Exception in user code:')
-                print('-'*60)
-                traceback.print_exc(file=sys.stdout)
-                print('-'*60)
+    def preroll(self, options):
+        # one index query per directory; the walk for new or changed files
+        # and their tags happens in the background
+        self.library = library.from_options(options)
+        self.playlist = self.library.playlist(options.files)
+        self.library.rescan()
+        # where the checkpoint says, or from the top with --from-start
+        self.playnumber, position = self.supervisor.resume_point(self.playlist)
+
+        self.tempo = tempo.from_options(options, self.library, self.playlist)
+        if self.tempo is not None:
+            self.switcher.choose_next = lambda index: self.tempo.choose(index, self.multiplier + 0.25)
+
+        # start play back and listen to events; the main loop sleeps until a
+        # bus message, GPIO edge or signal needs handling
+        self.engine.set_rate(self.playback_rate())
+        self.position.set_rate(self.engine.rate)
+        # build the first track and its neighbours; they decode on their
+        # streaming threads while the caller sets up the hardware
+        self.supervisor.preroll(self.playnumber, position)
+
+    def start(self, options):
+        if self.playlist is None:
+            self.preroll(options)
+        self.telemetry.start()
+        self.profiler.start()
+        self.status.start()
+        self.control.start()
+        self.supervisor.start()
+        self.supervisor.play()
+        self.display()
+        self.loop.run()
+        self.supervisor.stop(self.finished)
+        self.control.stop()
+        self.status.stop()
+        self.profiler.stop()
+        self.telemetry.stop()
 
         self.player.set_state (Gst.State.NULL);
 
@@ -140,93 +295,150 @@ class MalvernStar_Player(object):
     #    self.was_playpause_held = False
 
     def playpause(self, number):
-        if self.player.get_state(0)[1] == Gst.State.PAUSED:
+        # against where a change still under way is heading, so two quick
+        # presses cancel out
+        state, pending = self.player.get_state(0)[1:]
+        if pending != Gst.State.VOID_PENDING:
+            state = pending
+        if state == Gst.State.PAUSED:
             self.player.set_state(Gst.State.PLAYING)
+            self.telemetry.record(telemetry.PLAY, track=self.playnumber)
+            self.control.emit('state', state='playing', track=self.playnumber)
         else:
             self.player.set_state(Gst.State.PAUSED)
+            self.telemetry.record(telemetry.PAUSE, track=self.playnumber)
+            self.control.emit('state', state='paused', track=self.playnumber)
         print("play / pause music playback")
 
     def skipnext(self, number):
-        if (self.playnumber<(len(self.playlist)-1)):
-            self.player.set_state(Gst.State.NULL)
-            self.playnumber=self.playnumber+1
-            self.source.set_property("location", self.playlist[self.playnumber])
-            self.player.set_state(Gst.State.PLAYING)
-            print(self.playlist[self.playnumber])
-        else:
+        if not self.switcher.skip():
             print("no next track")
 
     def skipprev(self, number):
-        if (self.playnumber>0):
-            self.player.set_state(Gst.State.NULL)
-            self.playnumber=self.playnumber-1
-            self.source.set_property("location", self.playlist[self.playnumber])
-            self.player.set_state(Gst.State.PLAYING)
-            print(self.playlist[self.playnumber])
-        else:
+        if not self.switcher.previous():
             print("no prev track")
 
+    def track_changed(self, index):
+        self.playnumber = index
+        self.telemetry.record(telemetry.TRACK, track=index)
+        self.control.emit('track', track=index, location=self.playlist[index])
+        self.position.track_changed()
+        if self.ladder is not None:
+            self.ladder.track_changed()
+        if self.buffering is not None:
+            self.buffering.track_changed()
+        if self.tempo is not None:
+            self.repicked = None
+            self.tempo.track_started(index)
+            self.engine.set_rate(self.playback_rate())
+            self.position.set_rate(self.engine.rate)
+        self.display()
+
     def cleanup(self):
         sys.stderr.write("cleaup called\n")
         self.player.set_state(Gst.State.NULL)
 
-    def signal_handler(self, signalNumber, frame):
-        print('received:', signalNumber)
+    def quit(self):
         self.cleanup()
-        sys.exit(0)
+        self.loop.quit()
+        return GLib.SOURCE_REMOVE
 
+    def signal_handler(self, signalNumber, frame=None):
+        print('received:', signalNumber)
+        return self.quit()
+
+    # the queue signals arrive on streaming threads
     def on_overrun(self, element):
         logging.debug('on_overrun')
+        self.metrics.overruns.inc()
+        self.telemetry.record(telemetry.OVERRUN)
 
     def on_underrun(self, element):
         logging.debug('on_underrun')
+        self.metrics.underrun()
+        self.telemetry.record(telemetry.UNDERRUN)
+        if self.buffering is not None:
+            self.buffering.underrun()
 
     def on_running(self, element):
         logging.debug('on_running')
+        self.metrics.running()
+        self.telemetry.record(telemetry.RUNNING)
 
     def on_pushing(self, element):
         logging.debug('on_pushing')
 
-if __name__ == '__main__':
+def parse_args(args):
+    parser = argparse.ArgumentParser(prog=args[0])
+    parser.add_argument('files', nargs='+', metavar='<media file, directory or m3u>')
+    parser.add_argument('--engine', choices=sorted(rate_engine.engines), default=engine_name,
+                        help="playback rate engine")
+    parser.add_argument('--quality', default=engine_quality,
+                        help="scaletempo preset (low, medium, high) or stride,overlap,search")
+    parser.add_argument('--ramp-time', type=float, default=ramp_time,
+                        help="seconds over which rate changes are ramped, 0 to jump")
+    parser.add_argument('--sink', default='alsasink', help="audio sink element, e.g. fakesink to run without a sound card")
+    parser.add_argument('--cache-dir', help="decode tracks once to PCM here and play them from the cache")
+    parser.add_argument('--cache-budget', type=int, default=pcm_cache.default_budget // (1024 * 1024),
+                        help="PCM cache size limit in MiB")
+    parser.add_argument('--predecode', type=int, default=pcm_cache.default_predecode,
+                        help="number of upcoming tracks to decode into the cache in the background")
+    hardware.add_arguments(parser)
+    library.add_arguments(parser)
+    tempo.add_arguments(parser)
+    metrics.add_arguments(parser)
+    telemetry.add_arguments(parser)
+    decoders.add_arguments(parser)
+    adaptive_buffer.add_arguments(parser)
+    rate_ladder.add_arguments(parser)
+    supervisor.add_arguments(parser)
+    status_display.add_arguments(parser)
+    profiler.add_arguments(parser)
+    control_api.add_arguments(parser)
+    return parser.parse_args(args[1:])
 
-    GObject.threads_init()
-    Gst.init(None)
-    loop = GObject.MainLoop()
-
-    app = MalvernStar_Player()
-
-    # register the signals to be caught
-    signal.signal(signal.SIGINT, app.signal_handler)
-    signal.signal(signal.SIGTERM, app.signal_handler)
-
-    GPIO.setmode(GPIO.BCM)
-    GPIO.setwarnings(False)
+if __name__ == '__main__':
 
-    GPIO.setup(hall_pin, GPIO.IN, pull_up_down = GPIO.PUD_UP)
-    GPIO.add_event_detect(hall_pin, GPIO.FALLING, callback = app.get_pulse, bouncetime=20)
+    options = parse_args(sys.argv)
+    supervisor.startup.mark('imports')
 
-    GPIO.setup(play_pin, GPIO.IN, pull_up_down = GPIO.PUD_UP)
-    GPIO.add_event_detect(play_pin, GPIO.FALLING, callback = app.playpause, bouncetime=500)
+    profiler.prepare(options)
+    Gst.init(None)
+    supervisor.startup.mark('gst_init')
+    loop = GLib.MainLoop()
 
-    GPIO.setup(prev_pin, GPIO.IN, pull_up_down = GPIO.PUD_UP)
-    GPIO.add_event_detect(prev_pin, GPIO.FALLING, callback = app.skipprev, bouncetime=500)
+    backend = hardware.from_options(options, hall_pin)
+    app = MalvernStar_Player(loop, options, backend)
+    supervisor.startup.mark('pipeline')
 
-    GPIO.setup(next_pin, GPIO.IN, pull_up_down = GPIO.PUD_UP)
-    GPIO.add_event_detect(next_pin, GPIO.FALLING, callback = app.skipnext, bouncetime=500)
+    # register the signals to be caught by the main loop
+    GLib.unix_signal_add(GLib.PRIORITY_HIGH, signal.SIGINT, app.signal_handler, signal.SIGINT)
+    GLib.unix_signal_add(GLib.PRIORITY_HIGH, signal.SIGTERM, app.signal_handler, signal.SIGTERM)
 
     try:
-        app.start(sys.argv)
+        # the first track decodes while the GPIO pins are set up
+        app.preroll(options)
+        supervisor.startup.mark('playlist')
+
+        backend.add_edge_callback(hall_pin, app.get_pulse, backend.pulse_bouncetime)
+        backend.add_edge_callback(play_pin, lambda number: GLib.idle_add(app.playpause, number), 500)
+        backend.add_edge_callback(prev_pin, lambda number: GLib.idle_add(app.skipprev, number), 500)
+        backend.add_edge_callback(next_pin, lambda number: GLib.idle_add(app.skipnext, number), 500)
+        if options.exit_after_trace:
+            backend.on_finished = lambda: GLib.idle_add(app.quit)
+        metrics.serve(app.metrics.registry, options.metrics_port, options.metrics_socket)
+        backend.start()
+        supervisor.startup.mark('hardware')
+
+        app.start(options)
     except:
+        app.failed = True
         print('Exception in user code:')
         print('-'*60)
         traceback.print_exc(file=sys.stdout)
         print('-'*60)
 
-    try:
-    # Loop until users quits with CTRL-C
-        while True:
-            time.sleep(0.5)
-
-    except KeyboardInterrupt:
-        # Reset GPIO settings
-        GPIO.cleanup()
+    # Reset GPIO settings
+    backend.cleanup()
+    # non-zero so supervisor.py or systemd restart us
+    sys.exit(1 if app.failed else 0)
@@ -0,0 +1,221 @@
+#!/usr/bin/python3
+
+# Status output for the players, kept off the control path.
+#
+# The control loop calls update() with the latest values, which only swaps
+# a dict; a display thread wakes --display-rate times a second, formats
+# whatever is latest and hands it to a renderer. A slow serial console or
+# journald pipe then only ever delays the display thread, never a rate
+# change, and intermediate values are simply skipped.
+#
+#   term  one line redrawn in place, rewriting only the fields that changed;
+#         anything else printed clears the line first, and the next
+#         refresh draws all of it again below
+#   line  a full line whenever something changed, for pipes and logs
+#   oled  an SSD1306 over I2C (adafruit-circuitpython-ssd1306 and Pillow)
+#   none  nothing
+#
+# auto picks term on a terminal and line otherwise.
+
+import sys, threading, traceback
+
+default_rate = 4.0
+
+class OutsideWriter(object):
+
+    # stands in for sys.stdout and sys.stderr while the terminal line is
+    # up, so the players' own messages and tracebacks do not land in the
+    # middle of it
+
+    def __init__(self, stream, renderer):
+        self.stream = stream
+        self.renderer = renderer
+
+    def write(self, text):
+        with self.renderer.lock:
+            self.renderer.clear()
+            return self.stream.write(text)
+
+    def __getattr__(self, name):
+        return getattr(self.stream, name)
+
+class TerminalRenderer(object):
+
+    def __init__(self, layout, stream=sys.stdout):
+        self.stream = stream
+        self.columns = {}
+        column = 0
+        for name, _, width in layout:
+            self.columns[name] = (column, width)
+            column += width + 1
+        self.drawn = False
+        self.lock = threading.Lock()
+        self.outside = (sys.stdout, sys.stderr)
+        sys.stdout = OutsideWriter(sys.stdout, self)
+        sys.stderr = OutsideWriter(sys.stderr, self)
+
+    def stale(self):
+        return not self.drawn
+
+    def clear(self):
+        # with the lock held
+        if self.drawn:
+            self.stream.write("\r\x1b[K")
+            self.stream.flush()
+            self.drawn = False
+
+    def render(self, texts, changed):
+        with self.lock:
+            if not self.drawn:
+                changed = list(texts)
+                self.drawn = True
+            out = []
+            for name in changed:
+                column, width = self.columns[name]
+                # back to the start of the line, then across to the field
+                out.append("\r\x1b[%dC" % column if column else "\r")
+                out.append(texts[name][:width].ljust(width))
+            self.stream.write("".join(out))
+            self.stream.flush()
+
+    def close(self):
+        with self.lock:
+            sys.stdout, sys.stderr = self.outside
+            if self.drawn:
+                self.stream.write("\n")
+                self.stream.flush()
+
+class LineRenderer(object):
+
+    def __init__(self, layout, stream=sys.stdout):
+        self.stream = stream
+        self.names = [name for name, _, _ in layout]
+
+    def stale(self):
+        return False
+
+    def render(self, texts, changed):
+        self.stream.write("\t".join(texts[name] for name in self.names) + "\n")
+        self.stream.flush()
+
+    def close(self):
+        pass
+
+class OledRenderer(object):
+
+    # one field per row of 8 pixel text
+
+    def __init__(self, layout, width=128, height=64, address=0x3c):
+        import board
+        import busio
+        import adafruit_ssd1306
+        from PIL import Image, ImageDraw, ImageFont
+
+        self.names = [name for name, _, _ in layout][:height // 8]
+        self.oled = adafruit_ssd1306.SSD1306_I2C(width, height, busio.I2C(board.SCL, board.SDA), addr=address)
+        self.image = Image.new("1", (width, height))
+        self.draw = ImageDraw.Draw(self.image)
+        self.font = ImageFont.load_default()
+        self.width = width
+        self.height = height
+
+    def stale(self):
+        return False
+
+    def render(self, texts, changed):
+        self.draw.rectangle((0, 0, self.width, self.height), outline=0, fill=0)
+        for row, name in enumerate(self.names):
+            self.draw.text((0, row * 8), texts[name], font=self.font, fill=255)
+        self.oled.image(self.image)
+        self.oled.show()
+
+    def close(self):
+        self.oled.fill(0)
+        self.oled.show()
+
+class NullRenderer(object):
+
+    def stale(self):
+        return False
+
+    def render(self, texts, changed):
+        pass
+
+    def close(self):
+        pass
+
+class StatusDisplay(object):
+
+    def __init__(self, layout, renderer, rate=default_rate, poll=None):
+        # layout is a list of (field, format, width); poll, if given, is
+        # called on the display thread for values that change on their own,
+        # such as the track position
+        self.layout = layout
+        self.renderer = renderer
+        self.interval = 1.0 / rate
+        self.poll = poll
+        self.latest = {}
+        self.shown = {}
+        self.lock = threading.Lock()
+        self.stopping = threading.Event()
+        self.thread = None
+
+    def update(self, **fields):
+        # replaced, never modified, so the display thread reads a
+        # consistent set; locked, as the bus, control loop and control
+        # socket all update
+        with self.lock:
+            latest = dict(self.latest)
+            latest.update(fields)
+            self.latest = latest
+
+    def start(self):
+        self.thread = threading.Thread(target=self.run, name="status-display", daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        self.stopping.set()
+        if self.thread is not None:
+            self.thread.join(1.0)
+        self.renderer.close()
+
+    def format(self, fields):
+        texts = {}
+        for name, form, width in self.layout:
+            value = fields.get(name)
+            texts[name] = "-" if value is None else form.format(value)
+        return texts
+
+    def run(self):
+        while not self.stopping.wait(self.interval):
+            try:
+                fields = self.latest
+                if self.poll is not None:
+                    fields = dict(fields)
+                    fields.update(self.poll())
+                texts = self.format(fields)
+                changed = [name for name in texts if texts[name] != self.shown.get(name)]
+                if changed or self.renderer.stale():
+                    self.renderer.render(texts, changed)
+                    self.shown = texts
+            except Exception:
+                traceback.print_exc(file=sys.stderr)
+
+def add_arguments(parser):
+    parser.add_argument('--display', choices=['auto', 'term', 'line', 'oled', 'none'], default='auto',
+                        help="where the status goes")
+    parser.add_argument('--display-rate', type=float, default=default_rate, help="status refreshes per second")
+
+def from_options(options, layout, poll=None):
+    kind = options.display
+    if kind == 'auto':
+        kind = 'term' if sys.stdout.isatty() else 'line'
+    if kind == 'term':
+        renderer = TerminalRenderer(layout)
+    elif kind == 'line':
+        renderer = LineRenderer(layout)
+    elif kind == 'oled':
+        renderer = OledRenderer(layout)
+    else:
+        renderer = NullRenderer()
+    return StatusDisplay(layout, renderer, options.display_rate, poll)
@@ -0,0 +1,348 @@
+#!/usr/bin/python3
+
+# Keeping the GStreamer players playing through errors and restarts.
+#
+# With --state-file the player checkpoints the current track and position
+# about once a second: a few dozen bytes of JSON written to a temporary
+# file and renamed over the old one, so a crash or power cut leaves either
+# the old checkpoint or the new one, never half of one. The position comes
+# from PositionTracker, so checkpointing costs no pipeline query.
+#
+# An ERROR on the bus no longer ends the player. The pipeline is taken
+# down to NULL, the track rebuilt, and a flushing seek sent to its branch
+# alone while the pipeline is still PAUSED, so playback restarts where it
+# broke off. A track that fails max_track_failures times in
+# recovery_window seconds is taken to be a bad file and skipped, the next
+# one starting from the top with a clean count. More than max_recoveries
+# in recovery_window seconds otherwise, or every track skipped, and the
+# player gives up and exits with an error. A player started afresh picks
+# up from the checkpoint the same way, unless given --from-start.
+#
+# The waits for the pipeline to pre-roll, before and after the seek, poll
+# from the main loop rather than block it, for at most preroll_timeout
+# each.
+#
+# Either way the time from the decision to rebuild, or from the process
+# starting, to the first buffer reaching the sink is printed as time to
+# audio; it should be well under a second.
+#
+# On a cold start the players mark each phase on startup as they go, and
+# the time to audio comes with a breakdown of where it went: imports,
+# Gst.init, building the pipeline, reading the playlist, hardware setup,
+# and the wait for the first track to pre-roll. The first track, or the
+# checkpointed one, is set pre-rolling before the hardware
+# is set up, so its decoding overlaps the GPIO and ADC setup.
+#
+# Run this file to restart a player that exits with an error, for setups
+# without systemd:
+#
+#   python3 supervisor.py speedo_player.py --state-file ride.json /srv/music
+
+import sys, os, json, time, subprocess
+
+import gi
+
+gi.require_version('Gst', '1.0')
+from gi.repository import GLib, Gst
+
+checkpoint_interval = 1.0
+preroll_timeout = 5.0
+preroll_poll_ms = 10
+max_recoveries = 5
+max_track_failures = 3
+recovery_window = 60.0
+restart_delay = 1.0
+
+def process_age():
+    # seconds since this process started, from the kernel's own record
+    try:
+        with open("/proc/self/stat") as f:
+            # the command name can hold spaces; count from after it
+            fields = f.read().rsplit(")", 1)[1].split()
+        with open("/proc/uptime") as f:
+            uptime = float(f.read().split()[0])
+        return uptime - int(fields[19]) / os.sysconf('SC_CLK_TCK')
+    except (OSError, ValueError, IndexError):
+        return None
+
+class Startup(object):
+
+    def __init__(self):
+        # (phase, monotonic time it ended), in order
+        self.phases = []
+        self.breakdown = None
+
+    def mark(self, phase):
+        self.phases.append((phase, time.monotonic()))
+
+    def report(self, now):
+        # ms spent in each phase, the first counted from the process
+        # starting, and the total
+        age = process_age()
+        if age is None:
+            return None
+        previous = now - age
+        breakdown = []
+        for phase, stamp in self.phases + [('first_audio', now)]:
+            breakdown.append((phase, (stamp - previous) * 1000))
+            previous = stamp
+        breakdown.append(('total', age * 1000))
+        self.breakdown = breakdown
+        return breakdown
+
+startup = Startup()
+
+class Checkpoint(object):
+
+    def __init__(self, path):
+        self.path = path
+        self.last = None
+
+    def load(self):
+        try:
+            with open(self.path) as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return None
+
+    def save(self, state):
+        if state == self.last:
+            return
+        tmp = self.path + ".tmp"
+        with open(tmp, "w") as f:
+            json.dump(state, f)
+        os.replace(tmp, self.path)
+        self.last = state
+
+    def clear(self):
+        self.last = None
+        try:
+            os.unlink(self.path)
+        except OSError:
+            pass
+
+class Supervisor(object):
+
+    # works on the attributes the GStreamer players have in common: player,
+    # switcher, position, engine, sink, buffering, playlist, playnumber,
+    # loop and failed
+
+    def __init__(self, app, options):
+        self.app = app
+        self.checkpoint = Checkpoint(options.state_file) if options.state_file else None
+        self.resume = options.resume
+        self.recoveries = []
+        # the track that failed last, and when it did within the window
+        self.failing = None
+        self.track_failures = []
+        # tracks skipped since audio last reached the sink
+        self.skipped = 0
+        self.source = None
+        self.rebuild_pending = False
+        self.rebuild_started = None
+        self.preroll_position = 0
+        self.first_buffer_probe = None
+        # polling for the pre-roll: its source, deadline and what follows
+        self.wait_source = None
+        self.wait_deadline = None
+        self.wait_then = None
+
+    def resume_point(self, playlist):
+        # (index, position) to start from
+        if not self.resume or self.checkpoint is None:
+            return 0, 0
+        state = self.checkpoint.load()
+        if state is None:
+            return 0, 0
+        index = state.get('index', 0)
+        if not 0 <= index < len(playlist) or playlist[index] != state.get('location'):
+            # the playlist has changed; find the track by name
+            if state.get('location') not in playlist:
+                return 0, 0
+            index = playlist.index(state['location'])
+        sys.stdout.write("resuming %s at %.1f s\n" % (playlist[index], state.get('position', 0) / 1e9))
+        return index, state.get('position', 0)
+
+    def start(self):
+        if self.checkpoint is not None:
+            self.source = GLib.timeout_add(int(checkpoint_interval * 1000), self.save)
+
+    def stop(self, finished=False):
+        if self.source is not None:
+            GLib.source_remove(self.source)
+            self.source = None
+        if self.checkpoint is not None:
+            if finished:
+                # played to the end, so there is nothing to resume
+                self.checkpoint.clear()
+            else:
+                self.save()
+
+    def save(self):
+        app = self.app
+        if app.switcher.current is None:
+            return True
+        try:
+            self.checkpoint.save({
+                'index': app.playnumber,
+                'location': app.playlist[app.playnumber],
+                'position': app.position.position(),
+                'rate': app.engine.rate,
+            })
+        except OSError as e:
+            sys.stderr.write("checkpoint: %s\n" % e)
+        return True
+
+    def play_from(self, index, position, started=None):
+        # build the track at index and start playing it position ns in;
+        # called from the main loop with the pipeline in NULL
+        self.preroll(index, position, started)
+        self.play()
+
+    def preroll(self, index, position, started=None):
+        # build the track and set it decoding, without waiting for it
+        app = self.app
+        self.rebuild_started = started
+        if self.wait_source is not None:
+            # a rebuild while the last one was still pre-rolling
+            GLib.source_remove(self.wait_source)
+            self.wait_source = None
+        app.switcher.start(app.playlist, index)
+        app.player.set_state(Gst.State.PAUSED)
+        self.preroll_position = position
+
+    def play(self):
+        # once pre-rolled, seek to the position given to preroll and play
+        position, self.preroll_position = self.preroll_position, 0
+        if position:
+            self.wait_preroll(lambda: self.seek(position))
+        else:
+            self.start_playing()
+
+    def seek(self, position):
+        if self.app.switcher.seek(position):
+            self.wait_preroll(lambda: self.seeked(position))
+        else:
+            self.start_playing()
+
+    def seeked(self, position):
+        self.app.position.track_changed(position)
+        self.start_playing()
+
+    def start_playing(self):
+        # the pre-roll buffer, before or after the seek, is not yet audio
+        self.watch_first_buffer()
+        self.app.player.set_state(Gst.State.PLAYING)
+        if startup.breakdown is None:
+            startup.mark('play')
+
+    def wait_preroll(self, then):
+        self.wait_deadline = time.monotonic() + preroll_timeout
+        self.wait_then = then
+        self.wait_source = GLib.timeout_add(preroll_poll_ms, self.poll_preroll)
+
+    def poll_preroll(self):
+        if (self.app.player.get_state(0)[0] == Gst.StateChangeReturn.ASYNC
+                and time.monotonic() < self.wait_deadline):
+            return GLib.SOURCE_CONTINUE
+        self.wait_source = None
+        self.wait_then()
+        return GLib.SOURCE_REMOVE
+
+    def error(self):
+        # an ERROR on the bus; returns False when it is time to give up
+        if self.rebuild_pending:
+            # one failure tends to post several errors
+            return True
+        now = time.monotonic()
+        self.recoveries = [stamp for stamp in self.recoveries if now - stamp < recovery_window] + [now]
+        if len(self.recoveries) > max_recoveries:
+            sys.stderr.write("giving up after %d errors in %.0f s\n" % (len(self.recoveries) - 1, recovery_window))
+            return False
+        self.rebuild_pending = True
+        GLib.idle_add(self.rebuild, now, priority=GLib.PRIORITY_HIGH)
+        return True
+
+    def rebuild(self, started):
+        self.rebuild_pending = False
+        app = self.app
+        index, position = app.playnumber, app.position.position()
+        if self.failed_too_often(index, started):
+            index, position = app.switcher.next_index(index), 0
+            self.skipped += 1
+            if index is None or self.skipped >= len(app.playlist):
+                sys.stderr.write("giving up, no track left to skip to\n")
+                app.failed = True
+                app.loop.quit()
+                return GLib.SOURCE_REMOVE
+            sys.stderr.write("skipping track %d after %d errors\n" % (app.playnumber, max_track_failures))
+            self.failing = None
+            self.track_failures = []
+            self.recoveries = []
+        sys.stderr.write("rebuilding the pipeline at track %d, %.1f s\n" % (index, position / 1e9))
+        app.player.set_state(Gst.State.NULL)
+        if app.buffering is not None:
+            app.buffering.stopped()
+        app.switcher.reset()
+        app.metrics.recoveries.inc()
+        self.play_from(index, position, started)
+        return GLib.SOURCE_REMOVE
+
+    def failed_too_often(self, index, now):
+        if index != self.failing:
+            self.failing = index
+            self.track_failures = []
+        self.track_failures = [stamp for stamp in self.track_failures if now - stamp < recovery_window] + [now]
+        return len(self.track_failures) >= max_track_failures
+
+    def watch_first_buffer(self):
+        pad = self.app.sink.get_static_pad("sink")
+        if self.first_buffer_probe is not None:
+            # rebuilt again before any audio came through
+            pad.remove_probe(self.first_buffer_probe)
+        self.first_buffer_probe = pad.add_probe(Gst.PadProbeType.BUFFER, self.on_first_buffer)
+
+    def on_first_buffer(self, pad, info):
+        if self.app.sink.get_state(0)[1] != Gst.State.PLAYING:
+            # still pre-rolling; the sink holds this one until PLAYING
+            return Gst.PadProbeReturn.OK
+        self.first_buffer_probe = None
+        self.skipped = 0
+        if self.rebuild_started is not None:
+            seconds = time.monotonic() - self.rebuild_started
+            sys.stdout.write("time to audio: %.0f ms after rebuilding\n" % (seconds * 1000))
+            self.app.metrics.recovery_seconds.observe(seconds)
+        elif startup.breakdown is None:
+            breakdown = startup.report(time.monotonic())
+            if breakdown is not None:
+                sys.stdout.write("time to audio: %.0f ms after process start (%s)\n" % (
+                    breakdown[-1][1], ", ".join("%s %.0f ms" % phase for phase in breakdown[:-1])))
+        # read through a pipe by benchmark.py and supervisors
+        sys.stdout.flush()
+        return Gst.PadProbeReturn.REMOVE
+
+def add_arguments(parser):
+    parser.add_argument('--state-file', help="checkpoint the track and position here about once a second")
+    parser.add_argument('--resume', action='store_true', default=True,
+                        help="start from the checkpoint in --state-file (the default)")
+    parser.add_argument('--from-start', dest='resume', action='store_false',
+                        help="start from the top of the playlist whatever --state-file says")
+
+def main(args):
+    # supervisor.py player.py [player arguments]
+    if len(args) < 2:
+        sys.stderr.write("usage: %s player.py [arguments]\n" % args[0])
+        return 2
+    command = [sys.executable] + args[1:]
+    while True:
+        code = subprocess.call(command)
+        if code == 0 or code < 0 and -code in (2, 15):
+            # a clean exit, or SIGINT / SIGTERM
+            return 0
+        sys.stderr.write("player exited with %d, restarting\n" % code)
+        time.sleep(restart_delay)
+        if '--from-start' in command:
+            command.remove('--from-start')
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv))
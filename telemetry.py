@@ -0,0 +1,237 @@
+#!/usr/bin/python3
+
+# Ride telemetry: a compact binary log written off the control path, and a
+# tool to summarise months of it.
+#
+# Every record is 20 bytes, little endian:
+#
+#   time   float64  seconds since the epoch
+#   kind   uint8    see below
+#   bike   uint8    bike number, 0 outside multibike.py
+#   track  uint16   playlist index, 65535 for any past the end of the range
+#   a, b   float32  depend on the kind
+#
+#   START     a session starts; a is the format version
+#   PULSE     a hall sensor edge
+#   RATE      a is the RPM (or trimpot volts), b the rate applied
+#   TRACK     a new track started playing
+#   UNDERRUN  the queue ahead of the rate engine ran dry
+#   RUNNING   it has data again
+#   OVERRUN   it filled up
+#   PAUSE, PLAY
+#
+# record() only appends to a deque, so it is safe to call from GPIO and
+# streaming threads; a writer thread drains it to the file every
+# flush_interval. Should the writer fall behind or fail, the oldest records
+# go once max_pending are waiting. Run this file to summarise a log:
+#
+#   python3 telemetry.py ride.log --since 2026-01-01
+
+import sys, os, time, struct, argparse, threading, collections, traceback
+
+version = 1
+flush_interval = 0.5
+max_pending = 100000
+
+record_format = struct.Struct('<dBBHff')
+record_dtype = [('time', '<f8'), ('kind', 'u1'), ('bike', 'u1'), ('track', '<u2'), ('a', '<f4'), ('b', '<f4')]
+
+START, PULSE, RATE, TRACK, UNDERRUN, RUNNING, OVERRUN, PAUSE, PLAY = range(9)
+
+class Recorder(object):
+
+    def __init__(self, path, clock=time.monotonic):
+        self.path = path
+        # maps the backend's clock, which pulses are stamped with, to epoch
+        # time
+        self.offset = time.time() - clock()
+        self.clock = clock
+        self.pending = collections.deque(maxlen=max_pending)
+        self.stopping = threading.Event()
+        self.thread = None
+
+    def record(self, kind, a=0.0, b=0.0, track=0, bike=0, stamp=None):
+        if stamp is None:
+            stamp = self.clock()
+        # clamped to the record's fields, which would otherwise refuse them
+        self.pending.append((stamp + self.offset, kind, min(max(bike, 0), 0xff),
+                             min(max(track, 0), 0xffff), a, b))
+
+    def start(self):
+        self.record(START, version)
+        self.thread = threading.Thread(target=self.run, name="telemetry", daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        self.stopping.set()
+        if self.thread is not None:
+            self.thread.join()
+
+    def run(self):
+        try:
+            f = open(self.path, "ab")
+        except OSError:
+            traceback.print_exc(file=sys.stderr)
+            return
+        with f:
+            while True:
+                stopping = self.stopping.wait(flush_interval)
+                try:
+                    self.drain(f)
+                except Exception:
+                    traceback.print_exc(file=sys.stderr)
+                if stopping:
+                    break
+
+    def drain(self, f):
+        if not self.pending:
+            return
+        data = bytearray()
+        while self.pending:
+            record = self.pending.popleft()
+            try:
+                data += record_format.pack(*record)
+            except struct.error:
+                sys.stderr.write("telemetry: dropping %r\n" % (record,))
+        f.write(data)
+        f.flush()
+
+class NullRecorder(object):
+
+    def record(self, kind, a=0.0, b=0.0, track=0, bike=0, stamp=None):
+        pass
+
+    def start(self):
+        pass
+
+    def stop(self):
+        pass
+
+def add_arguments(parser):
+    parser.add_argument('--telemetry', help="append ride telemetry to this binary log")
+
+def from_options(options, clock=time.monotonic):
+    if options.telemetry is None:
+        return NullRecorder()
+    return Recorder(options.telemetry, clock)
+
+def load(path):
+    import numpy
+    count = os.path.getsize(path) // record_format.size
+    if count == 0:
+        return numpy.zeros(0, dtype=record_dtype)
+    # a record still being written at the end is left out
+    return numpy.memmap(path, dtype=record_dtype, mode='r', shape=(count,))
+
+def parse_date(text):
+    return time.mktime(time.strptime(text, "%Y-%m-%d"))
+
+def time_weighted(records, field, bins, max_gap):
+    # seconds spent in each bin, each RATE record holding until the next
+    # one for the same bike, or for at most max_gap
+    import numpy
+    seconds = numpy.zeros(len(bins) - 1)
+    for bike in numpy.unique(records['bike']):
+        rates = records[records['bike'] == bike]
+        if len(rates) < 2:
+            continue
+        held = numpy.minimum(numpy.diff(rates['time']), max_gap)
+        # float32 in the log; round so 1.3 lands in the 1.3 bin
+        values = numpy.round(rates[field][:-1].astype('<f8'), 4)
+        seconds += numpy.histogram(values, bins=bins, weights=held)[0]
+    return seconds
+
+def summary(log, circumference, max_gap=5.0):
+    import numpy
+
+    result = {}
+    result['records'] = len(log)
+    result['sessions'] = int(numpy.count_nonzero(log['kind'] == START))
+    if len(log):
+        result['first'] = time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(log['time'].min()))
+        result['last'] = time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(log['time'].max()))
+
+    pulses = log[log['kind'] == PULSE]
+    result['distance_km'] = len(pulses) * circumference / 1000.0
+    bikes, counts = numpy.unique(pulses['bike'], return_counts=True)
+    result['distance_km_by_bike'] = dict((int(bike), count * circumference / 1000.0)
+                                         for bike, count in zip(bikes, counts))
+
+    rates = log[log['kind'] == RATE]
+    rpm_bins = numpy.arange(0, 310, 10)
+    rate_bins = numpy.round(numpy.arange(0.0, 3.1, 0.1), 2)
+    result['cadence_seconds'] = time_weighted(rates, 'a', rpm_bins, max_gap)
+    result['rate_seconds'] = time_weighted(rates, 'b', rate_bins, max_gap)
+    result['rpm_bins'] = rpm_bins
+    result['rate_bins'] = rate_bins
+
+    # pair each underrun with the next RUNNING on the same bike
+    events = log[(log['kind'] == UNDERRUN) | (log['kind'] == RUNNING)]
+    underruns = []
+    for bike in numpy.unique(events['bike']):
+        bike_events = events[events['bike'] == bike]
+        starts = numpy.flatnonzero(bike_events['kind'] == UNDERRUN)
+        for start in starts:
+            following = bike_events[start + 1:start + 2]
+            if len(following) and following['kind'][0] == RUNNING:
+                duration = float(following['time'][0] - bike_events['time'][start])
+            else:
+                duration = None
+            underruns.append((float(bike_events['time'][start]), int(bike), duration))
+    result['underruns'] = sorted(underruns)
+    return result
+
+def print_histogram(title, bins, seconds, unit):
+    total = seconds.sum()
+    print(title)
+    if not total:
+        print("  (no data)")
+        return
+    for low, high, value in zip(bins, bins[1:], seconds):
+        if value:
+            bar = '#' * int(round(40 * value / seconds.max()))
+            print("  %6.2f-%-6.2f%s %9.0f s %5.1f%%  %s" % (low, high, unit, value, 100 * value / total, bar))
+
+def main(args):
+    parser = argparse.ArgumentParser(prog=args[0], description="summarise a ride telemetry log")
+    parser.add_argument('log')
+    parser.add_argument('--since', type=parse_date, help="YYYY-MM-DD")
+    parser.add_argument('--until', type=parse_date, help="YYYY-MM-DD")
+    parser.add_argument('--bike', type=int, help="only this bike")
+    parser.add_argument('--circumference', type=float, default=2.1, help="wheel circumference in metres")
+    parser.add_argument('--underruns', type=int, default=20, help="underruns to list, most recent first")
+    options = parser.parse_args(args[1:])
+
+    started = time.monotonic()
+    log = load(options.log)
+    keep = None
+    if options.since is not None:
+        keep = log['time'] >= options.since
+    if options.until is not None:
+        until = log['time'] < options.until
+        keep = until if keep is None else keep & until
+    if options.bike is not None:
+        bike = log['bike'] == options.bike
+        keep = bike if keep is None else keep & bike
+    if keep is not None:
+        log = log[keep]
+
+    result = summary(log, options.circumference)
+    print("%d records, %d sessions" % (result['records'], result['sessions']))
+    if result['records']:
+        print("from %s to %s" % (result['first'], result['last']))
+    print("distance: %.1f km" % result['distance_km'])
+    for bike, distance in sorted(result['distance_km_by_bike'].items()):
+        print("  bike %d: %.1f km" % (bike, distance))
+    print_histogram("cadence:", result['rpm_bins'], result['cadence_seconds'], " rpm")
+    print_histogram("time at rate:", result['rate_bins'], result['rate_seconds'], "x")
+
+    underruns = result['underruns']
+    print("underruns: %d" % len(underruns))
+    for stamp, bike, duration in reversed(underruns[-options.underruns:]):
+        print("  %s  bike %d  %s" % (time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(stamp)), bike,
+                                    "%.3f s" % duration if duration is not None else "-"))
+    sys.stderr.write("summarised in %.2f s\n" % (time.monotonic() - started))
+
+if __name__ == '__main__':
+    main(sys.argv)
@@ -0,0 +1,224 @@
+#!/usr/bin/python3
+
+# Track tempo for cadence-matched playback.
+#
+# Run offline to analyse the library; each track is decoded to mono PCM
+# by a niced gst-launch-1.0 child, and the tempo is the strongest
+# autocorrelation peak of its spectral-flux onset envelope. Results go
+# into the library index alongside the track's tags:
+#
+#   python3 tempo.py ~/Music
+#
+# At run time the players' --select tempo mode uses TempoSelector: the
+# RPM-derived rate multiplier times --reference-bpm is the tempo the rider
+# wants, the next track is the one whose tempo is nearest to it, and the
+# track is played at target / native so it stays close to 1.0x. Tempos are
+# compared in octaves, folded, so a 70 BPM track can stand in for 140.
+# The octave is settled once, when the track is picked, and kept while it
+# plays, so the rate still rises steadily with the cadence. The pick is
+# made again about_to_finish seconds before the end of the track, from the
+# cadence of the moment.
+
+import sys, os, math, time, argparse
+
+import library
+import profiler
+
+analysis_rate = 11025
+frame_size = 1024
+hop_size = 256
+max_seconds = 120
+min_bpm = 40.0
+max_bpm = 240.0
+analysis_niceness = 10
+
+default_reference = 120.0
+default_min_confidence = 0.2
+# seconds before the end of a track at which the next one is picked again
+about_to_finish = 15.0
+
+def decode(path, seconds=max_seconds):
+    import subprocess
+    import numpy
+    from pcm_cache import launch_location
+
+    command = ["nice", "-n", str(analysis_niceness), "gst-launch-1.0", "-q",
+               "filesrc", launch_location(path), "!", "decodebin", "!",
+               "audioconvert", "!", "audioresample", "!",
+               "audio/x-raw,format=S16LE,layout=interleaved,rate=%d,channels=1" % analysis_rate, "!",
+               "fdsink", "fd=1"]
+    child = subprocess.Popen(command, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL,
+                             env=profiler.child_environment())
+    # a couple of minutes is plenty to find the beat
+    data = child.stdout.read(seconds * analysis_rate * 2)
+    child.kill()
+    child.wait()
+    return numpy.frombuffer(data[:len(data) // 2 * 2], dtype='<i2').astype(numpy.float32) / 32768.0
+
+def onset_envelope(samples):
+    import numpy
+
+    frames = numpy.lib.stride_tricks.sliding_window_view(samples, frame_size)[::hop_size]
+    spectrum = numpy.abs(numpy.fft.rfft(frames * numpy.hanning(frame_size), axis=1))
+    spectrum = numpy.log1p(1000.0 * spectrum)
+    flux = numpy.maximum(numpy.diff(spectrum, axis=0), 0.0).sum(axis=1)
+    # drop the slow loudness changes, keep the attacks
+    window = max(1, int(analysis_rate / hop_size))
+    flux = flux - numpy.convolve(flux, numpy.ones(window) / window, mode='same')
+    return numpy.maximum(flux, 0.0)
+
+def estimate(envelope):
+    # returns (bpm, confidence), confidence being the normalised
+    # autocorrelation at the beat period
+    import numpy
+
+    fps = float(analysis_rate) / hop_size
+    count = len(envelope)
+    low = int(60.0 * fps / max_bpm)
+    high = int(math.ceil(60.0 * fps / min_bpm))
+    if count < high * 4:
+        return None, 0.0
+
+    envelope = envelope - envelope.mean()
+    spectrum = numpy.fft.rfft(envelope, 2 * count)
+    correlation = numpy.fft.irfft(spectrum * numpy.conj(spectrum))[:count]
+    if correlation[0] <= 0:
+        return None, 0.0
+
+    lags = numpy.arange(low, high + 1)
+    # mild preference for tempos around 120 so the octave is sensible
+    prior = numpy.exp(-0.5 * numpy.log2(60.0 * fps / lags / 120.0) ** 2)
+    best = int(lags[numpy.argmax(correlation[lags] * prior)])
+
+    # parabolic interpolation between neighbouring lags
+    lag = float(best)
+    a, b, c = correlation[best - 1], correlation[best], correlation[best + 1]
+    if a - 2 * b + c < 0:
+        lag += 0.5 * (a - c) / (a - 2 * b + c)
+    confidence = float(max(0.0, min(1.0, b / correlation[0])))
+    return float(60.0 * fps / lag), confidence
+
+def analyse(path):
+    try:
+        return estimate(onset_envelope(decode(path)))
+    except Exception as e:
+        sys.stderr.write("tempo: could not analyse %s: %s\n" % (path, e))
+        return None, 0.0
+
+def octave_distance(bpm, target):
+    # distance in octaves, with whole octaves folded away
+    octaves = math.log2(bpm / target)
+    return abs(octaves - round(octaves))
+
+def octave(bpm, target):
+    # the power of two taking bpm nearest to target
+    return 2.0 ** -round(math.log2(bpm / target))
+
+def folded(bpm, target):
+    # the octave of bpm nearest to target
+    return bpm * octave(bpm, target)
+
+class TempoSelector(object):
+
+    def __init__(self, tempos, playlist, reference=default_reference, min_confidence=default_min_confidence):
+        self.playlist = playlist
+        self.reference = reference
+        self.bpm = {}
+        for path, (bpm, confidence) in tempos.items():
+            if bpm and (confidence or 0.0) >= min_confidence:
+                self.bpm[path] = bpm
+        self.played = set()
+        # the octave each track plays in, settled when it is picked
+        self.octaves = {}
+
+    def target(self, multiplier):
+        return multiplier * self.reference
+
+    def fold_target(self, multiplier):
+        # a wheel just stopping or spinning wildly should not settle a
+        # track four times too fast or slow for the rest of it
+        return self.target(min(max(multiplier, 0.5), 2.0))
+
+    def track_rate(self, path, multiplier):
+        bpm = self.bpm.get(path)
+        if bpm is None:
+            return multiplier
+        if path not in self.octaves:
+            # not picked by us: the first track, or one gone back to
+            self.octaves[path] = octave(bpm, self.reference)
+        return self.target(multiplier) / (bpm * self.octaves[path])
+
+    def track_started(self, index):
+        self.played.add(index)
+        if len(self.played) >= len(self.playlist):
+            self.played = set([index])
+
+    def choose(self, index, multiplier):
+        # nearest tempo among the tracks not played yet this round, other
+        # than index; tracks without a tempo only come up once the analysed
+        # ones run out
+        target = self.target(multiplier)
+        best = None
+        for candidate, path in enumerate(self.playlist):
+            if candidate == index or candidate in self.played:
+                continue
+            bpm = self.bpm.get(path)
+            distance = octave_distance(bpm, target) if bpm else 1.0
+            if best is None or distance < best[0]:
+                best = (distance, candidate)
+        if best is None:
+            # all played this round
+            others = [candidate for candidate in range(len(self.playlist)) if candidate != index]
+            if not others:
+                return None
+            self.played = set([index])
+            return self.choose(index, multiplier)
+        path = self.playlist[best[1]]
+        if path in self.bpm:
+            self.octaves[path] = octave(self.bpm[path], self.fold_target(multiplier))
+        return best[1]
+
+def add_arguments(parser):
+    parser.add_argument('--select', choices=['order', 'tempo'], default='order',
+                        help="next track in playlist order, or the one nearest the cadence's tempo")
+    parser.add_argument('--reference-bpm', type=float, default=default_reference,
+                        help="tempo wanted at a 1.0x rate multiplier with --select tempo")
+
+def from_options(options, library_index, playlist):
+    if options.select != 'tempo':
+        return None
+    return TempoSelector(library_index.tempos(), playlist, options.reference_bpm)
+
+def main(args):
+    # only for analysis; the players import this module at startup
+    from concurrent.futures import ProcessPoolExecutor
+
+    parser = argparse.ArgumentParser(prog=args[0], description="analyse track tempos into the library index")
+    parser.add_argument('files', nargs='+', metavar='<media file, directory or m3u>')
+    parser.add_argument('--workers', type=int, default=os.cpu_count() or 1, help="analysis processes")
+    parser.add_argument('--force', action='store_true', help="analyse tracks that already have a tempo")
+    library.add_arguments(parser)
+    options = parser.parse_args(args[1:])
+
+    index = library.from_options(options)
+    playlist = index.playlist(options.files)
+    index.update_loose(index.db)
+    paths = []
+    for path in playlist:
+        track = index.track(path)
+        if options.force or track is None or track['bpm'] is None:
+            paths.append(path)
+
+    started = time.monotonic()
+    with ProcessPoolExecutor(max_workers=options.workers) as pool:
+        for path, (bpm, confidence) in zip(paths, pool.map(analyse, paths)):
+            if bpm is None:
+                continue
+            print("%6.1f\t%.2f\t%s" % (bpm, confidence, path))
+            index.db.execute("update tracks set bpm = ?, beat_confidence = ? where path = ?",
+                             (bpm, confidence, path))
+            index.db.commit()
+    sys.stderr.write("analysed %d tracks in %.1f s\n" % (len(paths), time.monotonic() - started))
+
+if __name__ == '__main__':
+    main(sys.argv)
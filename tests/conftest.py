@@ -0,0 +1,5 @@
+# The modules live flat at the top of the tree, next to this directory.
+
+import os, sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
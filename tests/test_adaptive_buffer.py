@@ -0,0 +1,99 @@
+import pytest
+
+pytest.importorskip('gi')
+import gi
+try:
+    gi.require_version('Gst', '1.0')
+except ValueError:
+    pytest.skip("GStreamer is not installed", allow_module_level=True)
+from gi.repository import Gst
+
+import adaptive_buffer
+
+class FakeElement(object):
+
+    def __init__(self, properties=(), state=None):
+        self.properties = dict((name, None) for name in properties)
+        self.state = state
+
+    def find_property(self, name):
+        return True if name in self.properties else None
+
+    def set_property(self, name, value):
+        assert name in self.properties
+        self.properties[name] = value
+
+    def get_state(self, timeout):
+        return Gst.StateChangeReturn.SUCCESS, self.state, Gst.State.VOID_PENDING
+
+class FakeClock(object):
+
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+def make_buffer(sink_properties=('buffer-time', 'latency-time')):
+    sink = FakeElement(sink_properties, Gst.State.NULL)
+    queue = FakeElement(['max-size-time'])
+    clock = FakeClock()
+    buffering = adaptive_buffer.AdaptiveBuffer(sink, queue, stable_time=60.0, clock=clock)
+    return buffering, sink, queue, clock
+
+def test_starts_on_the_tightest_rung():
+    buffering, sink, queue, clock = make_buffer()
+    assert sink.properties == {'buffer-time': 40000, 'latency-time': 10000}
+    assert queue.properties['max-size-time'] == 250 * Gst.MSECOND
+
+def test_underruns_while_settling_are_ignored():
+    buffering, sink, queue, clock = make_buffer()
+    buffering.track_changed()
+    clock.now += adaptive_buffer.settle_time / 2
+    buffering.underrun()
+    buffering.climb()
+    assert buffering.level == 0
+    clock.now += adaptive_buffer.settle_time
+    buffering.underrun()
+    buffering.climb()
+    assert buffering.level == 1
+
+def test_the_sink_waits_for_the_pipeline_to_stop():
+    buffering, sink, queue, clock = make_buffer()
+    sink.state = Gst.State.PLAYING
+    clock.now += 10
+    buffering.underrun()
+    buffering.climb()
+    # the queue follows at once, the sink keeps its device as it is
+    assert queue.properties['max-size-time'] == 500 * Gst.MSECOND
+    assert sink.properties['buffer-time'] == 40000
+    sink.state = Gst.State.NULL
+    buffering.stopped()
+    assert sink.properties == {'buffer-time': 80000, 'latency-time': 10000}
+
+def test_a_stopped_sink_is_set_at_once():
+    buffering, sink, queue, clock = make_buffer()
+    buffering.set_level(2)
+    assert sink.properties['buffer-time'] == 160000
+    assert buffering.pending is None
+
+def test_a_sink_without_buffer_time_is_left_alone():
+    buffering, sink, queue, clock = make_buffer(sink_properties=())
+    buffering.set_level(3)
+    buffering.stopped()
+    assert buffering.pending is None
+    assert queue.properties['max-size-time'] == 2000 * Gst.MSECOND
+
+def test_steps_down_after_a_stable_spell():
+    buffering, sink, queue, clock = make_buffer()
+    buffering.set_level(2)
+    clock.now += 30
+    buffering.check()
+    assert buffering.level == 2
+    clock.now += 30
+    buffering.check()
+    assert buffering.level == 1
+    # and counts again from that step
+    clock.now += 30
+    buffering.check()
+    assert buffering.level == 1
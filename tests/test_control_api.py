@@ -0,0 +1,145 @@
+import json, socket
+
+import pytest
+
+pytest.importorskip('gi')
+import gi
+try:
+    gi.require_version('Gst', '1.0')
+except ValueError:
+    pytest.skip("GStreamer is not installed", allow_module_level=True)
+from gi.repository import Gst
+
+import control_api
+
+class Player(object):
+
+    def __init__(self):
+        self.state = Gst.State.PAUSED
+        self.pending = Gst.State.VOID_PENDING
+
+    def get_state(self, timeout):
+        return Gst.StateChangeReturn.SUCCESS, self.state, self.pending
+
+class Engine(object):
+
+    rate = 1.0
+
+class Position(object):
+
+    def position(self):
+        return 2 * Gst.SECOND
+
+    def duration(self):
+        return 60 * Gst.SECOND
+
+class Switcher(object):
+
+    def __init__(self):
+        self.moves = []
+
+    def skip(self):
+        self.moves.append('next')
+        return True
+
+    def previous(self):
+        self.moves.append('prev')
+        return False
+
+class App(object):
+
+    def __init__(self):
+        self.player = Player()
+        self.engine = Engine()
+        self.position = Position()
+        self.switcher = Switcher()
+        self.playlist = ['a.flac', 'b.flac']
+        self.playnumber = 1
+        self.rpm = 90.0
+        self.rate_override = None
+        self.rpm_override = None
+
+    def playpause(self, number):
+        # an asynchronous change, still under way when the reply is made
+        player = self.player
+        target = player.pending if player.pending != Gst.State.VOID_PENDING else player.state
+        player.pending = Gst.State.PLAYING if target == Gst.State.PAUSED else Gst.State.PAUSED
+
+    def update_speed(self):
+        if self.rate_override is not None:
+            self.engine.rate = self.rate_override
+
+@pytest.fixture
+def server():
+    server = control_api.ControlServer(App(), None)
+    ours, theirs = socket.socketpair()
+    client = control_api.Client(ours)
+    yield server, client, theirs
+    ours.close()
+    theirs.close()
+
+def handle(server, client, request):
+    return server.handle(client, json.dumps(request).encode())
+
+def test_status(server):
+    server, client, peer = server
+    reply = handle(server, client, {'cmd': 'status', 'id': 7})
+    assert reply['ok'] and reply['id'] == 7
+    assert reply['result']['location'] == 'b.flac'
+    assert reply['result']['state'] == 'paused'
+    assert reply['result']['position'] == 2 * Gst.SECOND
+
+def test_batch_replies_in_order(server):
+    server, client, peer = server
+    replies = handle(server, client, [{'cmd': 'next', 'id': 1}, {'cmd': 'prev', 'id': 2}, {'cmd': 'ping'}])
+    assert [reply.get('id') for reply in replies] == [1, 2, None]
+    assert [reply['result'] for reply in replies] == [True, False, None]
+    assert server.app.switcher.moves == ['next', 'prev']
+
+def test_play_reports_the_state_it_is_heading_for(server):
+    server, client, peer = server
+    assert handle(server, client, {'cmd': 'play'})['result'] == 'playing'
+    # already on its way, so a second play changes nothing
+    assert handle(server, client, {'cmd': 'play'})['result'] == 'playing'
+    assert handle(server, client, {'cmd': 'pause'})['result'] == 'paused'
+
+def test_rate_override(server):
+    server, client, peer = server
+    assert handle(server, client, {'cmd': 'rate', 'value': 1.5})['result'] == 1.5
+    assert server.app.rate_override == 1.5
+    handle(server, client, {'cmd': 'rate', 'value': None})
+    assert server.app.rate_override is None
+
+@pytest.mark.parametrize('request_, error', [
+    ({'cmd': 'fly'}, "unknown command"),
+    ({'cmd': 'rate'}, "KeyError"),
+    ({'cmd': 'rpm', 'value': 'fast'}, "ValueError"),
+    ({'cmd': 'subscribe', 'events': ['weather']}, "unknown events"),
+    ([1], "expected an object"),
+])
+def test_bad_commands(server, request_, error):
+    server, client, peer = server
+    reply = handle(server, client, request_)
+    if isinstance(reply, list):
+        [reply] = reply
+    assert not reply['ok'] and error in reply['error']
+
+def test_not_json(server):
+    server, client, peer = server
+    assert server.handle(client, b'{') == {'ok': False, 'error': "not JSON"}
+
+def test_a_failing_command_gets_an_error_reply(server, capsys):
+    server, client, peer = server
+    server.app.position = None
+    reply = handle(server, client, {'cmd': 'status', 'id': 3})
+    assert reply['id'] == 3 and not reply['ok'] and "AttributeError" in reply['error']
+    assert "Traceback" in capsys.readouterr().err
+
+def test_events_go_to_subscribers(server):
+    server, client, peer = server
+    server.clients.append(client)
+    assert handle(server, client, {'cmd': 'subscribe', 'events': ['track']})['result'] == ['track']
+    server.emit('rate', rate=1.2)
+    server.emit('track', track=0, location='a.flac')
+    event = json.loads(peer.recv(65536).decode().splitlines()[0])
+    assert event['event'] == 'track' and event['location'] == 'a.flac'
@@ -0,0 +1,55 @@
+import time
+
+import pytest
+
+import gpio_cdev
+import hardware
+
+def test_structs_match_the_kernel_uapi():
+    # sizeof(struct gpio_v2_line_request) and sizeof(struct gpio_v2_line_event)
+    assert gpio_cdev.line_request.size == 592
+    assert gpio_cdev.line_event.size == 48
+
+def test_line_request_fields():
+    packed = gpio_cdev.line_request.pack(*([17] + [0] * 63 + [gpio_cdev.consumer, 0x124, 0, 1, 64, 42]))
+    # offsets[0], consumer, config.flags, num_lines, event_buffer_size, fd
+    assert packed[:4] == (17).to_bytes(4, 'little')
+    assert packed[256:256 + len(gpio_cdev.consumer)] == gpio_cdev.consumer
+    assert packed[288:296] == (0x124).to_bytes(8, 'little')
+    assert packed[560:568] == (1).to_bytes(4, 'little') + (64).to_bytes(4, 'little')
+    assert gpio_cdev.line_request.unpack(packed)[-1] == 42
+
+def event(stamp, offset=17):
+    return gpio_cdev.line_event.pack(int(stamp * 1e9), gpio_cdev.GPIO_V2_LINE_EVENT_FALLING_EDGE, offset, 1, 1)
+
+def test_dispatch_debounces_on_kernel_stamps():
+    backend = gpio_cdev.CdevBackend(gpio_cdev.SimulatedChip([]))
+    seen = []
+    backend.add_edge_callback(17, lambda pin: seen.append((pin, backend.event_time)), 2.0)
+    [fd] = backend.lines
+    # a partial record at the end is left alone
+    backend.dispatch(fd, event(1.0) + event(1.001) + event(1.5) + event(2.0)[:20])
+    backend.cleanup()
+    assert seen == [(17, 1.0), (17, 1.5)]
+
+def test_simulated_chip_end_to_end():
+    events = hardware.synthetic_pulses(17, [(120, 2)])
+    chip = gpio_cdev.SimulatedChip(events, time_scale=100.0)
+    backend = gpio_cdev.CdevBackend(chip, 0)
+    stamps = []
+    backend.add_edge_callback(17, lambda pin: stamps.append(backend.clock()), 1.0)
+    backend.start()
+    deadline = time.monotonic() + 5
+    while len(stamps) < len(events) and time.monotonic() < deadline:
+        time.sleep(0.01)
+    backend.cleanup()
+    assert len(stamps) == len(events)
+    # stamped when due, half a second of trace apart at 100x
+    gaps = [b - a for a, b in zip(stamps, stamps[1:])]
+    assert gaps == [pytest.approx(0.005, abs=1e-6)] * (len(events) - 1)
+
+def test_jitter():
+    result = gpio_cdev.jitter([0.0, 0.5, 1.0, 1.5])
+    assert result['rpm_mean'] == pytest.approx(120.0)
+    assert result['rpm_stddev'] == pytest.approx(0.0)
+    assert gpio_cdev.jitter([0.0, 0.5]) is None
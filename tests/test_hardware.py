@@ -0,0 +1,49 @@
+import threading
+
+import pytest
+
+import hardware
+
+def test_parse_profile():
+    assert hardware.parse_profile("90:30,120") == [(90.0, 30.0), (120.0, 60.0)]
+
+def test_synthetic_pulses_follow_the_profile():
+    events = hardware.synthetic_pulses(17, [(60, 3), (0, 2), (120, 1)])
+    assert [stamp for stamp, kind, pin in events] == [0.0, 1.0, 2.0, 5.0, 5.5]
+    assert all(kind == "edge" and pin == 17 for stamp, kind, pin in events)
+
+def test_load_trace(tmp_path):
+    trace = tmp_path / "ride.trace"
+    trace.write_text("# recorded\n0.750 adc 2.05\n0.512 edge 17\n\n")
+    assert hardware.load_trace(str(trace)) == [(0.512, "edge", 17), (0.75, "adc", 2.05)]
+
+def replay(events, bouncetime, time_scale=1000.0):
+    backend = hardware.SimulatedBackend(events, time_scale=time_scale)
+    seen = []
+    finished = threading.Event()
+    backend.on_finished = finished.set
+    backend.add_edge_callback(17, lambda pin: seen.append((pin, backend.clock())), bouncetime)
+    backend.start()
+    assert finished.wait(5)
+    backend.cleanup()
+    return backend, seen
+
+def test_simulated_backend_stamps_edges_with_trace_time():
+    backend, seen = replay(hardware.synthetic_pulses(17, [(120, 2)]), 0)
+    assert seen == [(17, 0.0), (17, 0.5), (17, 1.0), (17, 1.5)]
+
+def test_simulated_backend_debounces():
+    events = [(0.0, "edge", 17), (0.005, "edge", 17), (0.5, "edge", 17), (0.6, "edge", 18)]
+    backend, seen = replay(events, 20)
+    assert [stamp for pin, stamp in seen] == [0.0, 0.5]
+
+def test_simulated_backend_replays_voltages():
+    backend, seen = replay([(0.1, "adc", 1.5), (0.2, "adc", 2.5)], 0)
+    assert backend.read_voltage() == pytest.approx(2.5)
+
+def test_record_trace_round_trips(tmp_path):
+    path = str(tmp_path / "recorded.trace")
+    backend = hardware.SimulatedBackend([], record=path)
+    backend.wrap(lambda pin: None)(17)
+    backend.cleanup()
+    assert [event[1:] for event in hardware.load_trace(path)] == [("edge", 17)]
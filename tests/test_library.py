@@ -0,0 +1,63 @@
+import os
+
+import library
+
+def make_tree(tmp_path):
+    music = tmp_path / "music"
+    (music / "b").mkdir(parents=True)
+    (music / "a.mp3").write_bytes(b"a")
+    (music / "b" / "c.flac").write_bytes(b"c")
+    (music / "b" / "cover.jpg").write_bytes(b"not audio")
+    return music
+
+def make_library(tmp_path):
+    return library.Library(str(tmp_path / "library.db"))
+
+def test_walk_finds_audio_in_name_order(tmp_path):
+    music = make_tree(tmp_path)
+    paths = [path for path, st in library.walk(str(music))]
+    assert paths == [str(music / "a.mp3"), str(music / "b" / "c.flac")]
+
+def test_walk_follows_a_symlink_loop_once(tmp_path):
+    music = make_tree(tmp_path)
+    os.symlink("..", str(music / "b" / "up"))
+    paths = [path for path, st in library.walk(str(music))]
+    assert paths == [str(music / "a.mp3"), str(music / "b" / "c.flac")]
+
+def test_playlist_walks_a_new_directory(tmp_path):
+    music = make_tree(tmp_path)
+    assert make_library(tmp_path).playlist([str(music)]) == [str(music / "a.mp3"), str(music / "b" / "c.flac")]
+
+def test_playlist_leaves_out_deleted_tracks(tmp_path):
+    music = make_tree(tmp_path)
+    make_library(tmp_path).playlist([str(music)])
+    os.unlink(str(music / "a.mp3"))
+    # indexed, so not walked again until the rescan
+    assert make_library(tmp_path).playlist([str(music)]) == [str(music / "b" / "c.flac")]
+
+def test_update_root_picks_up_new_changed_and_deleted(tmp_path):
+    music = make_tree(tmp_path)
+    lib = make_library(tmp_path)
+    lib.playlist([str(music)])
+    (music / "b" / "c.flac").write_bytes(b"longer now")
+    (music / "d.ogg").write_bytes(b"d")
+    os.unlink(str(music / "a.mp3"))
+    changed = lib.update_root(lib.db, str(music))
+    assert sorted(changed) == [str(music / "b" / "c.flac"), str(music / "d.ogg")]
+    assert lib.track(str(music / "a.mp3")) is None
+    assert lib.track(str(music / "d.ogg"))['root'] == str(music)
+
+def test_update_loose_forgets_the_tempo_of_a_changed_file(tmp_path):
+    track = tmp_path / "loose.mp3"
+    track.write_bytes(b"x")
+    lib = make_library(tmp_path)
+    assert lib.playlist([str(track)]) == [str(track)]
+    lib.update_loose(lib.db)
+    lib.db.execute("update tracks set scanned = 1, bpm = 128, beat_confidence = 0.9")
+    lib.db.commit()
+    assert lib.tempos() == {str(track): (128.0, 0.9)}
+    track.write_bytes(b"changed")
+    lib.update_loose(lib.db)
+    row = lib.track(str(track))
+    assert (row['scanned'], row['bpm'], row['beat_confidence']) == (None, None, None)
+    assert lib.unscanned(lib.db) == [str(track)]
@@ -0,0 +1,47 @@
+import metrics
+
+def test_render_counters_and_gauges():
+    registry = metrics.Registry()
+    counter = registry.counter('speedo_things_total', "Things")
+    counter.inc()
+    counter.inc(2)
+    registry.gauge('speedo_level', "Level").set(0.5)
+    registry.gauge('speedo_rate', "Rate", lambda: 1.25)
+    assert registry.render().splitlines() == [
+        "# HELP speedo_things_total Things",
+        "# TYPE speedo_things_total counter",
+        "speedo_things_total 3.0",
+        "# HELP speedo_level Level",
+        "# TYPE speedo_level gauge",
+        "speedo_level 0.5",
+        "# HELP speedo_rate Rate",
+        "# TYPE speedo_rate gauge",
+        "speedo_rate 1.25",
+    ]
+
+def test_render_histogram_is_cumulative():
+    registry = metrics.Registry()
+    histogram = registry.histogram('speedo_seconds', "Seconds", buckets=(0.1, 1.0))
+    for value in (0.05, 0.5, 5.0):
+        histogram.observe(value)
+    lines = registry.render().splitlines()
+    assert lines[1] == "# TYPE speedo_seconds histogram"
+    assert lines[2:] == [
+        'speedo_seconds_bucket{le="0.1"} 1.0',
+        'speedo_seconds_bucket{le="1"} 2.0',
+        'speedo_seconds_bucket{le="+Inf"} 3.0',
+        "speedo_seconds_sum 5.55",
+        "speedo_seconds_count 3.0",
+    ]
+
+def test_render_leaves_out_a_failing_gauge():
+    registry = metrics.Registry()
+    registry.gauge('speedo_broken', "Broken", lambda: 1 / 0)
+    registry.gauge('process_cpu_seconds_total', "CPU", lambda: 2.0, 'counter')
+    assert registry.render().splitlines() == [
+        "# HELP speedo_broken Broken",
+        "# TYPE speedo_broken gauge",
+        "# HELP process_cpu_seconds_total CPU",
+        "# TYPE process_cpu_seconds_total counter",
+        "process_cpu_seconds_total 2.0",
+    ]
@@ -0,0 +1,103 @@
+import threading
+
+import mplayer_control
+
+class FakeSignal(object):
+
+    def __init__(self):
+        self.handlers = []
+
+    def connect(self, handler):
+        self.handlers.append(handler)
+
+    def emit(self, line):
+        for handler in self.handlers:
+            handler(line)
+
+class FakePlayer(object):
+
+    # records what the worker sends; a speed change waits for the gate,
+    # as one would on a slow mplayer
+
+    def __init__(self):
+        self.stdout = FakeSignal()
+        self.sent = []
+        self.entered = threading.Event()
+        self.gate = threading.Event()
+        self.gate.set()
+
+    @property
+    def speed(self):
+        raise AssertionError("speed is never read back")
+
+    @speed.setter
+    def speed(self, value):
+        self.entered.set()
+        self.gate.wait(5)
+        self.sent.append(('speed', value))
+
+    def loadfile(self, path, append):
+        self.sent.append(('loadfile', path, append))
+
+    def pause(self):
+        self.sent.append(('pause',))
+
+def test_speed_changes_are_coalesced():
+    player = FakePlayer()
+    control = mplayer_control.MplayerControl(player)
+    player.gate.clear()
+    control.set_speed(1.0)
+    assert player.entered.wait(5)
+    # mplayer is busy with 1.0; only the last of these is worth sending
+    for speed in (1.1, 1.2, 1.3):
+        control.set_speed(speed)
+    player.gate.set()
+    control.close()
+    assert player.sent == [('speed', 1.0), ('speed', 1.3)]
+
+def test_speed_changes_within_the_deadband_are_dropped():
+    player = FakePlayer()
+    control = mplayer_control.MplayerControl(player, deadband=0.05)
+    control.set_speed(1.0)
+    assert player.entered.wait(5)
+    control.set_speed(1.04)
+    control.set_speed(0.97)
+    control.set_speed(1.01, force=True)
+    control.close()
+    assert player.sent == [('speed', 1.0), ('speed', 1.01)]
+
+def test_a_change_back_within_the_deadband_cancels_the_pending_one():
+    player = FakePlayer()
+    control = mplayer_control.MplayerControl(player, deadband=0.05)
+    player.gate.clear()
+    control.set_speed(1.0)
+    assert player.entered.wait(5)
+    control.set_speed(1.2)
+    control.set_speed(1.02)
+    player.gate.set()
+    control.close()
+    assert player.sent == [('speed', 1.0)]
+
+def test_commands_are_sent_in_order():
+    player = FakePlayer()
+    control = mplayer_control.MplayerControl(player)
+    control.loadfile("a.mp3")
+    control.loadfile("b.mp3", 1)
+    control.pause()
+    control.close()
+    assert player.sent == [('loadfile', "a.mp3", 0), ('loadfile', "b.mp3", 1), ('pause',)]
+    assert control.playlist == ["a.mp3", "b.mp3"]
+
+def test_state_comes_from_mplayer_output():
+    player = FakePlayer()
+    control = mplayer_control.MplayerControl(player)
+    control.loadfile("a.mp3")
+    control.loadfile("b.mp3", 1)
+    player.stdout.emit("Playing b.mp3.")
+    assert control.wait_started(0)
+    assert (control.index, control.paused) == (1, False)
+    player.stdout.emit("ID_PAUSED")
+    assert control.paused
+    player.stdout.emit("EOF code: 1")
+    assert control.finished.is_set()
+    control.close()
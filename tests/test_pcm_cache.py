@@ -0,0 +1,56 @@
+import os
+
+import pytest
+
+pytest.importorskip('gi')
+import gi
+try:
+    gi.require_version('Gst', '1.0')
+except ValueError:
+    pytest.skip("GStreamer is not installed", allow_module_level=True)
+
+import pcm_cache
+
+def add_entry(cache, tmp_path, name, size, used):
+    source = tmp_path / name
+    source.write_bytes(b"source")
+    st = os.stat(str(source))
+    key = cache.key(str(source))
+    with open(cache.pcm_path(key), "wb") as f:
+        f.write(b"\0" * size)
+    cache.index[key] = {'path': str(source), 'mtime': st.st_mtime, 'size': st.st_size,
+                        'bytes': size, 'used': used}
+    return str(source), key
+
+def test_evict_drops_the_least_recently_used(tmp_path):
+    cache = pcm_cache.PcmCache(str(tmp_path / "cache"), budget=250)
+    old, old_key = add_entry(cache, tmp_path, "old.flac", 100, used=1.0)
+    middle, middle_key = add_entry(cache, tmp_path, "middle.flac", 100, used=2.0)
+    new, new_key = add_entry(cache, tmp_path, "new.flac", 100, used=3.0)
+    with cache.lock:
+        cache.evict()
+    assert sorted(cache.index) == sorted([middle_key, new_key])
+    assert not os.path.exists(cache.pcm_path(old_key))
+    assert os.path.exists(cache.pcm_path(middle_key))
+
+def test_evict_keeps_everything_within_budget(tmp_path):
+    cache = pcm_cache.PcmCache(str(tmp_path / "cache"), budget=300)
+    for i in range(3):
+        add_entry(cache, tmp_path, "%d.flac" % i, 100, used=float(i))
+    with cache.lock:
+        cache.evict()
+    assert len(cache.index) == 3
+
+def test_lookup_forgets_a_changed_source(tmp_path):
+    cache = pcm_cache.PcmCache(str(tmp_path / "cache"))
+    source, key = add_entry(cache, tmp_path, "track.flac", 100, used=0.0)
+    assert cache.lookup(source) == cache.pcm_path(key)
+    with open(source, "ab") as f:
+        f.write(b"more")
+    assert cache.lookup(source) is None
+    assert key not in cache.index
+    assert not os.path.exists(cache.pcm_path(key))
+
+def test_launch_location_quotes_pipeline_syntax():
+    assert pcm_cache.launch_location('/music/a!b=c.flac') == 'location="/music/a!b=c.flac"'
+    assert pcm_cache.launch_location('/music/say "hi"\\.flac') == 'location="/music/say \\"hi\\"\\\\.flac"'
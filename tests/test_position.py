@@ -0,0 +1,97 @@
+import pytest
+
+pytest.importorskip('gi')
+import gi
+try:
+    gi.require_version('Gst', '1.0')
+except ValueError:
+    pytest.skip("GStreamer is not installed", allow_module_level=True)
+from gi.repository import Gst
+
+from position import PositionTracker
+
+second = 1000000000
+
+class FakeConvert(object):
+
+    def __init__(self, branch):
+        self.branch = branch
+
+    def query_duration(self, format):
+        self.branch.queries += 1
+        return self.branch.duration is not None, self.branch.duration or 0
+
+class FakeBranch(object):
+
+    def __init__(self, location, duration, start=0, rate=1.0):
+        self.location = location
+        self.duration = duration
+        self.start = start
+        self.rate = rate
+        self.queries = 0
+        self.conv = FakeConvert(self)
+
+class FakeSwitcher(object):
+
+    def __init__(self, current):
+        self.current = current
+        self.now = 0
+
+    def running_time(self):
+        return self.now
+
+def test_position_follows_the_rate():
+    switcher = FakeSwitcher(FakeBranch("a.flac", 100 * second))
+    position = PositionTracker(switcher)
+    position.track_changed()
+    switcher.now = 10 * second
+    assert position.position() == 10 * second
+    position.set_rate(2.0)
+    switcher.now = 15 * second
+    assert position.position() == 20 * second
+    position.set_rate(0.5)
+    switcher.now = 19 * second
+    assert position.position() == 22 * second
+
+def test_track_changed_starts_from_the_given_position():
+    switcher = FakeSwitcher(FakeBranch("a.flac", 100 * second))
+    position = PositionTracker(switcher, rate=1.5)
+    switcher.now = 50 * second
+    position.track_changed(30 * second)
+    switcher.now = 52 * second
+    assert position.position() == 33 * second
+
+def test_duration_is_queried_once_until_it_changes():
+    branch = FakeBranch("a.flac", 100 * second)
+    position = PositionTracker(FakeSwitcher(branch))
+    position.track_changed()
+    assert position.duration() == 100 * second
+    assert position.duration() == 100 * second
+    assert branch.queries == 1
+    position.duration_changed()
+    assert position.duration() == 100 * second
+    assert branch.queries == 2
+
+def test_duration_of_a_rung_started_part_way_in():
+    # 40 s of a track rendered at 2.0x is 80 s of it, after the first 10
+    branch = FakeBranch("a.flac", 40 * second, start=10 * second, rate=2.0)
+    position = PositionTracker(FakeSwitcher(branch))
+    position.track_changed(10 * second)
+    assert position.duration() == 90 * second
+
+def test_remaining_eta_and_progress():
+    switcher = FakeSwitcher(FakeBranch("a.flac", 100 * second))
+    position = PositionTracker(switcher, rate=2.0)
+    position.track_changed()
+    switcher.now = 25 * second
+    assert position.remaining() == 50 * second
+    assert position.eta() == 25 * second
+    assert position.progress() == pytest.approx(0.5)
+
+def test_unknown_duration():
+    switcher = FakeSwitcher(FakeBranch("a.flac", None))
+    position = PositionTracker(switcher)
+    position.track_changed()
+    assert position.duration() == Gst.CLOCK_TIME_NONE
+    assert position.eta() == Gst.CLOCK_TIME_NONE
+    assert position.progress() is None
@@ -0,0 +1,135 @@
+import os, json, argparse
+
+import pytest
+
+pytest.importorskip('gi')
+import gi
+try:
+    gi.require_version('Gst', '1.0')
+except ValueError:
+    pytest.skip("GStreamer is not installed", allow_module_level=True)
+
+import rate_ladder
+
+def test_parse_range():
+    assert rate_ladder.parse_rates("0.5:1.0:0.1") == [0.5, 0.6, 0.7, 0.8, 0.9, 1.0]
+
+def test_parse_list_is_sorted_and_unique():
+    assert rate_ladder.parse_rates("1.2,0.8,1.2") == [0.8, 1.2]
+
+@pytest.mark.parametrize('text', ["fast", "1.0:0.5:0.1", "0.5:1.0:0", "0,1.0", "-1"])
+def test_parse_rejects(text):
+    with pytest.raises(argparse.ArgumentTypeError):
+        rate_ladder.parse_rates(text)
+
+def test_nearest_is_by_ratio():
+    # 1.45 is nearer 2.0 than 1.0 by ratio, though not by difference
+    assert rate_ladder.nearest(1.45, [1.0, 2.0]) == 2.0
+    assert rate_ladder.nearest(1.4, [1.0, 2.0]) == 1.0
+    assert rate_ladder.nearest(0.7, [0.5, 1.0]) == 0.5
+
+def make_ladder(tmp_path, rates, rendered):
+    directory = tmp_path / "ladder"
+    directory.mkdir()
+    (directory / "ladder.json").write_text(json.dumps({'rates': rates}))
+    track = tmp_path / "track.flac"
+    track.write_bytes(b"not really flac")
+    ladder = rate_ladder.RateLadder(str(directory), residual=0.08)
+    os.makedirs(ladder.track_dir(str(track)))
+    st = os.stat(str(track))
+    with open(os.path.join(ladder.track_dir(str(track)), "index.json"), "w") as f:
+        json.dump({'mtime': st.st_mtime, 'size': st.st_size, 'rates': rendered}, f)
+    for rate in rendered:
+        open(ladder.rung_path(str(track), rate), "wb").close()
+    return ladder, str(track)
+
+def test_select_keeps_the_rung_within_the_residual(tmp_path):
+    ladder, track = make_ladder(tmp_path, [0.8, 1.0, 1.2], [0.8, 1.0, 1.2])
+    assert ladder.rung == 1.0
+    assert not ladder.select(1.07)
+    assert ladder.select(1.15)
+    assert ladder.rung == 1.2
+    # outside the residual of 1.2, but 1.2 is still the nearer rung
+    assert not ladder.select(1.1)
+    assert ladder.select(0.97)
+    assert ladder.rung == 1.0
+
+def test_select_does_not_flip_around_a_midpoint(tmp_path):
+    ladder = rate_ladder.RateLadder(str(tmp_path))
+    ladder.rung = 0.5
+    # either side of the midpoint of 0.5 and 0.6, and outside the residual
+    # of both
+    assert [ladder.select(rate) for rate in (0.545, 0.551) * 10] == [False] * 20
+    assert ladder.rung == 0.5
+    assert ladder.select(0.58)
+    assert [ladder.select(rate) for rate in (0.545, 0.551) * 10] == [False] * 20
+    assert ladder.rung == 0.6
+
+def test_lookup_plays_the_rendered_rung(tmp_path):
+    ladder, track = make_ladder(tmp_path, [0.8, 1.0, 1.2], [0.8, 1.2])
+    ladder.select(1.2)
+    assert ladder.lookup(track) == (ladder.rung_path(track, 1.2), 1.2)
+
+def test_lookup_ignores_a_changed_track(tmp_path):
+    ladder, track = make_ladder(tmp_path, [0.8, 1.0], [0.8, 1.0])
+    with open(track, "ab") as f:
+        f.write(b"more")
+    assert ladder.lookup(track) == (None, 1.0)
+
+def test_missing_ladder_uses_the_default_rates(tmp_path):
+    ladder = rate_ladder.RateLadder(str(tmp_path))
+    assert ladder.rates == rate_ladder.parse_rates(rate_ladder.default_rates)
+    assert ladder.lookup(str(tmp_path / "nowhere.flac")) == (None, 1.0)
+
+class Engine(object):
+
+    element = None
+    rate = 1.0
+
+    def set_rate(self, rate):
+        self.rate = rate
+
+    def ramp_to(self, rate, seconds):
+        self.rate = rate
+
+class Branch(object):
+
+    def __init__(self, location, rate):
+        self.location = location
+        self.rate = rate
+
+class Switcher(object):
+
+    def __init__(self, ladder, location):
+        self.ladder = None
+        self.built = ladder
+        self.current = Branch(location, 1.0)
+        self.replaced = []
+
+    def replace(self, position):
+        self.replaced.append(position)
+        self.current = Branch(self.current.location, self.built.lookup(self.current.location)[1])
+
+class Position(object):
+
+    def position(self):
+        return 5
+
+    def track_changed(self, position=None):
+        pass
+
+def test_engine_does_the_residual(tmp_path):
+    ladder, track = make_ladder(tmp_path, [0.8, 1.0, 1.2], [0.8, 1.0, 1.2])
+    engine = Engine()
+    switcher = Switcher(ladder, track)
+    ladder_engine = rate_ladder.LadderEngine(engine, ladder, switcher, Position())
+    assert switcher.ladder is ladder
+
+    ladder_engine.set_rate(1.05)
+    assert switcher.replaced == []
+    assert engine.rate == pytest.approx(1.05)
+
+    ladder_engine.ramp_to(1.26, 0.5)
+    assert switcher.replaced == [5]
+    assert ladder_engine.rate == pytest.approx(1.26)
+    assert engine.rate == pytest.approx(1.05)
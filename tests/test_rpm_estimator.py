@@ -0,0 +1,61 @@
+import pytest
+
+from rpm_estimator import PulseRing, RpmEstimator, intervals, median_rpm, ema_rpm, window_rpm
+
+def steady(ring, rpm, count, start=0.0):
+    interval = 60.0 / rpm
+    for i in range(count):
+        ring.push(start + i * interval)
+    return start + (count - 1) * interval
+
+def test_ring_returns_newest_oldest_first():
+    ring = PulseRing(size=4)
+    for stamp in range(10):
+        ring.push(float(stamp))
+    # one slot is always kept back from a reader
+    assert ring.last(8) == [7.0, 8.0, 9.0]
+    assert ring.last(2) == [8.0, 9.0]
+
+def test_ring_empty():
+    assert PulseRing().last(5) == []
+
+def test_intervals_fold_bounces_into_the_next_gap():
+    assert intervals([0.0, 0.5, 0.505, 1.0], 0.02) == [0.5, 0.5]
+
+@pytest.mark.parametrize('estimate', [median_rpm, ema_rpm, window_rpm])
+def test_steady_cadence(estimate):
+    ring = PulseRing()
+    now = steady(ring, 120, 20)
+    assert estimate(ring, now) == pytest.approx(120.0)
+
+def test_median_ignores_one_missed_pulse():
+    ring = PulseRing()
+    for stamp in (0.0, 0.5, 1.0, 2.0, 2.5, 3.0):
+        ring.push(stamp)
+    assert median_rpm(ring, 3.0) == pytest.approx(120.0)
+
+def test_window_only_counts_recent_pulses():
+    ring = PulseRing()
+    steady(ring, 60, 5)
+    now = steady(ring, 120, 5, start=10.0)
+    assert window_rpm(ring, now, window=3.0) == pytest.approx(120.0)
+
+def test_estimator_stalls_to_zero():
+    ring = PulseRing()
+    now = steady(ring, 120, 10)
+    estimator = RpmEstimator(ring, 'median', stall_timeout=3.0)
+    assert estimator.rpm(now) == pytest.approx(120.0)
+    assert estimator.rpm(now + 3.5) == 0.0
+
+def test_estimator_decays_once_a_pulse_is_overdue():
+    ring = PulseRing()
+    now = steady(ring, 120, 10)
+    estimator = RpmEstimator(ring, 'median', stall_timeout=10.0)
+    # a second since the last pulse: at most one turn a second
+    assert estimator.rpm(now + 1.0) == pytest.approx(60.0)
+    assert estimator.decay_delay(120.0, now) == pytest.approx(0.5)
+
+def test_estimator_without_pulses():
+    estimator = RpmEstimator(PulseRing())
+    assert estimator.rpm(1.0) == 0.0
+    assert estimator.decay_delay(120.0, 1.0) is None
@@ -0,0 +1,66 @@
+import os, json, argparse
+
+import pytest
+
+pytest.importorskip('gi')
+import gi
+try:
+    gi.require_version('Gst', '1.0')
+except ValueError:
+    pytest.skip("GStreamer is not installed", allow_module_level=True)
+
+import supervisor
+
+def make_supervisor(tmp_path, *args):
+    parser = argparse.ArgumentParser()
+    supervisor.add_arguments(parser)
+    options = parser.parse_args(['--state-file', str(tmp_path / "state.json")] + list(args))
+    return supervisor.Supervisor(None, options)
+
+def test_checkpoint_round_trip(tmp_path):
+    checkpoint = supervisor.Checkpoint(str(tmp_path / "state.json"))
+    assert checkpoint.load() is None
+    checkpoint.save({'index': 2, 'location': "/music/b.flac", 'position': 5000000000})
+    assert supervisor.Checkpoint(checkpoint.path).load() == {
+        'index': 2, 'location': "/music/b.flac", 'position': 5000000000}
+    assert not os.path.exists(checkpoint.path + ".tmp")
+    checkpoint.clear()
+    assert not os.path.exists(checkpoint.path)
+
+def test_checkpoint_skips_an_unchanged_state(tmp_path):
+    checkpoint = supervisor.Checkpoint(str(tmp_path / "state.json"))
+    checkpoint.save({'index': 0})
+    os.unlink(checkpoint.path)
+    checkpoint.save({'index': 0})
+    assert not os.path.exists(checkpoint.path)
+
+def test_checkpoint_ignores_a_damaged_file(tmp_path):
+    (tmp_path / "state.json").write_text('{"index": ')
+    assert supervisor.Checkpoint(str(tmp_path / "state.json")).load() is None
+
+def save_state(tmp_path, index, location, position):
+    (tmp_path / "state.json").write_text(json.dumps({'index': index, 'location': location, 'position': position}))
+
+def test_resume_point(tmp_path):
+    save_state(tmp_path, 1, "b", 7000000000)
+    assert make_supervisor(tmp_path).resume_point(["a", "b", "c"]) == (1, 7000000000)
+
+def test_resume_point_finds_the_track_in_a_changed_playlist(tmp_path):
+    save_state(tmp_path, 1, "b", 7000000000)
+    assert make_supervisor(tmp_path).resume_point(["new", "a", "b"]) == (2, 7000000000)
+    assert make_supervisor(tmp_path).resume_point(["a"]) == (0, 0)
+
+def test_resume_point_from_start(tmp_path):
+    save_state(tmp_path, 1, "b", 7000000000)
+    assert make_supervisor(tmp_path, '--from-start').resume_point(["a", "b"]) == (0, 0)
+
+def test_resume_point_without_a_checkpoint(tmp_path):
+    assert make_supervisor(tmp_path).resume_point(["a", "b"]) == (0, 0)
+
+def test_a_track_is_given_up_on_after_repeated_failures(tmp_path):
+    watcher = make_supervisor(tmp_path)
+    failures = [watcher.failed_too_often(3, float(now)) for now in range(supervisor.max_track_failures)]
+    assert failures == [False] * (supervisor.max_track_failures - 1) + [True]
+    # failures on another track, or long ago, start the count again
+    assert not watcher.failed_too_often(4, 10.0)
+    assert not watcher.failed_too_often(4, 10.0 + supervisor.recovery_window)
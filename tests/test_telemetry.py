@@ -0,0 +1,80 @@
+import pytest
+
+import telemetry
+
+class Clock(object):
+
+    def __init__(self):
+        self.now = 100.0
+
+    def __call__(self):
+        return self.now
+
+def write_log(path, records):
+    clock = Clock()
+    recorder = telemetry.Recorder(str(path), clock)
+    recorder.start()
+    for stamp, kind, fields in records:
+        recorder.record(kind, stamp=stamp, **fields)
+    recorder.stop()
+    return recorder.offset
+
+def test_records_are_twenty_bytes():
+    assert telemetry.record_format.size == 20
+
+def test_round_trip(tmp_path):
+    pytest.importorskip('numpy')
+    path = tmp_path / "ride.log"
+    offset = write_log(path, [
+        (101.0, telemetry.RATE, {'a': 120.0, 'b': 1.25, 'track': 3, 'bike': 2}),
+        (102.0, telemetry.PULSE, {'bike': 2}),
+    ])
+    log = telemetry.load(str(path))
+    assert list(log['kind']) == [telemetry.START, telemetry.RATE, telemetry.PULSE]
+    rate = log[1]
+    assert rate['time'] == pytest.approx(101.0 + offset)
+    assert (rate['bike'], rate['track']) == (2, 3)
+    assert (rate['a'], rate['b']) == (pytest.approx(120.0), pytest.approx(1.25))
+    assert log[0]['a'] == telemetry.version
+
+def test_out_of_range_fields_are_clamped(tmp_path):
+    pytest.importorskip('numpy')
+    path = tmp_path / "ride.log"
+    write_log(path, [(101.0, telemetry.TRACK, {'track': 70000, 'bike': 300})])
+    log = telemetry.load(str(path))
+    assert (log[1]['track'], log[1]['bike']) == (0xffff, 0xff)
+
+def test_unpackable_records_are_dropped(tmp_path, capsys):
+    path = tmp_path / "ride.log"
+    write_log(path, [(101.0, telemetry.RATE, {'a': "fast"}), (102.0, telemetry.PULSE, {})])
+    assert path.stat().st_size == 2 * telemetry.record_format.size
+    assert "dropping" in capsys.readouterr().err
+
+def test_pending_records_are_bounded():
+    recorder = telemetry.Recorder("/nonexistent/ride.log")
+    for i in range(telemetry.max_pending + 10):
+        recorder.record(telemetry.PULSE)
+    assert len(recorder.pending) == telemetry.max_pending
+
+def test_truncated_record_is_left_out(tmp_path):
+    pytest.importorskip('numpy')
+    path = tmp_path / "ride.log"
+    write_log(path, [(101.0, telemetry.PULSE, {})])
+    with open(str(path), "ab") as f:
+        f.write(b"\0" * 7)
+    assert len(telemetry.load(str(path))) == 2
+
+def test_summary(tmp_path):
+    pytest.importorskip('numpy')
+    path = tmp_path / "ride.log"
+    records = [(100.0 + i, telemetry.PULSE, {}) for i in range(10)]
+    records += [(100.0, telemetry.RATE, {'a': 95.0, 'b': 1.0}), (110.0, telemetry.RATE, {'a': 95.0, 'b': 1.0}),
+                (104.0, telemetry.UNDERRUN, {}), (104.5, telemetry.RUNNING, {})]
+    write_log(path, sorted(records, key=lambda record: record[0]))
+    result = telemetry.summary(telemetry.load(str(path)), circumference=2.0, max_gap=20.0)
+    assert result['sessions'] == 1
+    assert result['distance_km'] == pytest.approx(0.02)
+    assert result['cadence_seconds'].sum() == pytest.approx(10.0)
+    assert result['cadence_seconds'][9] == pytest.approx(10.0)
+    [(stamp, bike, duration)] = result['underruns']
+    assert duration == pytest.approx(0.5)
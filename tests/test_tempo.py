@@ -0,0 +1,71 @@
+import pytest
+
+import tempo
+
+def test_octave_distance_folds_whole_octaves():
+    assert tempo.octave_distance(70.0, 140.0) == pytest.approx(0.0)
+    assert tempo.octave_distance(120.0, 60.0) == pytest.approx(0.0)
+    assert tempo.octave_distance(120.0 * 2 ** 0.5, 120.0) == pytest.approx(0.5)
+
+def test_folded():
+    assert tempo.folded(70.0, 140.0) == pytest.approx(140.0)
+    assert tempo.folded(200.0, 100.0) == pytest.approx(100.0)
+
+def test_track_rate_keeps_close_to_one():
+    selector = tempo.TempoSelector({'a': (70.0, 0.9)}, ['a', 'b'], reference=120.0)
+    # 1.0x wants 120 BPM, which a 70 BPM track folded to 140 reaches at 6/7
+    assert selector.track_rate('a', 1.0) == pytest.approx(120.0 / 140.0)
+    # untempoed tracks just follow the cadence
+    assert selector.track_rate('b', 1.2) == pytest.approx(1.2)
+
+def test_rate_rises_steadily_with_cadence():
+    selector = tempo.TempoSelector({'a': (100.0, 0.9)}, ['a'], reference=120.0)
+    rates = [selector.track_rate('a', multiplier / 100.0) for multiplier in range(25, 201)]
+    assert all(b > a for a, b in zip(rates, rates[1:]))
+    assert selector.track_rate('a', 1.42) == pytest.approx(1.42 * 120.0 / 100.0)
+
+def test_the_octave_is_settled_when_picked():
+    selector = tempo.TempoSelector({'a': (120.0, 0.9), 'b': (70.0, 0.9)}, ['a', 'b'], reference=120.0)
+    # a rider at 1.2x wants 144 BPM, so b is picked to play as 140
+    assert selector.choose(0, 1.2) == 1
+    assert selector.track_rate('b', 1.2) == pytest.approx(144.0 / 140.0)
+    # and stays in that octave as they slow down
+    assert selector.track_rate('b', 0.6) == pytest.approx(72.0 / 140.0)
+
+def test_choose_the_nearest_unplayed_tempo():
+    tempos = {'slow': (90.0, 0.9), 'mid': (120.0, 0.9), 'fast': (150.0, 0.9), 'unsure': (120.0, 0.05)}
+    playlist = ['slow', 'mid', 'fast', 'unsure', 'none']
+    selector = tempo.TempoSelector(tempos, playlist, reference=120.0)
+    assert 'unsure' not in selector.bpm
+    selector.track_started(0)
+    assert selector.choose(0, 1.25) == 2
+    # picking has no side effects; asking again gives the same answer
+    assert selector.choose(0, 1.25) == 2
+    selector.track_started(2)
+    assert selector.choose(2, 1.25) == 1
+    selector.track_started(1)
+    # only the ones without a usable tempo are left
+    assert selector.choose(1, 1.25) in (3, 4)
+
+def test_choose_starts_a_new_round():
+    selector = tempo.TempoSelector({}, ['a', 'b'])
+    selector.track_started(0)
+    assert selector.choose(0, 1.0) == 1
+    selector.track_started(1)
+    assert selector.choose(1, 1.0) == 0
+    assert tempo.TempoSelector({}, ['a']).choose(0, 1.0) is None
+
+def test_estimate_finds_a_click_track():
+    numpy = pytest.importorskip('numpy')
+    fps = float(tempo.analysis_rate) / tempo.hop_size
+    frames = int(fps * 30)
+    envelope = numpy.zeros(frames)
+    period = 60.0 * fps / 128.0
+    envelope[(numpy.arange(0, frames / period) * period).astype(int)] = 1.0
+    bpm, confidence = tempo.estimate(envelope)
+    assert bpm == pytest.approx(128.0, rel=0.02)
+    assert confidence > 0.5
+
+def test_estimate_needs_enough_audio():
+    numpy = pytest.importorskip('numpy')
+    assert tempo.estimate(numpy.ones(10)) == (None, 0.0)
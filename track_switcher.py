@@ -0,0 +1,440 @@
+#!/usr/bin/python3
+
+# Gapless track switching for the GStreamer players.
+#
+# Each playlist entry gets its own filesrc ! decodebin ! audioconvert
+# branch, or an appsrc ! rawaudioparse ! audioconvert one when it is in the
+# PCM cache, feeding an input-selector. decodebin picks the decoder by
+# rank, see decoders.py. The previous track and the next one (in
+# playlist order, or whatever choose_next picks) are built ahead of time
+# and held on a blocking pad probe once their first buffer is decoded, so a
+# skip or the end of a track only has to flip the selector's active pad and
+# release the probe. The previous track is the one that actually played
+# before, kept on a history stack, so going back retraces whatever
+# choose_next picked.
+#
+# With a rate ladder (see rate_ladder.py) a branch may instead play one of
+# the track's pre-rendered rates, and replace() rebuilds the current track
+# part way through from another one. Positions handed to the switcher are
+# always in track time.
+#
+# Downstream of the rate engine, running time is stretched by the rate, so
+# the pad offset that butts the next track up against the end of the
+# last is only right at 1.0x. With follow(engine element) the switcher
+# watches where the engine's output ended, in its own running time, and
+# rewrites the next track's segment as it reaches the engine to start
+# exactly there.
+
+import sys, time, collections
+
+import gi
+
+gi.require_version('Gst', '1.0')
+from gi.repository import GLib, Gst
+
+from pcm_cache import PcmSource
+
+max_history = 100
+
+class TrackBranch(object):
+
+    def __init__(self, index, location, name, pcm=None, rate=1.0, start=0):
+        self.index = index
+        self.location = location
+        self.pcm_source = None
+        # the rate pcm was rendered at, and the track position, in ns,
+        # that the branch starts from
+        self.rate = rate
+        self.start = start
+
+        self.bin = Gst.Bin.new(name)
+        if pcm is not None:
+            self.pcm_source = PcmSource(pcm, start / rate)
+            self.source = self.pcm_source.element
+            self.decoder = Gst.ElementFactory.make("rawaudioparse", None)
+            self.decoder.set_property("use-sink-caps", True)
+        else:
+            self.source = Gst.ElementFactory.make("filesrc", None)
+            self.decoder = Gst.ElementFactory.make("decodebin", None)
+            self.source.set_property("location", location)
+            # stop at raw audio, and only take the first audio stream
+            self.decoder.set_property("caps", Gst.Caps.from_string("audio/x-raw"))
+            self.decoder.connect("pad-added", self.on_pad_added)
+        self.conv = Gst.ElementFactory.make("audioconvert", None)
+
+        self.bin.add(self.source)
+        self.bin.add(self.decoder)
+        self.bin.add(self.conv)
+
+        self.source.link(self.decoder)
+        if pcm is not None:
+            self.decoder.link(self.conv)
+
+        self.srcpad = Gst.GhostPad.new("src", self.conv.get_static_pad("src"))
+        self.bin.add_pad(self.srcpad)
+
+        self.selector_pad = None
+        self.block_probe = None
+        # the decoder's segment, before the pad offset is applied to it
+        self.segment = None
+        # running time, before the pad offset, at which the last buffer ended
+        self.end = 0
+
+    def on_pad_added(self, element, pad):
+        # on the streaming thread, while the branch pre-rolls
+        sinkpad = self.conv.get_static_pad("sink")
+        if sinkpad.is_linked():
+            return
+        caps = pad.get_current_caps() or pad.query_caps(None)
+        if caps.is_empty() or not caps.get_structure(0).get_name().startswith("audio/x-raw"):
+            return
+        pad.link(sinkpad)
+
+    def close(self):
+        if self.pcm_source is not None:
+            self.pcm_source.close()
+
+class EngineOutput(object):
+
+    # where the audio out of a rate engine ended, in running time after the
+    # engine, for placing the next track on a gapless handoff
+
+    def __init__(self, element):
+        self.segment = None
+        self.end = None
+        # the next segment into the engine starts a track
+        self.handoff = False
+        self.injecting = False
+        element.get_static_pad("src").add_probe(
+            Gst.PadProbeType.BUFFER | Gst.PadProbeType.EVENT_DOWNSTREAM, self.on_output)
+        element.get_static_pad("sink").add_probe(Gst.PadProbeType.EVENT_DOWNSTREAM, self.on_input)
+
+    def on_output(self, pad, info):
+        if info.type & Gst.PadProbeType.EVENT_DOWNSTREAM:
+            event = info.get_event()
+            if event.type == Gst.EventType.SEGMENT:
+                self.segment = event.parse_segment().copy()
+            return Gst.PadProbeReturn.OK
+        buf = info.get_buffer()
+        if self.segment is not None and buf.pts != Gst.CLOCK_TIME_NONE:
+            duration = buf.duration if buf.duration != Gst.CLOCK_TIME_NONE else 0
+            end = self.segment.to_running_time(Gst.Format.TIME, buf.pts + duration)
+            if end != Gst.CLOCK_TIME_NONE:
+                self.end = end
+        return Gst.PadProbeReturn.OK
+
+    def on_input(self, pad, info):
+        # on the streaming thread; every buffer of the old track has been
+        # through the engine by the time the new track's segment gets here
+        event = info.get_event()
+        if self.injecting or event.type != Gst.EventType.SEGMENT or not self.handoff:
+            return Gst.PadProbeReturn.OK
+        self.handoff = False
+        if self.end is None:
+            return Gst.PadProbeReturn.OK
+        segment = event.parse_segment().copy()
+        segment.base = self.end
+        self.injecting = True
+        try:
+            pad.send_event(Gst.Event.new_segment(segment))
+        finally:
+            self.injecting = False
+        return Gst.PadProbeReturn.DROP
+
+class TrackSwitcher(object):
+
+    def __init__(self, pipeline, on_switch=None, cache=None, predecode=0):
+        self.pipeline = pipeline
+        self.on_switch = on_switch
+        self.cache = cache
+        self.predecode = predecode
+        self.playlist = []
+        self.branches = {}
+        self.current = None
+        self.index = 0
+        self.serial = 0
+        self.standby = (None, None)
+        # indexes played before the current one, most recent last
+        self.history = collections.deque(maxlen=max_history)
+
+        self.switch_started = None
+        self.latency_probe = None
+        self.latencies = []
+        self.on_latency = None
+        # picks the track after a given one; playlist order unless set
+        self.choose_next = None
+        # pre-rendered rates to play from instead, see rate_ladder.py
+        self.ladder = None
+        self.outputs = []
+
+        self.selector = Gst.ElementFactory.make("input-selector", "track-selector")
+        # standby branches are blocked by us, so never make them wait on
+        # the active one
+        self.selector.set_property("sync-streams", False)
+        self.pipeline.add(self.selector)
+
+    def link(self, element):
+        return self.selector.link(element)
+
+    def follow(self, element):
+        # a rate engine downstream, to place gapless handoffs by its output
+        self.outputs.append(EngineOutput(element))
+
+    def start(self, playlist, index=0):
+        self.playlist = playlist
+        return self.switch(index, flush=False)
+
+    def next_index(self, index):
+        if self.choose_next is not None:
+            return self.choose_next(index)
+        if index + 1 < len(self.playlist):
+            return index + 1
+        return None
+
+    def previous_index(self, index):
+        if self.history:
+            return self.history[-1]
+        if index > 0:
+            return index - 1
+        return None
+
+    def prepare(self, index, start=0):
+        if index is None or index in self.branches or not 0 <= index < len(self.playlist):
+            return
+
+        self.serial += 1
+        location = self.playlist[index]
+        pcm, rate = None, 1.0
+        if self.ladder is not None:
+            pcm, rate = self.ladder.lookup(location)
+        if pcm is None and self.cache is not None:
+            pcm = self.cache.lookup(location)
+        if pcm is None:
+            # decodebin can only start from the top
+            start = 0
+        branch = TrackBranch(index, location, "track-%d" % self.serial, pcm, rate, start)
+        self.pipeline.add(branch.bin)
+
+        branch.selector_pad = self.selector.get_request_pad("sink_%u")
+        branch.srcpad.link(branch.selector_pad)
+
+        # hold the branch once the decoder has produced its first buffer
+        branch.block_probe = branch.srcpad.add_probe(
+            Gst.PadProbeType.BLOCK | Gst.PadProbeType.BUFFER, self.on_blocked, branch)
+        branch.srcpad.add_probe(Gst.PadProbeType.BUFFER, self.on_buffer, branch)
+        branch.srcpad.add_probe(Gst.PadProbeType.EVENT_DOWNSTREAM, self.on_event, branch)
+        # inside the bin, where the segment has no pad offset in it
+        branch.conv.get_static_pad("src").add_probe(Gst.PadProbeType.EVENT_DOWNSTREAM, self.on_segment, branch)
+
+        self.branches[index] = branch
+        branch.bin.sync_state_with_parent()
+
+    def dispose(self, branch):
+        if self.branches.get(branch.index) is branch:
+            del self.branches[branch.index]
+        branch.bin.set_state(Gst.State.NULL)
+        branch.srcpad.unlink(branch.selector_pad)
+        self.selector.release_request_pad(branch.selector_pad)
+        self.pipeline.remove(branch.bin)
+        branch.close()
+
+    def running_time(self):
+        if self.current is None:
+            return 0
+        if self.pipeline.get_state(0)[1] == Gst.State.PAUSED:
+            # start-time holds the running time at which we paused
+            return self.pipeline.get_start_time()
+        clock = self.pipeline.get_clock()
+        if clock is None:
+            return 0
+        return max(0, clock.get_time() - self.pipeline.get_base_time())
+
+    def switch(self, index, flush=True, notify=True, remember=True):
+        if index is None or not 0 <= index < len(self.playlist):
+            return False
+
+        self.switch_started = time.monotonic()
+        self.prepare(index)
+        branch = self.branches[index]
+        old = self.current
+
+        if old is not None and not flush:
+            # carry straight on from where the old track's audio ended; the
+            # engines being followed correct this for their rate
+            offset = old.srcpad.get_offset() + old.end
+        else:
+            offset = self.running_time()
+        for output in self.outputs:
+            output.handoff = old is not None and not flush
+
+        self.selector.set_property("active-pad", branch.selector_pad)
+
+        if old is not None and flush:
+            # drop whatever of the old track is still queued downstream
+            srcpad = self.selector.get_static_pad("src")
+            srcpad.push_event(Gst.Event.new_flush_start())
+            srcpad.push_event(Gst.Event.new_flush_stop(False))
+
+        branch.srcpad.set_offset(offset)
+        if self.latency_probe is None:
+            self.latency_probe = self.selector.get_static_pad("src").add_probe(
+                Gst.PadProbeType.BUFFER, self.on_switched)
+        if branch.block_probe is not None:
+            branch.srcpad.remove_probe(branch.block_probe)
+            branch.block_probe = None
+
+        self.current = branch
+        self.index = index
+        if remember and old is not None and old.index != index:
+            self.history.append(old.index)
+
+        # the old branch is part way through its track, so it is no use as
+        # a standby; rebuild the neighbours from the start of their files
+        if old is not None:
+            self.dispose(old)
+        self.standby = (self.previous_index(index), self.next_index(index))
+        for stale in [b for i, b in self.branches.items() if i != index and i not in self.standby]:
+            self.dispose(stale)
+        for standby in self.standby:
+            self.prepare(standby)
+        if self.cache is not None:
+            self.cache.predecode(self.playlist[index:index + 1 + self.predecode])
+
+        if notify and self.on_switch is not None:
+            self.on_switch(index)
+        return True
+
+    def replace(self, position):
+        # rebuild the current track from position on, from whatever source
+        # prepare picks for it now; the standby branches are rebuilt too so
+        # that they match. Does not count as a track change.
+        old = self.current
+        if old is None:
+            return False
+        for branch in list(self.branches.values()):
+            if branch is not old:
+                self.dispose(branch)
+        del self.branches[old.index]
+        self.prepare(old.index, position)
+        return self.switch(old.index, notify=False)
+
+    def seek(self, position):
+        # a flushing seek of the current branch alone, the standby ones stay
+        # at the start of their tracks; best done while PAUSED
+        current = self.current
+        if current is None:
+            return False
+        position = int(max(0, position - current.start) / current.rate)
+        return current.srcpad.send_event(Gst.Event.new_seek(
+            1.0, Gst.Format.TIME, Gst.SeekFlags.FLUSH | Gst.SeekFlags.ACCURATE,
+            Gst.SeekType.SET, position, Gst.SeekType.NONE, -1))
+
+    def reset(self):
+        # drop every branch, with the pipeline already in NULL
+        for branch in list(self.branches.values()):
+            self.dispose(branch)
+        self.current = None
+        self.standby = (None, None)
+
+    def refresh_next(self):
+        # ask choose_next again and pre-roll its pick instead, if it has
+        # changed its mind; True if it has
+        following = self.next_index(self.index)
+        if following == self.standby[1] or following == self.index:
+            return False
+        stale = self.branches.get(self.standby[1])
+        if stale is not None and self.standby[1] != self.standby[0]:
+            self.dispose(stale)
+        self.standby = (self.standby[0], following)
+        self.prepare(following)
+        return True
+
+    def skip(self):
+        # to the pre-rolled standby
+        return self.switch(self.standby[1])
+
+    def previous(self):
+        # back to the track played before this one, which is not pushed on
+        # to the history in turn
+        index = self.standby[0]
+        if index is None:
+            return False
+        if self.history and self.history[-1] == index:
+            self.history.pop()
+        return self.switch(index, remember=False)
+
+    def advance(self, branch):
+        if branch is self.current:
+            self.switch(self.standby[1], flush=False)
+        return GLib.SOURCE_REMOVE
+
+    def standby_error(self, element):
+        # an ERROR from element; True when it only cost a standby track,
+        # which is dropped with the one after it pre-rolled in its place, or
+        # came from a branch that has gone already. False when it came from
+        # the current track or elsewhere in the pipeline.
+        while element is not None and element != self.pipeline:
+            for branch in list(self.branches.values()):
+                if element == branch.bin:
+                    break
+            else:
+                element = element.get_parent()
+                continue
+            if branch is self.current:
+                return False
+            self.dispose(branch)
+            if branch.index == self.standby[1]:
+                following = self.next_index(branch.index)
+                if following == self.index:
+                    following = None
+                self.standby = (self.standby[0], following)
+                self.prepare(following)
+            elif branch.index == self.standby[0]:
+                self.standby = (None, self.standby[1])
+            return True
+        # a branch that has been disposed of since
+        return element is None
+
+    def on_blocked(self, pad, info, branch):
+        return Gst.PadProbeReturn.OK
+
+    def on_buffer(self, pad, info, branch):
+        buf = info.get_buffer()
+        if buf.pts != Gst.CLOCK_TIME_NONE:
+            duration = buf.duration if buf.duration != Gst.CLOCK_TIME_NONE else 0
+            end = buf.pts + duration
+            if branch.segment is not None:
+                # after a seek the pts carry on from the seek position while
+                # running time starts again from zero
+                end = branch.segment.to_running_time(Gst.Format.TIME, end)
+            if end != Gst.CLOCK_TIME_NONE:
+                branch.end = end
+        return Gst.PadProbeReturn.OK
+
+    def on_segment(self, pad, info, branch):
+        event = info.get_event()
+        if event.type == Gst.EventType.SEGMENT:
+            # a copy; the parsed one belongs to the event
+            branch.segment = event.parse_segment().copy()
+        return Gst.PadProbeReturn.OK
+
+    def on_event(self, pad, info, branch):
+        event = info.get_event()
+        if event.type == Gst.EventType.EOS and self.standby[1] is not None:
+            # keep the EOS away from the sink and roll on to the standby
+            GLib.idle_add(self.advance, branch, priority=GLib.PRIORITY_HIGH)
+            return Gst.PadProbeReturn.DROP
+        return Gst.PadProbeReturn.OK
+
+    def on_switched(self, pad, info):
+        latency = (time.monotonic() - self.switch_started) * 1000
+        self.latencies.append(latency)
+        self.latency_probe = None
+        GLib.idle_add(self.report_latency, latency)
+        return Gst.PadProbeReturn.REMOVE
+
+    def report_latency(self, latency):
+        sys.stdout.write("switch latency: %.1f ms\n" % latency)
+        if self.on_latency is not None:
+            self.on_latency(latency)
+        return GLib.SOURCE_REMOVE
@@ -1,60 +1,74 @@
 #!/usr/bin/python3
-import sys, os, signal, time, traceback
+import sys, os, signal, time, traceback, argparse
 
-import RPi.GPIO as GPIO
 from signal import pause
 
 import logging
 
 from mplayer.core import Player
 
-import board
-import busio
-from digitalio import DigitalInOut, Direction, Pull
-import adafruit_ads1x15.ads1015 as ADS
-from adafruit_ads1x15.analog_in import AnalogIn
+import hardware
+import library
+import mplayer_control
+import status_display
+import profiler
+import adc_sampler
 
 play_pin = 25
 prev_pin = 23
 next_pin = 12
 
+# status fields: name, format, width
+status_layout = [
+    ('track', '{}', 32),
+    ('speed', '{:4.2f}x', 5),
+]
+
 class SpeedoPlayer(object):
-    def __init__(self):
+    def __init__(self, options, backend):
         self.multiplier = 2.0
         self.speed_refresh_delay = 0.25
-        self.player = Player()
+        self.backend = backend
+        args = mplayer_control.player_args + (('-ao', options.ao) if options.ao else ())
+        self.player = Player(args=args)
+        self.control = mplayer_control.MplayerControl(self.player, options.speed_deadband)
+        self.status = status_display.from_options(options, status_layout, self.status_track)
+        self.profiler = profiler.from_options(options)
+        # the ADC is read on the sampler thread; time each I2C read
+        backend.read_voltage = self.profiler.timed(backend.read_voltage, 'read_voltage', 'i2c')
 
     def display(self):
-        print("{0}\t{1:05.2f}".format(self.player.filename, self.multiplier*100), end='\r')
-
-    def start(self, args):
-        # The script expects MP3 files to be given as arguments
-        if len(args) < 2:
-            sys.stderr.write("usage: %s <media file or uri>\n" % args[0])
-            sys.exit(1)
-        else:
-            for arg in args[1:]:
-                if os.path.isfile(arg):
-                    self.player.loadfile(arg, 1)
+        self.status.update(speed=self.multiplier)
 
-        # Create the I2C bus
-        i2c = busio.I2C(board.SCL, board.SDA)
+    def status_track(self):
+        # called on the status thread
+        filename = self.control.filename
+        return {'track': os.path.basename(filename) if filename else None}
 
-        # Create the ADC object using the I2C bus
-        ads = ADS.ADS1015(i2c)
+    def start(self, options):
+        # files, directories and M3U playlists, expanded through the index
+        self.library = library.from_options(options)
+        for path in self.library.playlist(options.files):
+            self.control.loadfile(path, 1)
+        self.library.rescan()
 
-        # Create single-ended input on channel 0
-        chan = AnalogIn(ads, ADS.P0)
+        # sample the ADS1015 in the background so the loop below never
+        # waits on the I2C bus
+        self.sampler = adc_sampler.from_options(options, self.backend)
+        self.sampler.start()
 
         # Need to wait for the first track to load
-        while self.player.paused is True:
-            time.sleep(0.1)
+        self.control.wait_started()
+        self.status.start()
 
-        while self.player.paused is False:
+        self.profiler.start()
+        while self.control.paused is False and not self.control.finished.is_set():
+            started = time.monotonic()
             try:
-                self.multiplier = (chan.voltage / 4.09) + 0.25
+                self.multiplier = (self.sampler.latest / 4.09) + 0.25
+                self.control.set_speed(self.multiplier)
                 self.display()
-                self.player.speed = self.multiplier
+                self.profiler.complete('tick', started, time.monotonic())
                 time.sleep(self.speed_refresh_delay)
             except:
                 print('Exception in user code:')
@@ -62,26 +76,30 @@ class SpeedoPlayer(object):
                 traceback.print_exc(file=sys.stdout)
                 print('-'*60)
 
-        self.player.stop();
+        self.sampler.stop()
+        self.status.stop()
+        self.profiler.stop()
+        self.control.stop()
+        self.control.close()
 
     def playpause(self, number):
         print("Play / pause pressed")
-        self.player.pause()
-        self.player.speed = self.multiplier
+        self.control.pause()
+        self.control.set_speed(self.multiplier, force=True)
 
     def skipnext(self, number):
         print("Skipping to next track")
-        self.player.pt_step(1)
-        self.player.speed = self.multiplier
+        self.control.pt_step(1)
+        self.control.set_speed(self.multiplier, force=True)
 
     def skipprev(self, number):
         print("Skipping to previous track")
-        self.player.pt_step(-1)
-        self.player.speed = self.multiplier
+        self.control.pt_step(-1)
+        self.control.set_speed(self.multiplier, force=True)
 
     def cleanup(self):
         print("Cleaup called")
-        self.player.quit()
+        self.control.quit()
 
     def signal_handler(self, signalNumber, frame):
         print('received:', signalNumber)
@@ -89,32 +107,41 @@ class SpeedoPlayer(object):
         sys.exit(0)
 
 
-if __name__ == '__main__':
-    app = SpeedoPlayer()
-
-    GPIO.setmode(GPIO.BCM)
-    GPIO.setwarnings(False)
+def parse_args(args):
+    parser = argparse.ArgumentParser(prog=args[0])
+    parser.add_argument('files', nargs='+', metavar='<media file, directory or m3u>')
+    parser.add_argument('--ao', help="mplayer audio output driver, e.g. null to run without a sound card")
+    hardware.add_arguments(parser)
+    library.add_arguments(parser)
+    mplayer_control.add_arguments(parser)
+    status_display.add_arguments(parser)
+    profiler.add_arguments(parser)
+    adc_sampler.add_arguments(parser)
+    return parser.parse_args(args[1:])
 
-    # GPIO.setup(hall_pin, GPIO.IN, pull_up_down = GPIO.PUD_UP)
-    # GPIO.add_event_detect(hall_pin, GPIO.FALLING, callback = app.get_pulse, bouncetime=20)
+if __name__ == '__main__':
+    options = parse_args(sys.argv)
 
-    GPIO.setup(play_pin, GPIO.IN, pull_up_down = GPIO.PUD_UP)
-    GPIO.add_event_detect(play_pin, GPIO.FALLING, callback = app.playpause, bouncetime=500)
+    backend = hardware.from_options(options)
+    app = SpeedoPlayer(options, backend)
 
-    GPIO.setup(prev_pin, GPIO.IN, pull_up_down = GPIO.PUD_UP)
-    GPIO.add_event_detect(prev_pin, GPIO.FALLING, callback = app.skipprev, bouncetime=500)
+    # backend.add_edge_callback(hall_pin, app.get_pulse, 20)
 
-    GPIO.setup(next_pin, GPIO.IN, pull_up_down = GPIO.PUD_UP)
-    GPIO.add_event_detect(next_pin, GPIO.FALLING, callback = app.skipnext, bouncetime=500)
+    backend.add_edge_callback(play_pin, app.playpause, 500)
+    backend.add_edge_callback(prev_pin, app.skipprev, 500)
+    backend.add_edge_callback(next_pin, app.skipnext, 500)
+    backend.start()
 
     # register the signals to be caught
     signal.signal(signal.SIGINT, app.signal_handler)
     signal.signal(signal.SIGTERM, app.signal_handler)
 
     try:
-        app.start(sys.argv)
+        app.start(options)
     except:
         print('Exception in user code:')
         print('-'*60)
         traceback.print_exc(file=sys.stdout)
         print('-'*60)
+
+    backend.cleanup()
@@ -1,44 +1,77 @@
 #!/usr/bin/python3
 
-import sys, os, signal, time, traceback
+import sys, os, signal, time, traceback, argparse
 import termios, tty
 import gi
 
-import RPi.GPIO as GPIO
 from signal import pause
 
 import logging
 
-import board
-import busio
-from digitalio import DigitalInOut, Direction, Pull
-import adafruit_ads1x15.ads1015 as ADS
-from adafruit_ads1x15.analog_in import AnalogIn
-
-from helper import format_ns
+from helper import format_clock
+from track_switcher import TrackSwitcher
+from position import PositionTracker
+import rate_engine
+import rate_ladder
+import pcm_cache
+import decoders
+import adaptive_buffer
+import supervisor
+import hardware
+import library
+import metrics
+import telemetry
+import status_display
+import profiler
+import adc_sampler
 
 gi.require_version('Gst', '1.0')
-from gi.repository import GObject, Gst
+from gi.repository import GLib, GObject, Gst
+
+# 'speed', 'scaletempo' or 'pitch', see rate_engine.py
+engine_name = 'speed'
+engine_quality = 'medium'
+# seconds of track over which the rate glides to a new value
+ramp_time = 0.5
 
 play_pin = 25
 prev_pin = 23
 next_pin = 12
 
+# status fields: name, format, width
+status_layout = [
+    ('track', '{}', 32),
+    ('voltage', '{:4.2f} V', 6),
+    ('rate', '{:4.2f}x', 5),
+    ('position', '{}', 15),
+]
+
 class MalvernStar_Player(object):
 
-    def __init__(self):
+    def __init__(self, loop, options, backend):
+
+        self.loop = loop
+        self.backend = backend
+        self.playlist = None
+        self.playspeed = None
+        self.ramp_time = options.ramp_time
 
         self.was_playpause_held = False
 
         self.player = Gst.Pipeline.new("player")
         self.player.set_auto_flush_bus(True)
 
-        self.source = Gst.ElementFactory.make("filesrc", "source")
-        self.decoder = Gst.ElementFactory.make("mad", "mp3-decoder")
-        self.speed = Gst.ElementFactory.make("speed", "speed")
-        self.conv = Gst.ElementFactory.make("audioconvert", "converter")
+        # rank the cheapest decoders first, here and in the cache's children
+        decoders.from_options(options)
+        self.cache = None
+        if options.cache_dir is not None:
+            self.cache = pcm_cache.PcmCache(options.cache_dir, options.cache_budget * 1024 * 1024)
+        self.switcher = TrackSwitcher(self.player, self.track_changed, self.cache, options.predecode)
+        self.engine = rate_engine.make_engine(options.engine, options.quality)
         self.queue = Gst.ElementFactory.make("queue", "queue")
-        self.sink = Gst.ElementFactory.make("alsasink", "alsa-output")
+        self.sink = Gst.ElementFactory.make(options.sink, "alsa-output")
+        if options.sink == 'fakesink':
+            self.sink.set_property('sync', True)
 
         self.queue.set_property('max-size-buffers', 0)
         self.queue.set_property('max-size-bytes', 0)
@@ -47,82 +80,135 @@ class MalvernStar_Player(object):
         self.queue.connect('underrun', self.on_underrun)
         self.queue.connect('pushing', self.on_pushing)
         self.queue.connect('running', self.on_running)
-        
-        self.player.add(self.source)
-        self.player.add(self.decoder)
-        self.player.add(self.speed)
-        self.player.add(self.conv)
+        self.buffering = adaptive_buffer.from_options(options, self.sink, self.queue)
+
+        self.metrics = metrics.PipelineMetrics(self)
+        self.telemetry = telemetry.from_options(options, backend.clock)
+        self.profiler = profiler.from_options(options)
+        # the ADC is read on the sampler thread; time each I2C read
+        backend.read_voltage = self.profiler.timed(backend.read_voltage, 'read_voltage', 'i2c')
+        self.switcher.on_latency = self.metrics.switched
+        self.supervisor = supervisor.Supervisor(self, options)
+        self.finished = False
+        self.failed = False
+        self.status = status_display.from_options(options, status_layout, self.status_position)
+
+        self.player.add(self.engine.element)
         self.player.add(self.queue)
         self.player.add(self.sink)
 
-        self.source.link(self.decoder)
-        self.decoder.link(self.conv)
-        self.conv.link(self.queue)
-        self.queue.link(self.speed)
-        self.speed.link(self.sink)
+        self.switcher.link(self.queue)
+        self.queue.link(self.engine.element)
+        self.engine.element.link(self.sink)
+        self.switcher.follow(self.engine.element)
 
-        self.duration = Gst.CLOCK_TIME_NONE
+        self.position = PositionTracker(self.switcher)
+        # the engine only does what is left between the pre-rendered rates
+        self.ladder = rate_ladder.from_options(options, self.engine, self.switcher, self.position)
+        if self.ladder is not None:
+            self.engine = self.ladder
 
         # create an event loop and feed gstreamer bus mesages to it
         self.bus = self.player.get_bus()
         self.bus.add_signal_watch()
-        self.bus.connect ("message", self.bus_call, loop)
+        self.bus.connect ("message", self.bus_call, self.loop)
 
     def bus_call(self, bus, message, loop):
+        with self.profiler.span('bus message', args={'type': Gst.MessageType.get_name(message.type)}):
+            return self.handle_message(message, loop)
+
+    def handle_message(self, message, loop):
         t = message.type
         if t == Gst.MessageType.EOS:
             sys.stdout.write("End-of-stream\n")
+            self.finished = True
             loop.quit()
-        elif t == Gst.MessageType.DURATION_CHANGED:
-            # the duration has changed, invalidate the current one
-            self.duration = Gst.CLOCK_TIME_NONE
+        elif t in (Gst.MessageType.DURATION_CHANGED, Gst.MessageType.ASYNC_DONE):
+            # the duration has changed or can now be known, invalidate the
+            # cached one
+            self.position.duration_changed()
+        elif t == Gst.MessageType.WARNING:
+            self.metrics.bus_warnings.inc()
         elif t == Gst.MessageType.ERROR:
             err, debug = message.parse_error()
+            self.metrics.bus_errors.inc()
             sys.stderr.write("Error: %s: %s\n" % (err, debug))
-            loop.quit()
+            if self.switcher.standby_error(message.src):
+                # only a track waiting its turn; it is skipped
+                return True
+            if not self.supervisor.error():
+                self.failed = True
+                loop.quit()
         return True
 
-    def start(self, args):
-
-        speed_refresh_delay = 0.25
-        self.playnumber = 0;
-        self.playlist = []
-
-        if len(args) < 2:
-            sys.stderr.write("usage: %s <media file or uri>\n" % args[0])
-            sys.exit(1)
-        else:
-            for arg in args[1:]:
-                if os.path.isfile(arg):
-                    self.playlist.append(os.path.realpath(arg))
-
-        # take the commandline argument and ensure that it is a uri
-        self.source.set_property("location", self.playlist[0])
-
-        # Create the I2C bus
-        i2c = busio.I2C(board.SCL, board.SDA)
-
-        # Create the ADC object using the I2C bus
-        ads = ADS.ADS1015(i2c)
-
-        # Create single-ended input on channel 0
-        chan = AnalogIn(ads, ADS.P0)
-
-        # start play back and listed to events
-        self.player.set_state(Gst.State.PLAYING)
-
-        while self.player.get_state(Gst.CLOCK_TIME_NONE)[1] in [Gst.State.PLAYING, Gst.State.PAUSED]:
-            playspeed = (chan.voltage / 4.09) + 0.5
-            ret, current = self.decoder.query_position(Gst.Format.TIME)
-            # print current position and total duration
-            if self.duration == Gst.CLOCK_TIME_NONE:
-                (ret, duration) = self.player.query_duration(Gst.Format.TIME)
-                if not ret:
-                    print("ERROR: Could not query stream duration")
-                self.duration = duration
-            print("{0}\t{1}\t{2:05.2f}".format(self.playlist[self.playnumber], chan.voltage, playspeed*100))
-            self.speed.set_property("speed", playspeed)
-            time.sleep(speed_refresh_delay)
+    def voltage_changed(self, voltage):
+        # called on the sampler thread, the pipeline is driven from the loop
+        GLib.idle_add(self.apply_voltage, voltage, time.monotonic(), priority=GLib.PRIORITY_HIGH)
+
+    def apply_voltage(self, voltage, seen=None):
+        started = time.monotonic()
+        if seen is not None:
+            self.profiler.complete('voltage to apply_voltage', seen, started, 'gpio')
+        try:
+            playspeed = (voltage / 4.09) + 0.5
+            # only touch the pipeline when the knob has actually moved
+            if playspeed != self.playspeed:
+                self.playspeed = playspeed
+                with self.profiler.span('ramp_to', 'gst'):
+                    self.engine.ramp_to(playspeed, self.ramp_time)
+                self.position.set_rate(self.engine.rate)
+                self.telemetry.record(telemetry.RATE, voltage, self.engine.rate, self.playnumber)
+                self.status.update(voltage=voltage, rate=self.engine.rate)
+        except:
+            print('Exception in user code:')
+            print('-'*60)
+            traceback.print_exc(file=sys.stdout)
+            print('-'*60)
+        self.profiler.complete('apply_voltage', started, time.monotonic())
+        return GLib.SOURCE_REMOVE
+
+    def status_position(self):
+        # called on the status thread
+        return {'position': "%s / %s" % (format_clock(self.position.position()),
+                                         format_clock(self.position.duration()))}
+
+    def preroll(self, options):
+
+        # one index query per directory; the walk for new or changed files
+        # and their tags happens in the background
+        self.library = library.from_options(options)
+        self.playlist = self.library.playlist(options.files)
+        self.library.rescan()
+        # where the checkpoint says, or from the top with --from-start
+        self.playnumber, position = self.supervisor.resume_point(self.playlist)
+
+        # build the first track and its neighbours; they decode on their
+        # streaming threads while the ADC and GPIO pins are set up
+        self.supervisor.preroll(self.playnumber, position)
+
+    def start(self, options):
+        if self.playlist is None:
+            self.preroll(options)
+
+        # sample the ADS1015 in the background; the main loop only hears
+        # about it when the knob has actually moved. Opening it imports the
+        # Adafruit libraries, the slowest part of starting up.
+        self.sampler = adc_sampler.from_options(options, self.backend, self.voltage_changed)
+        self.sampler.start()
+        supervisor.startup.mark('adc')
+
+        # start play back and listen to events
+        self.telemetry.start()
+        self.profiler.start()
+        self.status.start()
+        self.supervisor.start()
+        self.supervisor.play()
+        self.loop.run()
+        self.supervisor.stop(self.finished)
+        self.sampler.stop()
+        self.status.stop()
+        self.profiler.stop()
+        self.telemetry.stop()
 
         self.player.set_state(Gst.State.NULL);
 
@@ -138,38 +224,47 @@ class MalvernStar_Player(object):
     def playpause(self, number):
         if self.player.get_state(0)[1] == Gst.State.PAUSED:
             self.player.set_state(Gst.State.PLAYING)
+            self.telemetry.record(telemetry.PLAY, track=self.playnumber)
         else:
             self.player.set_state(Gst.State.PAUSED)
+            self.telemetry.record(telemetry.PAUSE, track=self.playnumber)
         print("play / pause music playback")
 
     def skipnext(self, number):
-        if (self.playnumber<(len(self.playlist)-1)):
-            self.player.set_state(Gst.State.NULL)
-            self.playnumber=self.playnumber+1
-            self.source.set_property("location", self.playlist[self.playnumber])
-            self.player.set_state(Gst.State.PLAYING)
-            print(self.playlist[self.playnumber])
-        else:
+        if not self.switcher.skip():
             print("no next track")
 
     def skipprev(self, number):
-        if (self.playnumber>0):
-            self.player.set_state(Gst.State.NULL)
-            self.playnumber=self.playnumber-1
-            self.source.set_property("location", self.playlist[self.playnumber])
-            self.player.set_state(Gst.State.PLAYING)
-            print(self.playlist[self.playnumber])
-        else:
+        if not self.switcher.previous():
             print("no prev track")
 
+    def track_changed(self, index):
+        self.playnumber = index
+        self.telemetry.record(telemetry.TRACK, track=index)
+        self.position.track_changed()
+        if self.ladder is not None:
+            self.ladder.track_changed()
+        if self.buffering is not None:
+            self.buffering.track_changed()
+        self.status.update(track=os.path.basename(self.playlist[self.playnumber]))
+
+    # the queue signals arrive on streaming threads
     def on_overrun(self, element):
         logging.debug('on_overrun')
+        self.metrics.overruns.inc()
+        self.telemetry.record(telemetry.OVERRUN)
 
     def on_underrun(self, element):
         logging.debug('on_underrun')
+        self.metrics.underrun()
+        self.telemetry.record(telemetry.UNDERRUN)
+        if self.buffering is not None:
+            self.buffering.underrun()
 
     def on_running(self, element):
         logging.debug('on_running')
+        self.metrics.running()
+        self.telemetry.record(telemetry.RUNNING)
 
     def on_pushing(self, element):
         logging.debug('on_pushing')
@@ -178,44 +273,86 @@ class MalvernStar_Player(object):
         sys.stderr.write("cleaup called\n")
         self.player.set_state(Gst.State.NULL)
 
-    def signal_handler(self, signalNumber, frame):
-        print('received:', signalNumber)
+    def quit(self):
         self.cleanup()
-        sys.exit(0)
+        self.loop.quit()
+        return GLib.SOURCE_REMOVE
 
+    def signal_handler(self, signalNumber, frame=None):
+        print('received:', signalNumber)
+        return self.quit()
+
+
+def parse_args(args):
+    parser = argparse.ArgumentParser(prog=args[0])
+    parser.add_argument('files', nargs='+', metavar='<media file, directory or m3u>')
+    parser.add_argument('--engine', choices=sorted(rate_engine.engines), default=engine_name,
+                        help="playback rate engine")
+    parser.add_argument('--quality', default=engine_quality,
+                        help="scaletempo preset (low, medium, high) or stride,overlap,search")
+    parser.add_argument('--ramp-time', type=float, default=ramp_time,
+                        help="seconds over which rate changes are ramped, 0 to jump")
+    parser.add_argument('--sink', default='alsasink', help="audio sink element, e.g. fakesink to run without a sound card")
+    parser.add_argument('--cache-dir', help="decode tracks once to PCM here and play them from the cache")
+    parser.add_argument('--cache-budget', type=int, default=pcm_cache.default_budget // (1024 * 1024),
+                        help="PCM cache size limit in MiB")
+    parser.add_argument('--predecode', type=int, default=pcm_cache.default_predecode,
+                        help="number of upcoming tracks to decode into the cache in the background")
+    hardware.add_arguments(parser)
+    library.add_arguments(parser)
+    metrics.add_arguments(parser)
+    telemetry.add_arguments(parser)
+    decoders.add_arguments(parser)
+    adaptive_buffer.add_arguments(parser)
+    rate_ladder.add_arguments(parser)
+    supervisor.add_arguments(parser)
+    status_display.add_arguments(parser)
+    profiler.add_arguments(parser)
+    adc_sampler.add_arguments(parser)
+    return parser.parse_args(args[1:])
 
 if __name__ == '__main__':
 
-    GObject.threads_init()
-    Gst.init(None)
-    loop = GObject.MainLoop()
-
-    app = MalvernStar_Player()
-
-    GPIO.setmode(GPIO.BCM)
-    GPIO.setwarnings(False)
-
-    # GPIO.setup(hall_pin, GPIO.IN, pull_up_down = GPIO.PUD_UP)
-    # GPIO.add_event_detect(hall_pin, GPIO.FALLING, callback = app.get_pulse, bouncetime=20)
+    options = parse_args(sys.argv)
+    supervisor.startup.mark('imports')
 
-    GPIO.setup(play_pin, GPIO.IN, pull_up_down = GPIO.PUD_UP)
-    GPIO.add_event_detect(play_pin, GPIO.FALLING, callback = app.playpause, bouncetime=500)
-
-    GPIO.setup(prev_pin, GPIO.IN, pull_up_down = GPIO.PUD_UP)
-    GPIO.add_event_detect(prev_pin, GPIO.FALLING, callback = app.skipprev, bouncetime=500)
+    profiler.prepare(options)
+    Gst.init(None)
+    supervisor.startup.mark('gst_init')
+    loop = GLib.MainLoop()
 
-    GPIO.setup(next_pin, GPIO.IN, pull_up_down = GPIO.PUD_UP)
-    GPIO.add_event_detect(next_pin, GPIO.FALLING, callback = app.skipnext, bouncetime=500)
+    backend = hardware.from_options(options)
+    app = MalvernStar_Player(loop, options, backend)
+    supervisor.startup.mark('pipeline')
 
-    # register the signals to be caught
-    signal.signal(signal.SIGINT, app.signal_handler)
-    signal.signal(signal.SIGTERM, app.signal_handler)
+    # register the signals to be caught by the main loop
+    GLib.unix_signal_add(GLib.PRIORITY_HIGH, signal.SIGINT, app.signal_handler, signal.SIGINT)
+    GLib.unix_signal_add(GLib.PRIORITY_HIGH, signal.SIGTERM, app.signal_handler, signal.SIGTERM)
 
     try:
-        app.start(sys.argv)
+        # the first track decodes while the hardware is set up
+        app.preroll(options)
+        supervisor.startup.mark('playlist')
+
+        # backend.add_edge_callback(hall_pin, app.get_pulse, 20)
+
+        backend.add_edge_callback(play_pin, lambda number: GLib.idle_add(app.playpause, number), 500)
+        backend.add_edge_callback(prev_pin, lambda number: GLib.idle_add(app.skipprev, number), 500)
+        backend.add_edge_callback(next_pin, lambda number: GLib.idle_add(app.skipnext, number), 500)
+        if options.exit_after_trace:
+            backend.on_finished = lambda: GLib.idle_add(app.quit)
+        metrics.serve(app.metrics.registry, options.metrics_port, options.metrics_socket)
+        backend.start()
+        supervisor.startup.mark('hardware')
+
+        app.start(options)
     except:
+        app.failed = True
         print('Exception in user code:')
         print('-'*60)
         traceback.print_exc(file=sys.stdout)
         print('-'*60)
 
+    backend.cleanup()
+    # non-zero so supervisor.py or systemd restart us
+    sys.exit(1 if app.failed else 0)